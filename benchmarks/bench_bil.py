@@ -0,0 +1,94 @@
+"""
+Benchmark of clipping the PRISM .bil through the memory-mapped reader against rasterio/GDAL.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_bil --clips 200
+
+The tutorial data ships without the .bil itself, so by default a synthetic file
+with the PRISM 800 m header is written to a temporary directory; pass --path to
+use a real one.
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from factor_scripts.R_factor import calculate_rainfall_erosivity, clip_bil_within_conus, clip_raster_within_conus
+
+prism_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tutorial_data",
+                         "PRISM_ppt_30yr_normal_800mM4_annual_bil")
+prism_name = "PRISM_ppt_30yr_normal_800mM4_annual_bil"
+
+
+def synthetic_prism(directory, seed=0):
+    """
+    Writes a .bil with the tutorial PRISM header and projection and gamma-distributed
+    precipitation, with nodata (-9999) over the ocean corners. Returns its path.
+    """
+    hdr = os.path.join(prism_dir, f"{prism_name}.hdr")
+    header = dict(line.split(None, 1) for line in open(hdr) if line.strip())
+    rows, cols = int(header['NROWS']), int(header['NCOLS'])
+    rng = np.random.default_rng(seed)
+    precip = rng.gamma(4.0, 200.0, size=(rows, cols)).astype('<f4')
+    precip[: rows // 4, : cols // 6] = -9999
+    precip[-rows // 4:, -cols // 6:] = -9999
+
+    path = os.path.join(directory, f"{prism_name}.bil")
+    precip.tofile(path)
+    shutil.copy(hdr, os.path.join(directory, f"{prism_name}.hdr"))
+    shutil.copy(os.path.join(prism_dir, f"{prism_name}.prj"), os.path.join(directory, f"{prism_name}.prj"))
+    return path
+
+
+def random_bboxes(n, size, seed=1):
+    """n lat/lon boxes of size degrees, inside CONUS."""
+    rng = np.random.default_rng(seed)
+    minx = rng.uniform(-124, -67 - size, n)
+    miny = rng.uniform(25, 48 - size, n)
+    return np.column_stack([minx, miny, minx + size, miny + size])
+
+
+def clip_latency(clip, path, bboxes, erosivity=False):
+    """Median latency of clipping each bbox (and computing R on it), in milliseconds."""
+    times = []
+    for bbox in bboxes:
+        start = time.perf_counter()
+        data, _, meta = clip(path, *bbox)
+        if erosivity:
+            calculate_rainfall_erosivity(data, nodata=meta['nodata'])
+        times.append(time.perf_counter() - start)
+    return 1000 * float(np.median(times))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--path", help="PRISM .bil to use instead of a synthetic one")
+    parser.add_argument("--clips", type=int, default=200, help="number of random bboxes")
+    parser.add_argument("--size", type=float, default=1.0, help="bbox edge in degrees")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.path or synthetic_prism(tmp)
+        bboxes = random_bboxes(args.clips, args.size)
+
+        for bbox in bboxes[:10]:
+            gdal, _, gdal_meta = clip_raster_within_conus(path, *bbox)
+            mapped, _, mapped_meta = clip_bil_within_conus(path, *bbox)
+            assert np.array_equal(gdal, mapped), "readers disagree on the clipped pixels"
+            assert gdal_meta['transform'].almost_equals(mapped_meta['transform']), "readers disagree on the transform"
+            assert gdal_meta['nodata'] == mapped_meta['nodata'], "readers disagree on nodata"
+
+        print(f"{args.clips} random {args.size} degree clips of {path}")
+        print(f"{'reader':24s} {'clip ms':>8s} {'clip + R ms':>12s}")
+        for name, clip in (('rasterio (GDAL)', clip_raster_within_conus), ('memory map', clip_bil_within_conus)):
+            t_clip = clip_latency(clip, path, bboxes)
+            t_r = clip_latency(clip, path, bboxes, erosivity=True)
+            print(f"{name:24s} {t_clip:8.3f} {t_r:12.3f}")
+
+
+if __name__ == "__main__":
+    main()
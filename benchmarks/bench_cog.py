@@ -0,0 +1,104 @@
+"""
+Benchmark of the COG factor outputs against the previous lzw outputs: file size and read latency.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_cog --size 8000
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+
+from raster_handling.cog import write_cog
+
+
+def synthetic_factor(size, seed=0):
+    """
+    Builds a size x size float32 grid that looks like a factor raster: a smooth
+    field with some noise, and a nodata (-9999) corner.
+    """
+    rng = np.random.default_rng(seed)
+    coarse = rng.gamma(4.0, 50.0, size=(size // 100 + 2, size // 100 + 2))
+    field = np.kron(coarse, np.ones((100, 100)))[:size, :size]
+    field = field + rng.normal(0, 2, size=(size, size))
+    field = field.astype(np.float32)
+    field[: size // 10, : size // 10] = -9999
+    return field
+
+
+def write_lzw(path, data, profile, tiled):
+    """The previous outputs: source profile plus lzw, stripped (c_factor) or 256-tiled (tiled writers)."""
+    profile = dict(profile, compress='lzw')
+    if tiled:
+        profile.update(tiled=True, blockxsize=256, blockysize=256)
+    with rasterio.open(path, 'w', **profile) as dest:
+        dest.write(data, 1)
+
+
+def random_window_latency(path, windows):
+    """Median latency of reading each window from a freshly opened file, in milliseconds."""
+    times = []
+    for window in windows:
+        start = time.perf_counter()
+        with rasterio.open(path) as src:
+            src.read(1, window=window)
+        times.append(time.perf_counter() - start)
+    return 1000 * float(np.median(times))
+
+
+def overview_latency(path, factor=16):
+    """Time to read the whole raster downsampled by factor, as a map render or preview would, in milliseconds."""
+    start = time.perf_counter()
+    with rasterio.open(path) as src:
+        src.read(1, out_shape=(src.height // factor, src.width // factor), resampling=Resampling.average)
+    return 1000 * (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size", type=int, default=8000, help="edge length of the square test grid")
+    parser.add_argument("--window", type=int, default=256, help="edge length of the random windows")
+    parser.add_argument("--reads", type=int, default=200, help="number of random windows")
+    args = parser.parse_args()
+
+    data = synthetic_factor(args.size)
+    profile = {
+        'driver': 'GTiff', 'dtype': 'float32', 'count': 1, 'height': args.size, 'width': args.size,
+        'crs': 'EPSG:5070', 'transform': from_origin(-2000000, 3000000, 30, 30), 'nodata': -9999.0
+    }
+    rng = np.random.default_rng(1)
+    offsets = rng.integers(0, args.size - args.window, size=(args.reads, 2))
+    windows = [Window(int(col), int(row), args.window, args.window) for row, col in offsets]
+
+    writers = {
+        'lzw, stripped (c_factor)': lambda path: write_lzw(path, data, profile, tiled=False),
+        'lzw, 256 tiles (tiled writers)': lambda path: write_lzw(path, data, profile, tiled=True),
+        'COG, deflate': lambda path: write_cog(path, data, profile, compress='deflate'),
+        'COG, zstd': lambda path: write_cog(path, data, profile, compress='zstd'),
+    }
+
+    print(f"grid: {args.size} x {args.size} float32, {args.reads} random {args.window}px windows")
+    print(f"{'output':32s} {'write s':>8s} {'size MiB':>9s} {'window ms':>10s} {'1/16 ms':>9s}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for i, (name, write) in enumerate(writers.items()):
+            path = os.path.join(tmp, f"factor_{i}.tif")
+            start = time.perf_counter()
+            write(path)
+            t_write = time.perf_counter() - start
+            with rasterio.open(path) as src:
+                assert np.array_equal(src.read(1), data), f"{name} does not round-trip"
+            size = os.path.getsize(path) / 2**20
+            t_window = random_window_latency(path, windows)
+            t_overview = overview_latency(path)
+            print(f"{name:32s} {t_write:8.2f} {size:9.1f} {t_window:10.2f} {t_overview:9.1f}")
+
+
+if __name__ == "__main__":
+    main()
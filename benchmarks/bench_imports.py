@@ -0,0 +1,107 @@
+"""
+Benchmark of import time and worker cold start, and a check that importing does no I/O.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_imports --repeat 5
+
+Every module is imported in a fresh interpreter started in an empty directory;
+the heavy dependencies it loads and any files it creates are reported. Worker
+start-up is the time from creating a one-process pool (with the spawn start
+method, as on Windows and macOS) to the first finished job.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from statistics import median
+
+# Only the standard library is imported above: spawned workers re-import this module too
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+modules = (
+    'raster_handling',
+    'factor_scripts',
+    'raster_handling.profiling',
+    'raster_handling.rasterhandler',
+    'raster_handling.tiles',
+    'raster_handling.zonal',
+    'factor_scripts.R_factor',
+    'factor_scripts.C_Factor',
+    'factor_scripts.K_factor',
+    'factor_scripts.LS_factor',
+    'factor_scripts.rusle_composer',
+    'soil_erosion_alg_automated.jobs',
+    'soil_erosion_alg_automated.gui_map_start',
+)
+
+# Dependencies worth knowing about when they load
+heavy = ('rasterio', 'geopandas', 'shapely', 'pyproj', 'folium', 'openeo', 'PIL', 'matplotlib', 'flask')
+
+probe = """
+import json, os, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{'seconds': elapsed, 'loaded': [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def import_once(module, cwd):
+    """Imports module in a fresh interpreter; returns (seconds, heavy modules loaded)."""
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [repo_root, os.environ.get('PYTHONPATH')])))
+    result = subprocess.run([sys.executable, '-c', probe.format(module=module, heavy=heavy)],
+                            cwd=cwd, env=env, capture_output=True, text=True, timeout=120)
+    if result.returncode:
+        raise RuntimeError(f"importing {module} failed:\n{result.stderr}")
+    report = json.loads(result.stdout.strip().splitlines()[-1])
+    return report['seconds'], report['loaded']
+
+
+def noop_job():
+    """Smallest job the upload queue could run, from the module the workers import."""
+    from soil_erosion_alg_automated.jobs import leaflet_bounds
+    return leaflet_bounds((0, 0, 1, 1))
+
+
+def worker_startup(method):
+    """Seconds from creating a one-worker pool to the first finished job."""
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context(method)) as pool:
+        pool.submit(noop_job).result()
+        elapsed = time.perf_counter() - start
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5, help="fresh interpreters per module")
+    parser.add_argument("--budget", type=float, default=0.2, help="worker start-up budget in seconds")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as cwd:
+        baseline = median([import_once('os', cwd)[0] for _ in range(args.repeat)])
+        print(f"{'module':44s} {'import ms':>10s}  heavy dependencies loaded")
+        for module in modules:
+            times, loaded = [], []
+            for _ in range(args.repeat):
+                seconds, loaded = import_once(module, cwd)
+                times.append(seconds)
+            print(f"{module:44s} {1000 * (median(times) - baseline):10.1f}  {', '.join(loaded) or '-'}")
+        created = os.listdir(cwd)
+        print(f"files created by importing: {', '.join(created) or 'none'}")
+
+    print()
+    for method in multiprocessing.get_all_start_methods():
+        seconds = median(worker_startup(method) for _ in range(args.repeat))
+        verdict = 'ok' if seconds <= args.budget else f'over the {1000 * args.budget:.0f} ms budget'
+        print(f"worker start-up ({method + '):':12s} {1000 * seconds:7.1f} ms  {verdict}")
+
+
+if __name__ == "__main__":
+    main()
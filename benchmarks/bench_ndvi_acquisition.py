@@ -0,0 +1,87 @@
+"""
+Benchmark of acquire_ndvi against a local mock openEO backend, at several concurrency limits.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_ndvi_acquisition --latency 0.5
+"""
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+import numpy as np
+import rasterio
+from rasterio.transform import from_bounds
+
+from factor_scripts.ndvi_acquisition import acquire_ndvi, split_bbox
+
+
+class MockBackend:
+    """
+    Stands in for fetch_NDVI_TERRASCOPE: sleeps for `latency` seconds, then writes a
+    tile whose NDVI is a smooth function of longitude and latitude. Every
+    `fail_every`-th request fails, to exercise the retries.
+    """
+
+    def __init__(self, latency, resolution=0.01, fail_every=0):
+        self.latency = latency
+        self.resolution = resolution
+        self.fail_every = fail_every
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, bbox, datetime, output_path):
+        with self._lock:
+            self.requests += 1
+            fail = self.fail_every and self.requests % self.fail_every == 0
+        time.sleep(self.latency)
+        if fail:
+            raise ConnectionError("mock backend timeout")
+
+        width = round((bbox['east'] - bbox['west']) / self.resolution)
+        height = round((bbox['north'] - bbox['south']) / self.resolution)
+        lon = np.linspace(bbox['west'], bbox['east'], width, dtype=np.float32)
+        lat = np.linspace(bbox['north'], bbox['south'], height, dtype=np.float32)
+        ndvi = np.sin(np.radians(lon))[None, :] * np.cos(np.radians(lat))[:, None]
+        with rasterio.open(output_path, 'w', driver='GTiff', dtype='float32', count=1, height=height,
+                           width=width, crs='EPSG:4326', nodata=np.nan,
+                           transform=from_bounds(bbox['west'], bbox['south'], bbox['east'], bbox['north'],
+                                                 width, height)) as dest:
+            dest.write(ndvi, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--latency", type=float, default=0.5, help="seconds per mock request")
+    parser.add_argument("--tiles", type=int, default=4, help="tiles along each side of the extent")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    bbox = {'west': 0.0, 'south': 40.0, 'east': float(args.tiles), 'north': 40.0 + args.tiles}
+    dates = ["2022-05-01", "2022-05-30"]
+    n_tiles = len(split_bbox(bbox, 1.0))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        baseline = None
+        for concurrency in args.concurrency:
+            backend = MockBackend(args.latency, fail_every=7)
+            output_path = os.path.join(tmp, f"ndvi_{concurrency}.tif")
+            start = time.perf_counter()
+            acquire_ndvi(bbox, dates, output_path, tile_degrees=1.0, concurrency=concurrency,
+                         backoff=0.05, fetch=backend, tile_dir=os.path.join(tmp, f"tiles_{concurrency}"))
+            elapsed = time.perf_counter() - start
+
+            with rasterio.open(output_path) as src:
+                mosaic = src.read(1)
+            assert not np.isnan(mosaic).any(), "mosaic has gaps"
+            if baseline is None:
+                baseline = (elapsed, mosaic)
+            assert np.array_equal(mosaic, baseline[1]), "mosaic depends on concurrency"
+            print(f"concurrency {concurrency:3d}: {elapsed:7.2f} s for {n_tiles} tiles "
+                  f"({backend.requests} requests, {baseline[0] / elapsed:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+Benchmark of quantized factor storage: file size, round-trip error and composer read time.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_quantize --size 4000
+
+R is computed from a synthetic PRISM-like clip and C from a synthetic NDVI grid,
+each stored as float32, uint16 and uint8. Every quantized output is decoded and
+checked against the float32 one: the error must stay within half a quantization
+step, and nodata must stay nodata. The soil loss from quantized R and C is
+compared with the one from float32 factors.
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+
+from factor_scripts.C_Factor import c_factor
+from factor_scripts.R_factor import write_rainfall_erosivity_tiled
+from factor_scripts.rusle_composer import compose_soil_loss
+from raster_handling.cog import write_cog
+from raster_handling.rasterhandler import read_float32
+
+# Synthetic inputs are on a lat/lon grid starting over South Dakota; up to 4000 pixels stay inside CONUS
+origin = (-100.0, 45.0)
+resolution = 0.004
+
+
+def synthetic_inputs(directory, size, seed=0):
+    """Writes a precipitation grid (mm, nodata -9999) and an NDVI grid (NaN holes); returns their paths."""
+    rng = np.random.default_rng(seed)
+    coarse = rng.gamma(6.0, 180.0, size=(size // 50 + 2, size // 50 + 2))
+    precip = np.kron(coarse, np.ones((50, 50)))[:size, :size] + rng.normal(0, 5, (size, size))
+    precip = np.maximum(precip, 1).astype(np.float32)
+    precip[: size // 10, : size // 10] = -9999
+    ndvi = np.clip(rng.normal(0.45, 0.2, (size, size)), -0.2, 0.95).astype(np.float32)
+    ndvi[-size // 10:, -size // 10:] = np.nan
+
+    profile = {'driver': 'GTiff', 'count': 1, 'height': size, 'width': size, 'crs': 'EPSG:4326',
+               'transform': from_origin(*origin, resolution, resolution)}
+    precip_path = os.path.join(directory, 'precip.tif')
+    ndvi_path = os.path.join(directory, 'ndvi.tif')
+    write_cog(precip_path, precip, dict(profile, dtype='float32', nodata=-9999.0))
+    write_cog(ndvi_path, ndvi, dict(profile, dtype='float32', nodata=None))
+    return precip_path, ndvi_path
+
+
+def decoded(path):
+    """The whole first band as float32, nodata as NaN, plus the quantization step (0 for float)."""
+    with rasterio.open(path) as src:
+        return read_float32(src), src.scales[0] if src.dtypes[0] != 'float32' else 0.0
+
+
+def check_round_trip(name, reference, path):
+    """Asserts that a quantized output decodes to the float32 one within half a step; returns a report line."""
+    values, step = decoded(path)
+    assert np.array_equal(np.isnan(values), np.isnan(reference)), f"{name}: nodata moved"
+    valid = ~np.isnan(reference)
+    error = np.abs(values[valid].astype(np.float64) - reference[valid])
+    # Half a step, plus float32 rounding of the decoded value
+    tolerance = step / 2 + 4 * np.finfo(np.float32).eps * np.abs(reference[valid]).max()
+    assert error.max() <= tolerance, f"{name}: error {error.max()} above {tolerance}"
+    size = os.path.getsize(path) / 2**20
+    return f"{name:14s} {size:9.2f} {error.max():12.5g} {error.mean():12.5g} {step:12.5g}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size", type=int, default=4000, help="edge length of the square test grids")
+    args = parser.parse_args()
+
+    bbox = (origin[0], origin[1] - args.size * resolution, origin[0] + args.size * resolution, origin[1])
+    with tempfile.TemporaryDirectory() as tmp:
+        precip_path, ndvi_path = synthetic_inputs(tmp, args.size)
+        outputs = {}
+        for dtype in (None, 'uint16', 'uint8'):
+            suffix = dtype or 'float32'
+            outputs['R', suffix] = os.path.join(tmp, f"R_{suffix}.tif")
+            outputs['C', suffix] = os.path.join(tmp, f"C_{suffix}.tif")
+            write_rainfall_erosivity_tiled(precip_path, outputs['R', suffix], *bbox, quantize=dtype)
+            c_factor(ndvi_path, outputs['C', suffix], windowed=True, quantize=dtype)
+
+        print()
+        print(f"{'output':14s} {'size MiB':>9s} {'max error':>12s} {'mean error':>12s} {'step':>12s}")
+        for factor in ('R', 'C'):
+            reference, _ = decoded(outputs[factor, 'float32'])
+            for suffix in ('float32', 'uint16', 'uint8'):
+                print(check_round_trip(f"{factor} {suffix}", reference, outputs[factor, suffix]))
+
+        print()
+        # Errors relative to the largest soil loss: per pixel they blow up wherever C is close to 0
+        print(f"{'soil loss from':14s} {'compose s':>9s} {'max error / max A':>18s} {'mean':>10s}")
+        reference = None
+        for suffix in ('float32', 'uint16', 'uint8'):
+            path = os.path.join(tmp, f"A_{suffix}.tif")
+            start = time.perf_counter()
+            compose_soil_loss(path, R=outputs['R', suffix], C=outputs['C', suffix], workers=1)
+            elapsed = time.perf_counter() - start
+            with rasterio.open(path) as src:
+                soil_loss = src.read(1, masked=True)
+            if reference is None:
+                reference = soil_loss
+            assert np.array_equal(soil_loss.mask, reference.mask), f"soil loss from {suffix}: nodata moved"
+            valid = ~reference.mask
+            error = np.abs(soil_loss.data[valid].astype(np.float64) - reference.data[valid]) / reference.max()
+            print(f"{suffix:14s} {elapsed:9.2f} {error.max():18.4g} {error.mean():10.4g}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,367 @@
+"""
+Benchmark suite for the raster hot paths, with a JSON baseline to catch regressions.
+
+Run from the repository root:
+
+    python -m benchmarks.suite --sizes 1000 4000 --save baseline.json
+    # ... change something ...
+    python -m benchmarks.suite --sizes 1000 4000 --compare baseline.json
+
+Synthetic rasters (smooth fields with nodata holes, in EPSG:4326, EPSG:5070 and
+UTM 15N) are generated block by block, so sizes up to 20000 x 20000 work without
+holding a raster in memory, and are kept in --data-dir for later runs. Every
+case runs in a fresh interpreter, in an empty working directory, and reports
+its wall time (median of --repeat runs) and peak resident memory (the largest).
+With --compare, cases slower or hungrier than the baseline by more than
+--threshold are flagged and the exit status is 1.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from statistics import median
+
+import numpy as np
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Extent of the synthetic rasters per CRS, (left, top, edge length); pixels are square
+extents = {
+    'EPSG:4326': (-110.0, 48.0, 30.0),
+    'EPSG:5070': (-1500000.0, 3500000.0, 3000000.0),
+    'EPSG:32615': (200000.0, 4100000.0, 600000.0),
+}
+
+# Bounding box clipped by the clip case, inside CONUS and the EPSG:4326 extent
+clip_bbox = (-100.0, 30.0, -90.0, 40.0)
+
+nodata = -9999.0
+
+
+def raster_path(data_dir, kind, size, crs):
+    return os.path.join(data_dir, f"{kind}_{size}_{crs.replace(':', '')}.tif")
+
+
+def synthetic_block(kind, size, row, col, height, width, seed=0):
+    """
+    One block of a synthetic raster, the same whichever way the raster is cut.
+
+    A coarse random field (one value per 100 x 100 pixels) is interpolated
+    bilinearly and some noise added; circular nodata holes are cut from it.
+    kind is 'precip' (mm, nodata -9999) or 'ndvi' (NaN holes).
+    """
+    cells = size // 100 + 2
+    coarse = np.random.default_rng(seed).gamma(4.0, 1.0, size=(cells, cells))
+    y = (np.arange(row, row + height) + 0.5) / 100
+    x = (np.arange(col, col + width) + 0.5) / 100
+    y0, x0 = y.astype(int), x.astype(int)
+    fy, fx = (y - y0)[:, None], (x - x0)[None, :]
+    field = (coarse[np.ix_(y0, x0)] * (1 - fy) * (1 - fx) + coarse[np.ix_(y0, x0 + 1)] * (1 - fy) * fx +
+             coarse[np.ix_(y0 + 1, x0)] * fy * (1 - fx) + coarse[np.ix_(y0 + 1, x0 + 1)] * fy * fx)
+    noise = np.random.default_rng([seed, row, col]).normal(0, 0.05, size=(height, width))
+    field = (field + noise).astype(np.float32)
+
+    if kind == 'precip':
+        values, fill = np.maximum(field * 250, 1), nodata
+    else:
+        values, fill = np.clip(field / 8, -0.2, 0.95), np.nan
+
+    # Holes: about one per million pixels, radius 1% of the raster
+    holes = np.random.default_rng([seed, 1]).random((max(1, size * size // 10**6), 2)) * size
+    radius = size / 100
+    rows, cols = np.ogrid[row:row + height, col:col + width]
+    for hole_row, hole_col in holes:
+        if abs(hole_row - (row + height / 2)) < height / 2 + radius and abs(hole_col - (col + width / 2)) < width / 2 + radius:
+            values[(rows - hole_row) ** 2 + (cols - hole_col) ** 2 < radius ** 2] = fill
+    return values.astype(np.float32, copy=False)
+
+
+def make_raster(data_dir, kind, size, crs):
+    """Writes a synthetic size x size raster block by block unless it exists; returns its path."""
+    import rasterio
+    from rasterio.transform import from_origin
+    from rasterio.windows import Window
+
+    from raster_handling.cog import cog_profile
+
+    path = raster_path(data_dir, kind, size, crs)
+    if os.path.exists(path):
+        return path
+    left, top, edge = extents[crs]
+    profile = cog_profile({
+        'dtype': 'float32', 'count': 1, 'height': size, 'width': size, 'crs': crs,
+        'transform': from_origin(left, top, edge / size, edge / size),
+        'nodata': nodata if kind == 'precip' else None
+    })
+    tmp_path = f"{path}.{os.getpid()}.tmp.tif"
+    block = 2048
+    with rasterio.open(tmp_path, 'w', **profile) as dest:
+        for row in range(0, size, block):
+            for col in range(0, size, block):
+                height, width = min(block, size - row), min(block, size - col)
+                dest.write(synthetic_block(kind, size, row, col, height, width), 1,
+                           window=Window(col, row, width, height))
+    os.replace(tmp_path, path)
+    return path
+
+
+def case_erosivity(data_dir, size, crs):
+    import rasterio
+
+    from factor_scripts.R_factor import calculate_rainfall_erosivity
+
+    # Read from the cached raster: generating it here would put synthetic_block's
+    # float64 temporaries in the measured peak memory
+    with rasterio.open(raster_path(data_dir, 'precip', size, 'EPSG:4326')) as src:
+        precip = src.read(1)
+    start = time.perf_counter()
+    calculate_rainfall_erosivity(precip, nodata=nodata)
+    return time.perf_counter() - start
+
+
+def case_clip(data_dir, size, crs):
+    from factor_scripts.R_factor import clip_raster_within_conus
+
+    path = raster_path(data_dir, 'precip', size, 'EPSG:4326')
+    start = time.perf_counter()
+    clip_raster_within_conus(path, *clip_bbox)
+    return time.perf_counter() - start
+
+
+def case_c_factor(data_dir, size, crs):
+    from factor_scripts.C_Factor import c_factor
+
+    path = raster_path(data_dir, 'ndvi', size, crs)
+    start = time.perf_counter()
+    c_factor(path, 'cover_factor.tif', windowed=True)
+    return time.perf_counter() - start
+
+
+def case_reproject(data_dir, size, crs):
+    import rasterio
+
+    from raster_handling.rasterhandler import reproject_raster_obj
+
+    with rasterio.open(raster_path(data_dir, 'precip', size, crs)) as src:
+        start = time.perf_counter()
+        reproject_raster_obj(src, 'EPSG:4269').close()
+        return time.perf_counter() - start
+
+
+def case_resample(data_dir, size, crs):
+    import rasterio
+    from rasterio.warp import calculate_default_transform
+
+    from raster_handling.rasterhandler import resample_raster_obj
+
+    with rasterio.open(raster_path(data_dir, 'precip', size, crs)) as src:
+        # Reference: the same area in EPSG:4326, at half the resolution; only its grid is used
+        transform, width, height = calculate_default_transform(
+            src.crs, 'EPSG:4326', src.width // 2, src.height // 2, *src.bounds)
+        with rasterio.open('reference.tif', 'w', driver='GTiff', dtype='uint8', count=1, width=width,
+                           height=height, crs='EPSG:4326', transform=transform, tiled=True,
+                           sparse_ok=True) as reference:
+            pass
+        with rasterio.open('reference.tif') as reference:
+            start = time.perf_counter()
+            resample_raster_obj(src, reference).close()
+            return time.perf_counter() - start
+
+
+def case_upload_raster(data_dir, size, crs):
+    """POST the raster to /upload_raster and wait for its processing job (overviews, summed-area table)."""
+    from soil_erosion_alg_automated.gui_map_start import app, job_queue
+
+    path = raster_path(data_dir, 'precip', size, crs)
+    client = app.test_client()
+    start = time.perf_counter()
+    with open(path, 'rb') as f:
+        response = client.post('/upload_raster', data={'file': (f, os.path.basename(path))},
+                               content_type='multipart/form-data')
+    if response.status_code != 202:
+        raise RuntimeError(f"upload failed: {response.status_code} {response.get_data(as_text=True)}")
+    status_url = response.get_json()['status_url']
+    while True:
+        status = client.get(status_url).get_json()
+        if status['state'] == 'failed':
+            raise RuntimeError(f"upload job failed: {status['error']}")
+        if status['state'] == 'done':
+            break
+        time.sleep(0.005)
+    elapsed = time.perf_counter() - start
+    job_queue.shutdown()
+    return elapsed
+
+
+# Case name -> (function, rasters it needs as (kind, crs); None for the CRS under test)
+cases = {
+    'erosivity': (case_erosivity, [('precip', 'EPSG:4326')]),
+    'clip': (case_clip, [('precip', 'EPSG:4326')]),
+    'c_factor': (case_c_factor, [('ndvi', None)]),
+    'reproject': (case_reproject, [('precip', None)]),
+    'resample': (case_resample, [('precip', None)]),
+    'upload_raster': (case_upload_raster, [('precip', None)]),
+}
+
+# Cases whose result doesn't depend on the CRS run only once per size
+crs_independent = {'erosivity', 'clip'}
+
+
+def peak_rss_mb():
+    """
+    Peak resident memory in MiB of this process or its largest worker process,
+    whichever is larger, or None where it can't be measured.
+    """
+    try:
+        import resource
+    except ImportError:
+        try:
+            import psutil
+        except ImportError:
+            return None
+        return psutil.Process().memory_info().peak_wset / 2**20
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    if sys.platform == 'darwin':
+        # Bytes on macOS
+        return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, children) / 2**20
+    # On Linux ru_maxrss carries over the high-water mark of the process that
+    # started this one; VmHWM is this interpreter's own
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    try:
+        with open('/proc/self/status') as f:
+            peak = next(int(line.split()[1]) for line in f if line.startswith('VmHWM:'))
+    except (OSError, StopIteration):
+        pass
+    return max(peak, children) / 2**10
+
+
+def run_child(name, data_dir, size, crs):
+    """Runs one case in this process and prints its result as JSON."""
+    seconds = cases[name][0](data_dir, size, crs)
+    print(json.dumps({'seconds': seconds, 'peak_rss_mb': peak_rss_mb()}))
+
+
+def run_case(name, data_dir, size, crs):
+    """Runs one case in a fresh interpreter and working directory; returns its result dict."""
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [repo_root, os.environ.get('PYTHONPATH')])))
+    with tempfile.TemporaryDirectory() as cwd:
+        result = subprocess.run([sys.executable, '-m', 'benchmarks.suite', '--child', name, str(size), crs,
+                                 os.path.abspath(data_dir)], cwd=cwd, env=env, capture_output=True, text=True)
+    if result.returncode:
+        raise RuntimeError(f"{name} failed:\n{result.stderr}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def environment():
+    import rasterio
+
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'numpy': np.__version__,
+        'rasterio': rasterio.__version__,
+        'gdal': rasterio.__gdal_version__,
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+    }
+
+
+def compare(results, baseline, threshold):
+    """
+    Compares results with a baseline.
+
+    Returns:
+    - list of (key, seconds ratio, memory ratio, flags) for the keys in both
+    """
+    rows = []
+    for key, result in results.items():
+        base = baseline.get(key)
+        if base is None:
+            continue
+        time_ratio = result['seconds'] / base['seconds'] if base['seconds'] else None
+        memory_ratio = None
+        if result.get('peak_rss_mb') and base.get('peak_rss_mb'):
+            memory_ratio = result['peak_rss_mb'] / base['peak_rss_mb']
+        flags = []
+        if time_ratio is not None and time_ratio > 1 + threshold:
+            flags.append('SLOWER')
+        if memory_ratio is not None and memory_ratio > 1 + threshold:
+            flags.append('MORE MEMORY')
+        rows.append((key, time_ratio, memory_ratio, flags))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--child", nargs=4, metavar=('CASE', 'SIZE', 'CRS', 'DATA_DIR'), help=argparse.SUPPRESS)
+    parser.add_argument("--cases", nargs='+', choices=sorted(cases), default=sorted(cases))
+    parser.add_argument("--sizes", nargs='+', type=int, default=[1000, 4000],
+                        help="raster edge lengths in pixels (1000 to 20000)")
+    parser.add_argument("--crs", nargs='+', choices=sorted(extents), default=['EPSG:5070', 'EPSG:32615'],
+                        help="CRSs of the rasters for the CRS-dependent cases")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per case; the median time is kept")
+    parser.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "soil_erosion", "bench_data"))
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="baseline JSON file to compare with")
+    parser.add_argument("--threshold", type=float, default=0.15,
+                        help="relative slowdown or memory growth flagged as a regression")
+    args = parser.parse_args()
+
+    if args.child:
+        name, size, crs, data_dir = args.child
+        run_child(name, data_dir, int(size), crs)
+        return 0
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+
+    results = {}
+    print(f"{'case':40s} {'seconds':>9s} {'peak MiB':>9s}" + ("   vs baseline" if baseline else ""))
+    for size in args.sizes:
+        for name in args.cases:
+            func, rasters = cases[name]
+            for crs in (['EPSG:4326'] if name in crs_independent else args.crs):
+                for kind, raster_crs in rasters:
+                    make_raster(args.data_dir, kind, size, raster_crs or crs)
+                runs = [run_case(name, args.data_dir, size, crs) for _ in range(args.repeat)]
+                key = f"{name}[{size}]" if name in crs_independent else f"{name}[{size},{crs}]"
+                memory = [run['peak_rss_mb'] for run in runs if run['peak_rss_mb'] is not None]
+                results[key] = {'seconds': median(run['seconds'] for run in runs),
+                                'peak_rss_mb': max(memory) if memory else None}
+
+                line = f"{key:40s} {results[key]['seconds']:9.3f} {results[key]['peak_rss_mb'] or float('nan'):9.1f}"
+                if baseline:
+                    rows = compare({key: results[key]}, baseline, args.threshold)
+                    if rows:
+                        _, time_ratio, memory_ratio, flags = rows[0]
+                        line += f"   time x{time_ratio:.2f}" if time_ratio is not None else "   time -"
+                        line += f", memory x{memory_ratio:.2f}" if memory_ratio is not None else ""
+                        line += f"  {' '.join(flags)}" if flags else ""
+                    else:
+                        line += "   (not in baseline)"
+                print(line, flush=True)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'environment': environment(), 'threshold': args.threshold, 'results': results}, f, indent=2)
+        print(f"Results saved to {args.save}")
+
+    if baseline:
+        regressions = [row for row in compare(results, baseline, args.threshold) if row[3]]
+        if regressions:
+            print(f"{len(regressions)} regression(s) above {args.threshold:.0%}: "
+                  f"{', '.join(key for key, *_ in regressions)}")
+            return 1
+        print(f"No regression above {args.threshold:.0%}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
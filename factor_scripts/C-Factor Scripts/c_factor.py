@@ -1,15 +1,19 @@
-def fetch_SENTINEL(bbox, datetime):
+from factor_scripts.C_Factor import c_factor, delete_file
+from factor_scripts.openeo_cache import get_connection
+
+
+def fetch_SENTINEL(bbox, datetime, connection=None):
     """Fetches Sentinel-2 satellite data as a datacube using the openEO API.
 
     Parameters:
     bbox (dict): A dictionary specifying the bounding box with keys 'west', 'south', 'east', 'north'.
     datetime (list): A list containing the start and end date strings.
+    connection (openeo.Connection): Connection to use; defaults to the shared per-process connection.
 
     Returns:
     openeo.ImageCollection: An image collection of Sentinel-2 data.
     """
-    connection = openeo.connect("openeofed.dataspace.copernicus.eu")
-    connection.authenticate_oidc()
+    connection = connection or get_connection()
     sentinelCube = connection.load_collection(
         "SENTINEL2_L2A",
         spatial_extent=bbox,
@@ -43,45 +47,6 @@ def ndvi_generation(datacube, output_path):
     ndvi_composite.download(output_path)
     print(f"NDVI data saved to {output_path}")
 
-def c_factor(tiff_path, output_path):
-    """
-    Calculates the cover factor (C-Factor) from an NDVI TIFF and saves it as a new TIFF.
-
-    Parameters:
-    tiff_path (str): The path to the NDVI TIFF file.
-    output_path (str): The path where the C-Factor TIFF file will be saved.
-
-    See Van der Knijff, J.M., Jones, R.J.A. and Montanarella, L. (2000) 
-    Soil Erosion Risk Assessment in Europe. 
-    EUR 19044 EN, Office for Official Publications of the European Communities, Luxembourg, 34.
-    
-    For more information on the specifications of the C-factor.
-
-
-    """
-    # Open the NDVI TIFF file
-    with rasterio.open(tiff_path) as src:
-        ndvi = src.read(1)  # Read the first band
-
-        # Normalize NDVI to scale from 0 to 1
-        ndvi_min, ndvi_max = ndvi.min(), ndvi.max()
-        normalized_ndvi = (ndvi - ndvi_min) / (ndvi_max - ndvi_min)
-
-        # Invert the normalized NDVI to get the Cover Factor
-        cover_factor = 1 - normalized_ndvi
-
-        # Define new metadata for the output file
-        out_meta = src.meta.copy()
-        out_meta.update({
-            "dtype": 'float32',
-            "compress": "lzw"
-        })
-
-        # Save the Cover Factor as a new TIFF file
-        with rasterio.open(output_path, 'w', **out_meta) as dest:
-            dest.write(cover_factor, 1)  # Write the Cover Factor to the first band
-    print(f"C_Factor saved to {output_path}")
-
 def c_factor_and_cleanup(ndvi_path, c_factor_path):
     # Generate the C_Factor
     c_factor(ndvi_path, c_factor_path)
@@ -1,7 +1,14 @@
 import os
-import openeo
 import rasterio
 from rasterio.enums import Resampling
+import numpy as np
+
+from factor_scripts.openeo_cache import cache_key, download_cache, get_connection
+from raster_handling import profiling
+from raster_handling.cog import open_cog
+from raster_handling.manifest import TileManifest, output_tiles
+from raster_handling.quantize import quantizer, set_scaling
+from raster_handling.rasterhandler import block_windows
 
 # First, set up file storage
 def ensure_dir(directory):
@@ -36,25 +43,21 @@ storage_base = "C:/RUSLE_Application/File_Storage"
 ndvi_dir = os.path.join(storage_base, "NDVI")
 c_factor_dir = os.path.join(storage_base, "C_Factor")
 
-# Ensure directories exist
-ensure_dir(ndvi_dir)
-ensure_dir(c_factor_dir)
-
 
 
 # establish connection to EO
-def fetch_SENTINEL(bbox, datetime):
+def fetch_SENTINEL(bbox, datetime, connection=None):
     """Fetches Sentinel-2 satellite data as a datacube using the openEO API.
 
     Parameters:
     bbox (dict): A dictionary specifying the bounding box with keys 'west', 'south', 'east', 'north'.
     datetime (list): A list containing the start and end date strings.
+    connection (openeo.Connection): Connection to use; defaults to the shared per-process connection.
 
     Returns:
     openeo.ImageCollection: An image collection of Sentinel-2 data.
     """
-    connection = openeo.connect("openeofed.dataspace.copernicus.eu")
-    connection.authenticate_oidc()
+    connection = connection or get_connection()
     sentinelCube = connection.load_collection(
         "SENTINEL2_L2A",
         spatial_extent=bbox,
@@ -95,42 +98,139 @@ dates = ["2022-07-01", "2022-07-30"]
  #   ndvi_composite.download(output_path)
 #    print(f"NDVI data saved to {output_path}")
 
-def fetch_NDVI_TERRASCOPE(bbox, datetime, output_path):
+# Names the processing fetch_NDVI_TERRASCOPE applies in its cache keys; change it with the processing
+ndvi_composite_graph = "apply(0.004 * x - 0.08) | max_time"
+
+def fetch_NDVI_TERRASCOPE(bbox, datetime, output_path, cache=download_cache, connection=None):
     """
     Fetches and processes NDVI data from the TERRASCOPE_S2_NDVI_V2 collection using the openEO API.
 
     This function connects to the Copernicus openEO backend, loads NDVI data for the given spatial and temporal
     extent, rescales the raw values, and computes the temporal maximum composite.
 
+    Downloads are cached on disk, keyed by collection, bands, bbox, dates and processing. The key
+    is built from the request alone and looked up before connecting, so asking for the same
+    composite again is served from the cache without network access or credentials.
+
     Parameters:
     bbox (dict): A dictionary specifying the bounding box with keys 'west', 'south', 'east', 'north'.
     datetime (list): A list containing the start and end date strings (e.g., ["2022-05-01", "2022-05-30"]).
+    output_path (str): The file path where the NDVI GeoTIFF will be saved.
+    cache (DownloadCache): Download cache to use, or None to always download.
+    connection (openeo.Connection): Connection to use; defaults to the shared per-process connection.
 
     Returns:
-    openeo.ImageCollection: A datacube of the maximum NDVI composite over time.
+    openeo.ImageCollection: A datacube of the maximum NDVI composite over time, or None if
+    it was served from the cache.
     """
-    connection = openeo.connect("openeofed.dataspace.copernicus.eu")
-    connection.authenticate_oidc()
+    collection, bands = "TERRASCOPE_S2_NDVI_V2", ["NDVI_10M"]
+    cubes = []
+
+    def download(path):
+        cube = (connection or get_connection()).load_collection(
+            collection,
+            spatial_extent=bbox,
+            temporal_extent=datetime,
+            bands=bands,
+        )
+        cube = cube.apply(lambda x: 0.004 * x - 0.08).max_time()
+        cube.download(path)
+        cubes.append(cube)
+
+    if cache is None:
+        download(output_path)
+    else:
+        key = cache_key(collection, bands, bbox, datetime, ndvi_composite_graph)
+        if cache.fetch(key, download, output_path):
+            print(f"NDVI data for {bbox} served from cache")
+    print(f"NDVI data saved to {output_path}")
+    return cubes[0] if cubes else None
 
-    cube = connection.load_collection(
-        "TERRASCOPE_S2_NDVI_V2",
-        spatial_extent=bbox,
-        temporal_extent=datetime,
-        bands=["NDVI_10M"],
-    )
+def ndvi_range(src, clamp=False, tile_size=512):
+    """
+    First pass of the windowed C-Factor: block-wise min/max of the NDVI band.
 
-    cube = cube.apply(lambda x: 0.004 * x - 0.08).max_time()
+    Parameters:
+    src (rasterio DatasetReader): The open NDVI raster.
+    clamp (bool): Clamp NDVI to the physical range [-1, 1] before reducing.
+    tile_size (int): Approximate tile edge in pixels.
 
-    cube.download(output_path)
-    print(f"NDVI data saved to {output_path}")
+    Returns:
+    tuple: (ndvi_min, ndvi_max) over valid pixels, ignoring nodata and NaN.
 
-def c_factor(tiff_path, output_path):
+    Raises:
+    ValueError: If the raster has no valid NDVI pixel.
+    """
+    ndvi_min, ndvi_max = None, None
+    for window in block_windows(src, tile_size=tile_size):
+        ndvi = src.read(1, window=window)
+        valid = valid_ndvi(ndvi, src.nodata)
+        if not valid.any():
+            continue
+        values = ndvi[valid]
+        if clamp:
+            np.clip(values, -1, 1, out=values)
+        tile_min, tile_max = values.min(), values.max()
+        ndvi_min = tile_min if ndvi_min is None else min(ndvi_min, tile_min)
+        ndvi_max = tile_max if ndvi_max is None else max(ndvi_max, tile_max)
+    if ndvi_min is None:
+        raise ValueError("no valid NDVI pixels")
+    return ndvi_min, ndvi_max
+
+def valid_ndvi(ndvi, nodata):
+    """Returns a mask of the NDVI pixels that are neither NaN nor nodata."""
+    valid = ~np.isnan(ndvi)
+    if nodata is not None:
+        valid &= ndvi != nodata
+    return valid
+
+@profiling.profiled('c_factor.math')
+def cover_factor_from_ndvi(ndvi, ndvi_min, ndvi_max, nodata, clamp=False):
+    """
+    Converts NDVI values into Cover Factor values, in place for floating-point input.
+
+    Parameters:
+    ndvi (ndarray): NDVI values; overwritten with the Cover Factor.
+    ndvi_min, ndvi_max: The NDVI range used for normalization.
+    nodata: Nodata value of the raster, kept as is in the output.
+    clamp (bool): Clamp NDVI to [-1, 1] first.
+
+    Returns:
+    ndarray: The Cover Factor (the same array as ndvi).
+    """
+    valid = valid_ndvi(ndvi, nodata)
+    if ndvi.dtype.kind != 'f':
+        ndvi = ndvi.astype(np.float64)
+    if clamp:
+        np.clip(ndvi, -1, 1, out=ndvi, where=valid)
+
+    # Normalize NDVI to scale from 0 to 1
+    normalized_ndvi = np.subtract(ndvi, ndvi_min, out=ndvi, where=valid)
+    np.divide(normalized_ndvi, ndvi_max - ndvi_min, out=normalized_ndvi, where=valid)
+
+    # Invert the normalized NDVI to get the Cover Factor
+    return np.subtract(1, normalized_ndvi, out=normalized_ndvi, where=valid)
+
+@profiling.profiled('c_factor')
+def c_factor(tiff_path, output_path, windowed=False, clamp=False, tile_size=512, incremental=False, quantize=None):
     """
     Calculates the cover factor (C-Factor) from an NDVI TIFF and saves it as a new TIFF.
 
     Parameters:
     tiff_path (str): The path to the NDVI TIFF file.
     output_path (str): The path where the C-Factor TIFF file will be saved.
+    windowed (bool): Process the raster in two block-wise passes (global min/max,
+        then normalize-and-write) so memory stays bounded by tile_size. The output
+        matches the single-shot path.
+    clamp (bool): Clamp NDVI to [-1, 1] before normalizing.
+    tile_size (int): Approximate tile edge in pixels for the windowed mode.
+    incremental (bool): Windowed mode with a build manifest next to the output (see
+        TileManifest): only the tiles whose NDVI changed since the last run are
+        recomputed, or all of them if the NDVI range moved.
+    quantize (str): 'uint8' or 'uint16' to store the Cover Factor, which lies in [0, 1], as
+        scaled integer codes instead of float32 (see raster_handling.quantize).
+
+    Nodata pixels are skipped when finding the NDVI range and kept as nodata.
 
     See Van der Knijff, J.M., Jones, R.J.A. and Montanarella, L. (2000) 
     Soil Erosion Risk Assessment in Europe. 
@@ -142,25 +242,62 @@ def c_factor(tiff_path, output_path):
     """
     # Open the NDVI TIFF file
     with rasterio.open(tiff_path) as src:
-        ndvi = src.read(1)  # Read the first band
-
-        # Normalize NDVI to scale from 0 to 1
-        ndvi_min, ndvi_max = ndvi.min(), ndvi.max()
-        normalized_ndvi = (ndvi - ndvi_min) / (ndvi_max - ndvi_min)
-
-        # Invert the normalized NDVI to get the Cover Factor
-        cover_factor = 1 - normalized_ndvi
-
         # Define new metadata for the output file
         out_meta = src.meta.copy()
         out_meta.update({
-            "dtype": 'float32',
-            "compress": "lzw"
+            "dtype": 'float32'
         })
 
-        # Save the Cover Factor as a new TIFF file
-        with rasterio.open(output_path, 'w', **out_meta) as dest:
-            dest.write(cover_factor, 1)  # Write the Cover Factor to the first band
+        q = quantizer(quantize, 0.0, 1.0) if quantize else None
+        if q is not None:
+            out_meta = q.profile(out_meta)
+
+        def stored(cover_factor):
+            if q is None:
+                return cover_factor.astype('float32', copy=False)
+            return q.encode(cover_factor, src.nodata)
+
+        if incremental:
+            def read(window):
+                return [src.read(1, window=window)]
+
+            def compute(window, arrays):
+                return stored(cover_factor_from_ndvi(arrays[0], ndvi_min, ndvi_max, src.nodata, clamp))
+
+            with TileManifest(output_path) as manifest:
+                ndvi_min, ndvi_max = manifest.memo(
+                    f"ndvi_range clamp={clamp}", [tiff_path],
+                    lambda: [float(v) for v in ndvi_range(src, clamp, tile_size)])
+                counts = manifest.build(out_meta, output_tiles(src.height, src.width, tile_size), [tiff_path],
+                                        read, compute,
+                                        params={'factor': 'C', 'range': [ndvi_min, ndvi_max], 'clamp': clamp},
+                                        quantizer=q)
+            print(f"C_Factor saved to {output_path} ({counts['rebuilt']} tiles recomputed)")
+            return
+        if windowed:
+            ndvi_min, ndvi_max = ndvi_range(src, clamp, tile_size)
+            with open_cog(output_path, out_meta) as dest:
+                if q is not None:
+                    set_scaling(dest, q)
+                for window in block_windows(src, tile_size=tile_size):
+                    ndvi = src.read(1, window=window)
+                    cover_factor = cover_factor_from_ndvi(ndvi, ndvi_min, ndvi_max, src.nodata, clamp)
+                    dest.write(stored(cover_factor), 1, window=window)
+        else:
+            ndvi = src.read(1)  # Read the first band
+            values = ndvi[valid_ndvi(ndvi, src.nodata)]
+            if values.size == 0:
+                raise ValueError("no valid NDVI pixels")
+            if clamp:
+                np.clip(values, -1, 1, out=values)
+            ndvi_min, ndvi_max = values.min(), values.max()
+            cover_factor = cover_factor_from_ndvi(ndvi, ndvi_min, ndvi_max, src.nodata, clamp)
+
+            # Save the Cover Factor as a new TIFF file
+            with open_cog(output_path, out_meta) as dest:
+                if q is not None:
+                    set_scaling(dest, q)
+                dest.write(stored(cover_factor), 1)  # Write the Cover Factor to the first band
     print(f"C_Factor saved to {output_path}")
 
 # Function which calls the C_factor function, but then also deletes the NDVI, to save on storage
@@ -172,9 +309,14 @@ def c_factor_and_cleanup(ndvi_path, c_factor_path):
     delete_file(ndvi_path)
     print("NDVI file has been deleted after processing C_Factor.")
 
-ndvi_path = os.path.join(ndvi_dir, "ndvi.tiff")
-c_factor_path = os.path.join(c_factor_dir, "cover_factor.tiff")
+if __name__ == "__main__":
+    # Ensure directories exist
+    ensure_dir(ndvi_dir)
+    ensure_dir(c_factor_dir)
+
+    ndvi_path = os.path.join(ndvi_dir, "ndvi.tiff")
+    c_factor_path = os.path.join(c_factor_dir, "cover_factor.tiff")
 
-# Example usage
-fetch_NDVI_TERRASCOPE(bounding, dates, ndvi_path)
-c_factor_and_cleanup(ndvi_path, c_factor_path)
\ No newline at end of file
+    # Example usage
+    fetch_NDVI_TERRASCOPE(bounding, dates, ndvi_path)
+    c_factor_and_cleanup(ndvi_path, c_factor_path)
\ No newline at end of file
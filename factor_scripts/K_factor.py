@@ -0,0 +1,178 @@
+import csv
+import hashlib
+import json
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+from raster_handling.cog import open_cog
+from raster_handling.rasterhandler import (block_windows, bounded_map, close_on_grid, grid_key, open_on_grid,
+                                          raster_grid)
+
+# Where lookup tables are kept between runs, keyed by their content
+lookup_cache_dir = os.path.join(tempfile.gettempdir(), "soil_erosion", "k_lookup")
+
+k_nodata = -9999.0
+
+# Per-process cache of memory-mapped lookup tables
+_lookups = {}
+
+
+def read_k_table(table, key_column='mukey', k_column='kffact'):
+    """
+    Reads a map-unit → K table.
+
+    Parameters:
+    table: A dict of {map unit key: K}, or the path of a CSV file (e.g. a SSURGO export).
+    key_column (str): CSV column holding the integer map-unit key.
+    k_column (str): CSV column holding the K value; empty cells are skipped.
+
+    Returns:
+    tuple: (keys as int64 array, K values as float32 array)
+    """
+    if isinstance(table, dict):
+        items = table.items()
+    else:
+        with open(table, newline='') as f:
+            items = [(row[key_column], row[k_column]) for row in csv.DictReader(f) if row[k_column] not in ('', None)]
+    keys = np.array([int(key) for key, _ in items], dtype=np.int64)
+    values = np.array([float(k) for _, k in items], dtype=np.float32)
+    return keys, values
+
+
+def build_k_lookup(table, key_column='mukey', k_column='kffact', cache_dir=None):
+    """
+    Builds the dense map-unit → K lookup array once and stores it as a .npy file.
+
+    Entry i of the array is the K value of map unit i (NaN if the table has none),
+    so a whole tile is converted with a single np.take. The file name is a hash of
+    the table contents, so the same table is only built once, and the file can be
+    memory-mapped by any number of worker processes without copying it.
+
+    Parameters:
+    table: A dict of {map unit key: K}, or the path of a CSV file.
+    key_column, k_column (str): CSV columns, see read_k_table.
+    cache_dir (str): Directory of cached lookup files (default: lookup_cache_dir).
+
+    Returns:
+    str: Path of the .npy lookup file.
+    """
+    keys, values = read_k_table(table, key_column, k_column)
+    if len(keys) and keys.min() < 0:
+        raise ValueError("Map-unit keys must be non-negative integers")
+
+    digest = hashlib.sha256()
+    digest.update(json.dumps([key_column, k_column]).encode())
+    order = np.argsort(keys, kind='stable')
+    digest.update(keys[order].tobytes())
+    digest.update(values[order].tobytes())
+
+    cache_dir = cache_dir or lookup_cache_dir
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, f"k_lookup_{digest.hexdigest()[:32]}.npy")
+    if not os.path.exists(path):
+        lookup = np.full(int(keys.max()) + 1 if len(keys) else 1, np.nan, dtype=np.float32)
+        lookup[keys] = values
+        # Write to a temporary name first so other processes never see a partial file
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.save(f, lookup)
+        os.replace(tmp_path, path)
+    return path
+
+
+def load_k_lookup(path):
+    """
+    Memory-maps a lookup file built by build_k_lookup, once per process.
+    The pages are shared through the OS page cache, so workers don't each hold a copy.
+    """
+    if path not in _lookups:
+        _lookups[path] = np.load(path, mmap_mode='r')
+    return _lookups[path]
+
+
+def map_units_to_k(units, lookup, nodata=None):
+    """
+    Converts an array of map-unit keys to K values with one gather.
+
+    Parameters:
+    units (ndarray): Integer map-unit keys.
+    lookup (ndarray): Dense lookup array from build_k_lookup.
+    nodata: Nodata value of the map-unit raster.
+
+    Returns:
+    ndarray: float32 K values; k_nodata where the unit is nodata, unknown or has no K.
+    """
+    units = units.astype(np.int64, copy=False)
+    known = (units >= 0) & (units < len(lookup))
+    if nodata is not None:
+        known &= units != nodata
+    k = np.asarray(np.take(lookup, units, mode='clip'))
+    known &= ~np.isnan(k)
+    k[~known] = k_nodata
+    return k
+
+
+def k_tile(path, key, window, lookup_path):
+    """
+    Converts one tile of the map-unit raster to K.
+
+    Returns:
+    tuple: (window, K tile as float32)
+    """
+    src = open_on_grid(path, key)
+    units = src.read(1, window=Window(*window))
+    return window, map_units_to_k(units, load_k_lookup(lookup_path), src.nodata)
+
+
+def k_factor(mapunit_path, table, output_path, key_column='mukey', k_column='kffact',
+             tile_size=512, workers=None, cache_dir=None):
+    """
+    Calculates the soil erodibility factor (K) from a soil map-unit raster and saves it as a tiled TIFF.
+
+    Parameters:
+    mapunit_path (str): Path to the raster of integer map-unit keys (e.g. gSSURGO MUKEY).
+    table: The map-unit → K table, as a dict or a CSV path, see read_k_table.
+    output_path (str): Path where the K-Factor TIFF will be saved.
+    key_column, k_column (str): CSV columns, see read_k_table.
+    tile_size (int): Approximate tile edge in pixels, rounded up to whole source blocks.
+    workers (int): Number of worker processes (default: all cores; 1 runs in-process).
+    cache_dir (str): Directory of cached lookup files.
+
+    Returns:
+    str: output_path
+    """
+    lookup_path = build_k_lookup(table, key_column, k_column, cache_dir)
+
+    with rasterio.open(mapunit_path) as src:
+        key = grid_key(raster_grid(src))
+        tiles = [(int(w.col_off), int(w.row_off), int(w.width), int(w.height))
+                 for w in block_windows(src, tile_size=tile_size)]
+        out_meta = src.meta.copy()
+        out_meta.update({
+            'driver': 'GTiff',
+            'dtype': 'float32',
+            'nodata': k_nodata
+        })
+
+    workers = workers or os.cpu_count() or 1
+    jobs = [(mapunit_path, key, tile, lookup_path) for tile in tiles]
+    with open_cog(output_path, out_meta) as dest:
+        if workers == 1:
+            try:
+                for window, k in (k_tile(*job) for job in jobs):
+                    dest.write(k, 1, window=Window(*window))
+            finally:
+                close_on_grid()
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                # A couple of tiles per worker in flight, so finished tiles don't pile up in memory
+                for window, k in bounded_map(pool, k_tile, jobs, 2 * workers):
+                    dest.write(k, 1, window=Window(*window))
+
+    print(f"K_Factor saved to {output_path}")
+    return output_path
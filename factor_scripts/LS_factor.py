@@ -0,0 +1,348 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+from raster_handling.cog import open_cog
+from raster_handling.rasterhandler import bounded_map, close_on_grid, grid_key, open_on_grid, raster_grid
+
+# D8 neighbour offsets (row, col); a cell's flow direction is an index into this list
+d8_offsets = ((-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1))
+
+# Approximate length of one degree, for DEMs in a geographic CRS
+meters_per_degree_lat = 110574.0
+meters_per_degree_lon = 111320.0
+
+ls_nodata = -9999.0
+
+
+def flow_accumulation(receivers, weights):
+    """
+    Accumulates weights downstream along receiver links in linear time.
+
+    Nodes are released in topological waves (Kahn's algorithm): a node joins a
+    wave once everything upstream of it is done, and each wave is one vectorized
+    step, so the total work is proportional to the number of nodes.
+
+    Parameters:
+    receivers (ndarray): int64 index of each node's downstream node, or -1.
+    weights (ndarray): Weight contributed by each node.
+
+    Returns:
+    tuple: (accumulated weights as float64, list of waves in upstream-to-downstream order)
+    """
+    n = len(receivers)
+    accumulated = np.array(weights, dtype=np.float64)
+    indegree = np.bincount(receivers[receivers >= 0], minlength=n)
+    frontier = np.flatnonzero(indegree == 0)
+    waves = []
+    while frontier.size:
+        waves.append(frontier)
+        down = receivers[frontier]
+        keep = down >= 0
+        up, down = frontier[keep], down[keep]
+        np.add.at(accumulated, down, accumulated[up])
+        np.subtract.at(indegree, down, 1)
+        down = np.unique(down)
+        frontier = down[indegree[down] == 0]
+    return accumulated, waves
+
+
+def cell_size(transform, crs, row_off, height):
+    """
+    Returns the cell width per row (as a column vector) and the cell height, in meters.
+    """
+    res_x, res_y = abs(transform.a), abs(transform.e)
+    if crs is not None and rasterio.crs.CRS.from_user_input(crs).is_geographic:
+        rows = np.arange(row_off, row_off + height) + 0.5
+        lat = np.radians(transform.f + rows * transform.e)
+        dx = res_x * meters_per_degree_lon * np.cos(lat)
+        return dx[:, None], res_y * meters_per_degree_lat
+    return np.full((height, 1), res_x), res_y
+
+
+def read_with_halo(src, window, height, width):
+    """
+    Reads a tile of a DEM grown by one cell on every side.
+
+    Cells outside the raster and nodata cells come back as NaN.
+
+    Returns:
+    ndarray: float64 array of shape (tile height + 2, tile width + 2)
+    """
+    col, row, w, h = window
+    row0, row1 = max(row - 1, 0), min(row + h + 1, height)
+    col0, col1 = max(col - 1, 0), min(col + w + 1, width)
+    data = src.read(1, window=Window(col0, row0, col1 - col0, row1 - row0), out_dtype='float64')
+    if src.nodata is not None:
+        data[data == src.nodata] = np.nan
+
+    z = np.full((h + 2, w + 2), np.nan)
+    top, left = row0 - (row - 1), col0 - (col - 1)
+    z[top:top + data.shape[0], left:left + data.shape[1]] = data
+    return z
+
+
+def d8_and_slope(z, dx, dy):
+    """
+    Computes D8 flow directions and slope angles for the inner cells of a halo tile.
+
+    Parameters:
+    z (ndarray): Elevations with a one-cell halo, NaN where there is no data.
+    dx (ndarray): Cell width per row, as a column vector (m).
+    dy (float): Cell height (m).
+
+    Returns:
+    tuple: (direction index into d8_offsets or -1 for pits/nodata, slope in radians)
+    """
+    h, w = z.shape[0] - 2, z.shape[1] - 2
+    center = z[1:-1, 1:-1]
+
+    steepest = np.zeros((h, w))
+    direction = np.full((h, w), -1, dtype=np.int8)
+    for k, (dr, dc) in enumerate(d8_offsets):
+        neighbour = z[1 + dr:1 + dr + h, 1 + dc:1 + dc + w]
+        drop = (center - neighbour) / np.hypot(dr * dy, dc * dx)
+        steeper = drop > steepest  # NaN never compares greater
+        steepest[steeper] = drop[steeper]
+        direction[steeper] = k
+
+    # Central differences, falling back to one-sided ones next to nodata
+    def gradient(before, after, spacing):
+        central = (after - before) / (2 * spacing)
+        forward = (after - center) / spacing
+        backward = (center - before) / spacing
+        return np.where(~np.isnan(central), central,
+                        np.where(~np.isnan(forward), forward, np.nan_to_num(backward)))
+
+    gx = gradient(z[1:-1, :-2], z[1:-1, 2:], dx)
+    gy = gradient(z[2:, 1:-1], z[:-2, 1:-1], dy)
+    slope = np.arctan(np.hypot(gx, gy))
+    return direction, slope
+
+
+def tile_flow(src, key, window):
+    """
+    Builds the flow graph of one tile.
+
+    Returns:
+    tuple: (local receiver of each cell or -1, global index of each cell's
+    receiver outside the tile or -1, cell area in m², slope in radians, nodata mask)
+    """
+    crs, transform, height, width = key
+    transform = rasterio.Affine(*transform)
+    col, row, w, h = window
+
+    z = read_with_halo(src, window, height, width)
+    dx, dy = cell_size(transform, crs, row, h)
+    direction, slope = d8_and_slope(z, dx, dy)
+
+    rows, cols = np.indices((h, w))
+    offsets = np.array(d8_offsets)
+    flows = direction >= 0
+    down_row = np.where(flows, rows + offsets[direction, 0], -1)
+    down_col = np.where(flows, cols + offsets[direction, 1], -1)
+    inside = flows & (down_row >= 0) & (down_row < h) & (down_col >= 0) & (down_col < w)
+    leaves = flows & ~inside
+
+    receivers = np.where(inside, down_row * w + down_col, -1).ravel()
+    external = np.where(leaves, (row + down_row) * width + (col + down_col), -1).ravel()
+    area = np.broadcast_to(dx * dy, (h, w)).ravel()
+    return receivers, external, area, slope, np.isnan(z[1:-1, 1:-1])
+
+
+def perimeter(h, w):
+    """Returns the local indices of the edge cells of an h x w tile."""
+    rows, cols = np.indices((h, w))
+    edge = (rows == 0) | (rows == h - 1) | (cols == 0) | (cols == w - 1)
+    return np.flatnonzero(edge)
+
+
+def tile_links(path, key, window, resampling):
+    """
+    First pass over one tile: local flow accumulation, summarized at the tile edge.
+
+    Returns:
+    dict: global indices of the perimeter cells and the in-tile outlet each one
+    drains to (or -1), plus every outlet's downstream cell in the next tile and
+    its local accumulated area.
+    """
+    src = open_on_grid(path, key, resampling)
+    col, row, w, h = window
+    width = key[3]
+    receivers, external, area, _, _ = tile_flow(src, key, window)
+    accumulated, waves = flow_accumulation(receivers, area)
+
+    # Walk downstream-first to label every cell with the outlet it leaves the tile through
+    is_outlet = external >= 0
+    outlet = np.full(len(receivers), -1)
+    for wave in reversed(waves):
+        down = receivers[wave]
+        outlet[wave] = np.where(is_outlet[wave], wave, np.where(down >= 0, outlet[np.maximum(down, 0)], -1))
+
+    def to_global(local):
+        return (row + local // w) * width + (col + local % w)
+
+    edge = perimeter(h, w)
+    edge_outlet = outlet[edge]
+    outlets = np.flatnonzero(is_outlet)
+    return {
+        'perimeter': to_global(edge),
+        'perimeter_outlet': np.where(edge_outlet >= 0, to_global(edge_outlet), -1),
+        'outlets': to_global(outlets),
+        'targets': external[outlets],
+        'outlet_area': accumulated[outlets],
+    }
+
+
+def stitch_tiles(links):
+    """
+    Solves the flow between tiles on the graph of perimeter cells.
+
+    Every perimeter cell drains to the outlet its tile labelled, and every outlet
+    drains into a perimeter cell of the neighbouring tile, so the whole domain
+    reduces to a small graph that flow_accumulation solves exactly.
+
+    Returns:
+    tuple: (global indices of perimeter cells, area flowing into each from other tiles)
+    """
+    cells = np.concatenate([link['perimeter'] for link in links])
+    cell_outlet = np.concatenate([link['perimeter_outlet'] for link in links])
+    outlets = np.concatenate([link['outlets'] for link in links])
+    targets = np.concatenate([link['targets'] for link in links])
+    outlet_area = np.concatenate([link['outlet_area'] for link in links])
+
+    nodes = np.unique(cells)
+    receivers = np.full(len(nodes), -1)
+    passes = (cell_outlet >= 0) & (cell_outlet != cells)
+    receivers[np.searchsorted(nodes, cells[passes])] = np.searchsorted(nodes, cell_outlet[passes])
+    outlet_ids, target_ids = np.searchsorted(nodes, outlets), np.searchsorted(nodes, targets)
+    receivers[outlet_ids] = target_ids
+
+    weights = np.zeros(len(nodes))
+    weights[outlet_ids] = outlet_area
+    accumulated, _ = flow_accumulation(receivers, weights)
+    inflow = np.bincount(target_ids, weights=accumulated[outlet_ids], minlength=len(nodes))
+    return nodes, inflow
+
+
+def tile_ls(path, key, window, resampling, inflow_cells, inflow, m, n):
+    """
+    Second pass over one tile: flow accumulation including the area flowing in
+    from other tiles, turned into the LS factor.
+
+    Returns:
+    tuple: (window, LS tile as float32)
+    """
+    src = open_on_grid(path, key, resampling)
+    col, row, w, h = window
+    width = key[3]
+    receivers, _, area, slope, missing = tile_flow(src, key, window)
+
+    weights = area.copy()
+    local = (inflow_cells // width - row) * w + (inflow_cells % width - col)
+    weights[local] += inflow
+    accumulated, _ = flow_accumulation(receivers, weights)
+
+    # Moore & Burch (1986): LS = (As / 22.13)^m * (sin(beta) / 0.0896)^n,
+    # with As the specific catchment area (upslope area per unit contour width)
+    dx, _ = cell_size(rasterio.Affine(*key[1]), key[0], row, h)
+    specific_area = accumulated.reshape(h, w) / dx
+    ls = np.power(specific_area / 22.13, m) * np.power(np.sin(slope) / 0.0896, n)
+    ls = ls.astype(np.float32)
+    ls[missing] = ls_nodata
+    return window, ls
+
+
+def ls_factor(dem_path, output_path, reference=None, tile_size=1024, workers=None,
+              m=0.4, n=1.3, resampling='bilinear'):
+    """
+    Derives the slope length and steepness factor (LS) from a DEM and saves it as a tiled TIFF.
+
+    Slope and D8 flow directions come from the DEM; upslope contributing area comes
+    from a linear-time flow accumulation. The DEM is processed in tiles with a
+    one-cell halo on a process pool, in two passes: the first accumulates flow
+    inside each tile and records where it leaves, the tile-to-tile flow is then
+    solved on the small graph of tile-edge cells, and the second pass adds that
+    inflow and computes LS. The result equals an untiled run, while memory stays
+    bounded by tile_size.
+
+    The DEM should be hydrologically conditioned (sinks filled); pits and flats
+    simply end a flow path.
+
+    Parameters:
+    dem_path (str): Path to the DEM (elevations in meters).
+    output_path (str): Path where the LS TIFF will be saved.
+    reference: Optional grid to produce LS on, as a raster path, an open dataset or
+        a (crs, transform, (height, width)) tuple; the DEM is aligned to it the same
+        way rasterhandler.resample_raster_obj would. Defaults to the DEM's own grid.
+    tile_size (int): Tile edge in pixels, rounded up to a multiple of 256.
+    workers (int): Number of worker processes (default: all cores; 1 runs in-process).
+    m, n (float): Exponents of the slope length and slope steepness terms.
+    resampling (str): Resampling used when aligning the DEM to the reference.
+
+    Returns:
+    str: output_path
+
+    See Moore, I.D. and Burch, G.J. (1986) Physical basis of the length-slope factor
+    in the Universal Soil Loss Equation. Soil Science Society of America Journal, 50, 1294-1298.
+    """
+    if reference is None:
+        reference = dem_path
+    if isinstance(reference, str):
+        with rasterio.open(reference) as ref:
+            grid = raster_grid(ref)
+    else:
+        grid = raster_grid(reference)
+    key = grid_key(grid)
+    crs, transform, height, width = grid
+
+    tile_size = -(-tile_size // 256) * 256
+    tiles = [(col, row, min(tile_size, width - col), min(tile_size, height - row))
+             for row in range(0, height, tile_size) for col in range(0, width, tile_size)]
+
+    workers = workers or os.cpu_count() or 1
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+
+    def run(fn, jobs):
+        # A couple of tiles per worker in flight, so finished tiles don't pile up in memory
+        if pool is None:
+            return (fn(*job) for job in jobs)
+        return bounded_map(pool, fn, jobs, 2 * workers)
+
+    try:
+        # The links are only the tile perimeters, so keeping all of them is cheap
+        links = list(run(tile_links, [(dem_path, key, tile, resampling) for tile in tiles]))
+        nodes, inflow = stitch_tiles(links)
+
+        # Hand each tile only the inflow at its own edge
+        node_rows, node_cols = nodes // width, nodes % width
+        jobs = []
+        for col, row, w, h in tiles:
+            mine = ((node_rows >= row) & (node_rows < row + h) &
+                    (node_cols >= col) & (node_cols < col + w) & (inflow > 0))
+            jobs.append((dem_path, key, (col, row, w, h), resampling, nodes[mine], inflow[mine], m, n))
+
+        profile = {
+            'driver': 'GTiff',
+            'dtype': 'float32',
+            'count': 1,
+            'height': height,
+            'width': width,
+            'crs': crs,
+            'transform': transform,
+            'nodata': ls_nodata
+        }
+        with open_cog(output_path, profile) as dest:
+            for window, ls in run(tile_ls, jobs):
+                dest.write(ls, 1, window=Window(*window))
+    finally:
+        if pool:
+            pool.shutdown()
+        else:
+            close_on_grid()
+
+    print(f"LS_Factor saved to {output_path}")
+    return output_path
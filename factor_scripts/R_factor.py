@@ -1,13 +1,103 @@
 import rasterio
-from rasterio.windows import from_bounds
-from rasterio.warp import transform_bounds
+from rasterio.windows import Window, transform as window_transform
+from rasterio.warp import transform
 from shapely.geometry import box
 import numpy as np
 
+from raster_handling import profiling
+from raster_handling.bilreader import open_bil
+from raster_handling.cog import open_cog
+from raster_handling.manifest import TileManifest
+from raster_handling.quantize import quantizer, set_scaling
+from raster_handling.rasterhandler import block_windows, dataset_cache, merge_windows
+
 
 # Define the file path
 raster_path = r"C:\Users\jpkeb\Documents\soil_erosion\tutorial_data\PRISM_ppt_30yr_normal_800mM4_annual_bil\PRISM_ppt_30yr_normal_800mM4_annual_bil.bil"
 
+# Rough lat/lon bounding box for the contiguous U.S.
+conus_bounds = (-125, 24, -66.5, 49)
+
+def within_conus(minx, miny, maxx, maxy):
+    """
+    Checks whether lat/lon bounding boxes fall inside the contiguous U.S.
+
+    Parameters:
+        minx, miny, maxx, maxy (float or ndarray): Bounding box(es) in EPSG:4326 (lon/lat)
+
+    Returns:
+        bool or ndarray: True where every corner of the bbox is inside CONUS
+    """
+    return (
+        (conus_bounds[0] <= minx) & (minx <= conus_bounds[2]) &
+        (conus_bounds[0] <= maxx) & (maxx <= conus_bounds[2]) &
+        (conus_bounds[1] <= miny) & (miny <= conus_bounds[3]) &
+        (conus_bounds[1] <= maxy) & (maxy <= conus_bounds[3])
+    )
+
+def conus_windows(src, bboxes, densify_pts=21):
+    """
+    Converts lat/lon bounding boxes into whole-pixel windows of an open raster.
+
+    Every bbox edge is densified like transform_bounds does, and the points of
+    all boxes are projected in a single call. Windows are snapped to the pixel
+    grid so that reading one in one go or tile by tile gives exactly the same
+    pixels (a fractional window makes GDAL resample the read).
+
+    Parameters:
+        src (rasterio DatasetReader): The open source raster
+        bboxes (array-like): N bounding boxes (minx, miny, maxx, maxy) in EPSG:4326
+        densify_pts (int): Extra points per edge to smooth out projection distortions
+
+    Returns:
+        ndarray: int array of shape (N, 4) with col_off, row_off, width, height,
+        clipped to the raster extent (zero-sized where a bbox misses the raster)
+    """
+    minx, miny, maxx, maxy = np.asarray(bboxes, dtype=float).reshape(-1, 4).T[:, :, None]
+    t = np.linspace(0, 1, densify_pts + 2)
+    along_x = minx + (maxx - minx) * t
+    along_y = miny + (maxy - miny) * t
+    xs = np.concatenate([along_x, along_x, np.broadcast_to(minx, along_y.shape),
+                         np.broadcast_to(maxx, along_y.shape)], axis=1)
+    ys = np.concatenate([np.broadcast_to(miny, along_x.shape), np.broadcast_to(maxy, along_x.shape),
+                         along_y, along_y], axis=1)
+
+    # Convert bounding boxes from EPSG:4326 to raster CRS
+    px, py = transform('EPSG:4326', src.crs, xs.ravel(), ys.ravel())
+    px, py = np.reshape(px, xs.shape), np.reshape(py, ys.shape)
+    left, right = px.min(axis=1), px.max(axis=1)
+    bottom, top = py.min(axis=1), py.max(axis=1)
+
+    inverse = ~src.transform
+    col_start, row_start = inverse * (left, top)
+    col_stop, row_stop = inverse * (right, bottom)
+    col_start, col_stop = np.minimum(col_start, col_stop), np.maximum(col_start, col_stop)
+    row_start, row_stop = np.minimum(row_start, row_stop), np.maximum(row_start, row_stop)
+
+    # Same snapping as Window.round_offsets().round_lengths()
+    col_off = np.floor(col_start + 0.1).astype(np.int64)
+    row_off = np.floor(row_start + 0.1).astype(np.int64)
+    col_end = col_off + np.floor(col_stop - col_start + 0.5).astype(np.int64)
+    row_end = row_off + np.floor(row_stop - row_start + 0.5).astype(np.int64)
+
+    col0, col1 = np.clip(col_off, 0, src.width), np.clip(col_end, 0, src.width)
+    row0, row1 = np.clip(row_off, 0, src.height), np.clip(row_end, 0, src.height)
+    return np.column_stack([col0, row0, np.maximum(col1 - col0, 0), np.maximum(row1 - row0, 0)])
+
+def conus_window(src, minx, miny, maxx, maxy):
+    """
+    Converts a lat/lon bounding box into a whole-pixel window of an open raster.
+
+    Parameters:
+        src (rasterio DatasetReader): The open source raster
+        minx, miny, maxx, maxy (float): Bounding box in EPSG:4326 (lon/lat)
+
+    Returns:
+        rasterio Window: Integer window, clipped to the raster extent
+    """
+    return Window(*(int(v) for v in conus_windows(src, [(minx, miny, maxx, maxy)])[0]))
+
+@profiling.profiled('clip')
 def clip_raster_within_conus(filepath, minx, miny, maxx, maxy):
     """
     Loads and clips a raster using a user-defined lat/lon bounding box,
@@ -20,31 +110,16 @@ def clip_raster_within_conus(filepath, minx, miny, maxx, maxy):
     Returns:
         Tuple: (clipped_data, transform, metadata) or None if bbox is invalid
     """
-    # Rough lat/lon bounding box for the contiguous U.S.
-    conus_bounds = (-125, 24, -66.5, 49)
-
     # Check if the bbox falls within CONUS bounds
-    if not (
-        conus_bounds[0] <= minx <= conus_bounds[2] and
-        conus_bounds[0] <= maxx <= conus_bounds[2] and
-        conus_bounds[1] <= miny <= conus_bounds[3] and
-        conus_bounds[1] <= maxy <= conus_bounds[3]
-    ):
+    if not within_conus(minx, miny, maxx, maxy):
         print("❌ Bounding box is outside the contiguous U.S.")
         return None
 
     with rasterio.open(filepath) as src:
-        raster_crs = src.crs
-        # Convert bounding box from EPSG:4326 to raster CRS
-        transformed_bounds = transform_bounds(
-            'EPSG:4326', raster_crs,
-            minx, miny, maxx, maxy,
-            densify_pts=21  # Smooth out any projection distortions
-        )
-
         # Create window and read data
-        window = from_bounds(*transformed_bounds, transform=src.transform)
+        window = conus_window(src, minx, miny, maxx, maxy)
         clipped_data = src.read(1, window=window)
+        profiling.read(clipped_data)
         clipped_transform = src.window_transform(window)
         clipped_meta = src.meta.copy()
         clipped_meta.update({
@@ -55,14 +130,106 @@ def clip_raster_within_conus(filepath, minx, miny, maxx, maxy):
 
         return clipped_data, clipped_transform, clipped_meta
 
-# Define a bounding box in EPSG:4326 (lat/lon) — e.g. around Kansas - sample use
-minx, miny = -77.5, 40.9
-maxx, maxy = -76.5, 41.9
+def clip_bil_within_conus(filepath, minx, miny, maxx, maxy):
+    """
+    Same as clip_raster_within_conus for a raw .bil raster such as the PRISM
+    normals, without going through GDAL.
+
+    The file is memory-mapped and the clip is a slice of the map, so nothing is
+    decoded or copied; calculate_rainfall_erosivity can take it as is.
+
+    Parameters:
+        filepath (str): Path to the .bil file (its .hdr and .prj sit next to it)
+        minx, miny, maxx, maxy (float): Bounding box in EPSG:4326 (lon/lat)
+
+    Returns:
+        Tuple: (clipped_data, transform, metadata) or None if bbox is invalid.
+        clipped_data is a read-only view of the file.
+    """
+    if not within_conus(minx, miny, maxx, maxy):
+        print("❌ Bounding box is outside the contiguous U.S.")
+        return None
+
+    # The clip is a view of the memory map, so it stays readable after the file is closed
+    with open_bil(filepath) as src:
+        window = conus_window(src, minx, miny, maxx, maxy)
+        clipped_data = src.read(1, window=window)
+        clipped_transform = src.window_transform(window)
+        clipped_meta = src.meta.copy()
+    clipped_meta.update({
+        'height': clipped_data.shape[0],
+        'width': clipped_data.shape[1],
+        'transform': clipped_transform
+    })
+
+    return clipped_data, clipped_transform, clipped_meta
+
+def clip_rasters_within_conus(filepath, bboxes, cache=dataset_cache):
+    """
+    Clips many lat/lon bounding boxes out of one raster, for services that answer
+    lots of bbox requests.
+
+    The raster is opened once through a shared dataset cache, all bboxes are
+    checked against CONUS and projected in one vectorized step, and overlapping
+    windows are merged so shared pixels are read only once. Clips are produced
+    lazily: a merged window is read when the first of its bboxes is reached and
+    released after the last one.
 
-result = clip_raster_within_conus(raster_path, minx, miny, maxx, maxy)
+    Parameters:
+        filepath (str): Path to the raster file
+        bboxes (array-like): N bounding boxes (minx, miny, maxx, maxy) in EPSG:4326
+        cache (DatasetCache): Cache of open dataset handles
+
+    Yields:
+        Tuple: (clipped_data, transform, metadata) per bbox in input order, or None if the bbox is invalid.
+        clipped_data is a read-only view shared with overlapping clips; copy it before changing it in place.
+    """
+    bboxes = np.asarray(bboxes, dtype=float).reshape(-1, 4)
+    valid = within_conus(*bboxes.T)
+
+    windows = np.zeros((len(bboxes), 4), dtype=np.int64)
+    with cache.open(filepath) as src:
+        src_meta = src.meta.copy()
+        if valid.any():
+            windows[valid] = conus_windows(src, bboxes[valid])
+
+    labels, merged = merge_windows(windows[valid])
+    group = np.full(len(bboxes), -1)
+    group[valid] = labels
+    remaining = np.bincount(labels, minlength=len(merged))
+    reads = {}
+
+    for i in range(len(bboxes)):
+        if not valid[i]:
+            print("❌ Bounding box is outside the contiguous U.S.")
+            yield None
+            continue
 
+        g = group[i]
+        if g not in reads:
+            with cache.open(filepath) as src:
+                data = src.read(1, window=Window(*(int(v) for v in merged[g])))
+            data.setflags(write=False)
+            reads[g] = data
 
-def calculate_rainfall_erosivity(precip_array):
+        col_off, row_off, width, height = (int(v) for v in windows[i])
+        row0, col0 = row_off - merged[g][1], col_off - merged[g][0]
+        clipped_data = reads[g][row0:row0 + height, col0:col0 + width]
+        clipped_transform = window_transform(Window(col_off, row_off, width, height), src_meta['transform'])
+        clipped_meta = src_meta.copy()
+        clipped_meta.update({
+            'height': height,
+            'width': width,
+            'transform': clipped_transform
+        })
+
+        remaining[g] -= 1
+        if remaining[g] == 0:
+            del reads[g]
+        yield clipped_data, clipped_transform, clipped_meta
+
+@profiling.profiled('erosivity')
+def calculate_rainfall_erosivity(precip_array, out=None, nodata=None, chunk_size=65536):
     """
     Compute the rainfall erosivity factor (R) from annual precipitation (P).
 
@@ -75,36 +242,208 @@ def calculate_rainfall_erosivity(precip_array):
         R = 587.8 - 1.219 * P + 0.004105 * P^2
 
     
+    Both branches are evaluated a few rows at a time into small scratch buffers
+    and blended with np.copyto, so no full-size temporaries or fancy-indexed
+    copies are made. Passing out=precip_array (float32) computes in place.
+
     Parameters:
         precip_array (ndarray): raster data (precip in mm)
+        out (ndarray): optional float32 array of the same shape to write R into; a strided
+            view works if it is 2-D or its last axes can be merged without a copy
+        nodata (float): optional nodata value; those pixels (and NaNs) come out as nodata
+        chunk_size (int): approximate number of pixels handled per chunk
     
     Returns:
-        ndarray: R-factor array of same shape
+        ndarray: R-factor array of same shape (out, if given)
     """
-    P = np.array(precip_array, dtype=np.float32)
+    P = np.asarray(precip_array)
+    if out is None:
+        out = np.empty(P.shape, dtype=np.float32)
+        profiling.allocated(out)
+    elif out.shape != P.shape or out.dtype != np.float32:
+        raise ValueError("out must be a float32 array with the same shape as precip_array")
+    if P.size == 0:
+        return out
+
+    # Work on 2-D views so the loop below can walk whole rows (a scalar is one row of one pixel)
+    P = np.atleast_1d(P)
+    P2 = P.reshape(-1, P.shape[-1]) if P.ndim != 2 else P
+    R2 = out.reshape(P2.shape)
+    if not np.may_share_memory(R2, out):
+        # The reshape had to copy, so R would never reach the caller's array
+        raise ValueError("out must be viewable with 2-D rows, e.g. C-contiguous or a 2-D strided view")
+
+    # Scratch buffers for one chunk of rows, small enough to stay in cache
+    rows = max(1, chunk_size // P2.shape[1])
+    rows = min(rows, P2.shape[0])
+    high = np.empty((rows, P2.shape[1]), dtype=bool)
+    missing = np.empty_like(high)
+    nan = np.empty_like(high)
+    square = np.empty((rows, P2.shape[1]), dtype=np.float32)
+    linear = np.empty_like(square)
+    cast = None if P2.dtype == np.float32 else np.empty_like(square)
+
+    errstate = {'invalid': 'ignore'} if nodata is not None else {}
+    with np.errstate(**errstate):
+        for start in range(0, P2.shape[0], rows):
+            stop = min(start + rows, P2.shape[0])
+            n = stop - start
+            p, r = P2[start:stop], R2[start:stop]
+            if cast is not None:
+                np.copyto(cast[:n], p, casting='unsafe')
+                p = cast[:n]
+            h, m, s1, s2 = high[:n], missing[:n], square[:n], linear[:n]
+
+            # Masks first: r may be the same memory as p (in-place use)
+            np.greater_equal(p, 850, out=h)
+            if nodata is not None:
+                np.equal(p, nodata, out=m)
+                np.isnan(p, out=nan[:n])
+                np.logical_or(m, nan[:n], out=m)
+
+            # P >= 850: R = 587.8 - 1.219 * P + 0.004105 * P^2
+            np.multiply(p, p, out=s1)
+            s1 *= 0.004105
+            np.multiply(p, 1.219, out=s2)
+            np.subtract(587.8, s2, out=s2)
+            s2 += s1
+
+            # P < 850: R = 0.0483 * P^1.161
+            np.power(p, 1.161, out=r)
+            r *= 0.0483
+
+            np.copyto(r, s2, where=h)
+            if nodata is not None:
+                np.copyto(r, nodata, where=m)
+
+    return out
+
+def precip_range(src, window, tile_size=512):
+    """
+    Min and max of the valid precipitation in a window of an open raster, read block by block.
+
+    Returns:
+        tuple: (min, max), or (0, 0) if the window holds no valid pixel
+    """
+    low, high = np.inf, -np.inf
+    for tile in block_windows(src, window, tile_size):
+        precip = src.read(1, window=tile, masked=True)
+        if precip.count():
+            low, high = min(low, float(precip.min())), max(high, float(precip.max()))
+    return (low, high) if low <= high else (0.0, 0.0)
+
+def erosivity_quantizer(dtype, p_range):
+    """
+    Quantizer covering the R values of a precipitation range.
+
+    R grows with P (the jump at 850 mm is upwards too), so the R range is R of
+    the ends of the P range.
+    """
+    ends = np.maximum(np.array(p_range, dtype=np.float32), 0)
+    r_min, r_max = calculate_rainfall_erosivity(ends)
+    return quantizer(dtype, float(r_min), float(r_max))
+
+@profiling.profiled('erosivity.tiled')
+def write_rainfall_erosivity_tiled(filepath, output_path, minx, miny, maxx, maxy, tile_size=512, incremental=False,
+                                   quantize=None):
+    """
+    Computes the R-factor for a lat/lon bounding box without loading the whole
+    clip into memory, and writes it to a tiled GeoTIFF.
+
+    The source is walked in windows aligned to its internal blocks; each window
+    is read, converted with calculate_rainfall_erosivity and written straight
+    into the output, so peak memory depends on tile_size rather than on the
+    raster size. The result is identical to running calculate_rainfall_erosivity
+    on the output of clip_raster_within_conus with the source nodata value.
+
+    Parameters:
+        filepath (str): Path to the precipitation raster (mm)
+        output_path (str): Path of the R-factor GeoTIFF to write
+        minx, miny, maxx, maxy (float): Bounding box in EPSG:4326 (lon/lat)
+        tile_size (int): Approximate tile edge in pixels, rounded up to whole source blocks
+        incremental (bool): Keep a build manifest and working copy next to the output (see
+            TileManifest, and TileManifest.discard to remove them) and only recompute the
+            tiles whose precipitation changed since the last run
+        quantize (str): 'uint16' or 'uint8' to store R as scaled integer codes over the
+            clip's R range instead of float32 (see raster_handling.quantize); this takes
+            an extra pass over the precipitation to find the range
+
+    Returns:
+        str: output_path, or None if bbox is invalid
+    """
+    if not within_conus(minx, miny, maxx, maxy):
+        print("❌ Bounding box is outside the contiguous U.S.")
+        return None
+
+    with rasterio.open(filepath) as src:
+        window = conus_window(src, minx, miny, maxx, maxy)
+
+        out_meta = src.meta.copy()
+        out_meta.update({
+            'driver': 'GTiff',
+            'dtype': 'float32',
+            'height': window.height,
+            'width': window.width,
+            'transform': src.window_transform(window)
+        })
+
+        if incremental:
+            # The source blocks in output coordinates, so a tile decodes each block once
+            tiles = [Window(tile.col_off - window.col_off, tile.row_off - window.row_off, tile.width, tile.height)
+                     for tile in block_windows(src, window, tile_size)]
+
+            def read(tile):
+                return [src.read(1, window=Window(tile.col_off + window.col_off, tile.row_off + window.row_off,
+                                                  tile.width, tile.height), out_dtype='float32')]
+
+            def compute(tile, arrays):
+                R = calculate_rainfall_erosivity(arrays[0], out=arrays[0], nodata=src.nodata)
+                return R if q is None else q.encode(R, src.nodata)
+
+            with TileManifest(output_path) as manifest:
+                q = None
+                if quantize:
+                    p_range = manifest.memo(f"precip_range {window.flatten()}", [filepath],
+                                            lambda: precip_range(src, window, tile_size))
+                    q = erosivity_quantizer(quantize, p_range)
+                counts = manifest.build(q.profile(out_meta) if q else out_meta,
+                                        tiles, [filepath],
+                                        read, compute, params={'factor': 'R', 'window': window.flatten()},
+                                        quantizer=q)
+            print(f"R_Factor saved to {output_path} ({counts['rebuilt']} tiles recomputed)")
+            return output_path
 
-    # Initialize R with same shape
-    R = np.zeros_like(P)
+        q = erosivity_quantizer(quantize, precip_range(src, window, tile_size)) if quantize else None
+        with open_cog(output_path, q.profile(out_meta) if q else out_meta) as dest:
+            if q is not None:
+                set_scaling(dest, q)
+            for tile in block_windows(src, window, tile_size):
+                precip = src.read(1, window=tile, out_dtype='float32')
+                dest_window = Window(tile.col_off - window.col_off, tile.row_off - window.row_off,
+                                     tile.width, tile.height)
+                # The tile is ours, so compute R in place
+                R = calculate_rainfall_erosivity(precip, out=precip, nodata=src.nodata)
+                dest.write(R if q is None else q.encode(R, src.nodata), 1, window=dest_window)
 
-    # Condition 1: P < 850
-    mask_low = P < 850
-    R[mask_low] = 0.0483 * np.power(P[mask_low], 1.161)
+    print(f"R_Factor saved to {output_path}")
+    return output_path
 
-    # Condition 2: P >= 850
-    mask_high = ~mask_low
-    R[mask_high] = 587.8 - 1.219 * P[mask_high] + 0.004105 * np.power(P[mask_high], 2)
+if __name__ == "__main__":
+    # Define a bounding box in EPSG:4326 (lat/lon) — e.g. around Kansas - sample use
+    minx, miny = -77.5, 40.9
+    maxx, maxy = -76.5, 41.9
 
-    return R
+    result = clip_bil_within_conus(raster_path, minx, miny, maxx, maxy)
 
-if result:
-    clipped_data, transform, meta = result
+    if result:
+        clipped_data, transform, meta = result
 
-    R_array = calculate_rainfall_erosivity(clipped_data)
+        R_array = calculate_rainfall_erosivity(clipped_data, nodata=meta['nodata'])
 
-    # Plot it
-    import matplotlib.pyplot as plt
-    plt.figure(figsize=(8, 6))
-    plt.imshow(R_array, cmap='plasma')
-    plt.colorbar(label='Rainfall Erosivity Factor (R)')
-    plt.title("R-Factor Based on Annual Precipitation")
-    plt.show()
\ No newline at end of file
+        # Plot it
+        import matplotlib.pyplot as plt
+        plt.figure(figsize=(8, 6))
+        plt.imshow(R_array, cmap='plasma')
+        plt.colorbar(label='Rainfall Erosivity Factor (R)')
+        plt.title("R-Factor Based on Annual Precipitation")
+        plt.show()
\ No newline at end of file
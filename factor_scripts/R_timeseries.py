@@ -0,0 +1,231 @@
+import os
+import re
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import rasterio
+from rasterio.windows import Window, transform as window_transform
+
+from factor_scripts.R_factor import calculate_rainfall_erosivity, conus_window, within_conus
+from raster_handling import profiling
+from raster_handling.cog import open_cog
+from raster_handling.rasterhandler import bounded_map, close_on_grid, grid_key, open_on_grid, raster_grid
+
+# Nodata value of the R-factor outputs
+r_nodata = -9999.0
+
+# PRISM file names end in _<YYYY>, _<YYYYMM> or _<YYYYMMDD> before _bil (e.g. PRISM_ppt_stable_4kmM3_201901_bil)
+prism_date_pattern = re.compile(r'_(\d{4})(\d{2})?(\d{2})?_bil')
+
+# The attributes of a dataset that conus_window needs, for grids given as tuples
+Grid = namedtuple('Grid', 'crs transform height width')
+
+
+def prism_date(path):
+    """
+    (year, month, day) of a PRISM grid from its file name; month is None for annual
+    grids and day for annual and monthly ones.
+    """
+    match = prism_date_pattern.search(os.path.basename(path))
+    if match is None:
+        raise ValueError(f"Can't tell the year of {path}; pass years= explicitly")
+    year, month, day = match.groups()
+    return int(year), int(month) if month else None, int(day) if day else None
+
+
+def group_by_year(paths, years=None):
+    """
+    Group the time steps of a stack into years.
+
+    Parameters:
+    - paths: precipitation grids (annual, monthly or daily)
+    - years: year of each path, if the file names don't carry it
+
+    Returns:
+    - OrderedDict of year -> list of paths, sorted by year
+    """
+    if years is None:
+        dates = [prism_date(path) for path in paths]
+    else:
+        if len(years) != len(paths):
+            raise ValueError("years must have one entry per path")
+        dates = [(year, None, None) for year in years]
+
+    grouped = {}
+    for path, (year, month, day) in zip(paths, dates):
+        grouped.setdefault(year, []).append(((month, day), path))
+
+    stack = OrderedDict()
+    for year in sorted(grouped):
+        steps = [step for step, _ in grouped[year] if step != (None, None)]
+        if steps:
+            # Every grid of a year is summed, so a repeated or annual one would count twice
+            if len(steps) < len(grouped[year]):
+                raise ValueError(f"{year} mixes an annual grid with monthly or daily ones")
+            if len(set(steps)) < len(steps):
+                month, day = next(step for step in steps if steps.count(step) > 1)
+                date = f"{year}-{month:02d}" + (f"-{day:02d}" if day else "")
+                raise ValueError(f"{year} has more than one grid for {date}")
+            months = {month for month, _ in steps}
+            if len(months) < 12:
+                raise ValueError(f"{year} only has {len(months)} of 12 monthly grids")
+        stack[year] = [path for _, path in grouped[year]]
+    return stack
+
+
+def annual_erosivity_tile(paths, grid, window, resampling):
+    """
+    R factor of one year on one tile of the target grid.
+
+    The year's grids are added one at a time into a single float32 buffer, so
+    memory is one tile whatever the number of time steps. A pixel that is
+    nodata in any step is nodata in the result.
+
+    Parameters:
+    - paths: the year's precipitation grids (mm)
+    - grid: hashable grid key from grid_key
+    - window: (col_off, row_off, width, height) of the tile
+    - resampling: resampling used if a grid is not on the target grid
+
+    Returns:
+    - R tile as float32, with r_nodata where precipitation is missing
+    """
+    window_obj = Window(*window)
+    shape = (window[3], window[2])
+    total = np.zeros(shape, dtype=np.float32)
+    buffer = np.empty(shape, dtype=np.float32)
+
+    for path in paths:
+        src = open_on_grid(path, grid, resampling)
+        src.read(1, window=window_obj, out=buffer)
+        if src.nodata is not None:
+            buffer[buffer == src.nodata] = np.nan
+        total += buffer
+
+    # NaN marks the missing pixels, calculate_rainfall_erosivity turns them into r_nodata
+    return calculate_rainfall_erosivity(total, out=total, nodata=r_nodata)
+
+
+def erosivity_task(paths, grid, window, resampling, band, offset=(0, 0)):
+    """
+    Worker entry point: returns (window, band, R tile).
+
+    window is a tile of the output, which starts offset (col, row) pixels into grid.
+    """
+    col, row, width, height = window
+    return window, band, annual_erosivity_tile(paths, grid, (col + offset[0], row + offset[1], width, height),
+                                               resampling)
+
+
+@profiling.profiled('erosivity.series')
+def rainfall_erosivity_series(paths, output_path, years=None, bbox=None, grid=None, include_mean=True,
+                              tile_size=512, workers=None, resampling='bilinear'):
+    """
+    Computes per-year R-factor maps from a stack of annual or monthly PRISM precipitation grids.
+
+    The stack is never loaded: the target grid is split into tiles, and for
+    every (tile, year) a worker streams the year's grids through a running sum
+    of annual precipitation and converts it to R. Tasks run on a process pool
+    and a single writer puts each result into its band of a multi-band tiled
+    GeoTIFF, so memory is bounded by tile_size and the number of workers, not
+    by the number of time steps. The mean annual R over the series is kept as
+    a running sum per tile and written as an extra last band.
+
+    Parameters:
+    - paths: precipitation grids in mm, annual or monthly (all months of a year are needed)
+    - output_path: path of the GeoTIFF to write
+    - years: year of each path, if the file names aren't PRISM names
+    - bbox: (minx, miny, maxx, maxy) in EPSG:4326 to clip to (default: the whole grid)
+    - grid: target grid, as a raster path, an open dataset or a (crs, transform, (height, width))
+      tuple (default: the grid of the first path)
+    - include_mean: add a band with the mean annual R of the series
+    - tile_size: tile edge in pixels, rounded up to a multiple of the 256-pixel output blocks
+    - workers: number of worker processes (default: all cores; 1 runs in-process)
+    - resampling: resampling used for grids that are not on the target grid
+
+    Returns:
+    - (output_path, list of years, one per band before the mean band), or None if bbox is invalid
+    """
+    stack = group_by_year(paths, years)
+    if not stack:
+        raise ValueError("No precipitation grids given")
+
+    if bbox is not None and not within_conus(*bbox):
+        print("❌ Bounding box is outside the contiguous U.S.")
+        return None
+
+    if grid is None or isinstance(grid, str):
+        with rasterio.open(grid or paths[0]) as ref:
+            grid = raster_grid(ref)
+    else:
+        grid = raster_grid(grid)
+    # Tiles are read from the whole grid at an offset, so grids already on it are read
+    # as plain windows instead of being warped onto the clipped grid
+    key = grid_key(grid)
+    crs, transform, height, width = grid
+    offset = (0, 0)
+    if bbox is not None:
+        window = conus_window(Grid(*grid), *bbox)
+        offset = (int(window.col_off), int(window.row_off))
+        transform, height, width = window_transform(window, transform), int(window.height), int(window.width)
+
+    tile_size = -(-tile_size // 256) * 256
+    tiles = [(col, row, min(tile_size, width - col), min(tile_size, height - row))
+             for row in range(0, height, tile_size) for col in range(0, width, tile_size)]
+    year_list = list(stack)
+    # Tile-major order, so the years of a tile finish together and its running mean can be written
+    tasks = [(stack[year], key, tile, resampling, band, offset)
+             for tile in tiles for band, year in enumerate(year_list, start=1)]
+
+    profile = {
+        'driver': 'GTiff',
+        'dtype': 'float32',
+        'count': len(year_list) + include_mean,
+        'height': height,
+        'width': width,
+        'crs': crs,
+        'transform': transform,
+        'nodata': r_nodata
+    }
+
+    # tile -> [sum of valid R, number of valid years, years still to come]
+    running = {}
+
+    def write(window, band, R):
+        dest.write(R, band, window=Window(*window))
+        if not include_mean:
+            return
+        valid = R != r_nodata
+        acc = running.setdefault(window, [np.zeros(R.shape, dtype=np.float64),
+                                          np.zeros(R.shape, dtype=np.uint16), len(year_list)])
+        np.add(acc[0], R, out=acc[0], where=valid)
+        acc[1] += valid
+        acc[2] -= 1
+        if acc[2] == 0:
+            total, count, _ = running.pop(window)
+            mean = np.full(R.shape, r_nodata, dtype=np.float32)
+            np.divide(total, count, out=mean, where=count > 0, casting='unsafe')
+            dest.write(mean, len(year_list) + 1, window=Window(*window))
+
+    workers = workers or os.cpu_count() or 1
+    with open_cog(output_path, profile, blocksize=256) as dest:
+        for band, year in enumerate(year_list, start=1):
+            dest.set_band_description(band, str(year))
+        if include_mean:
+            dest.set_band_description(len(year_list) + 1, f"mean {year_list[0]}-{year_list[-1]}")
+
+        if workers == 1:
+            try:
+                for task in tasks:
+                    write(*erosivity_task(*task))
+            finally:
+                close_on_grid()
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                # Keep a couple of tasks per worker in flight so finished tiles don't pile up in memory
+                for result in bounded_map(pool, erosivity_task, tasks, 2 * workers):
+                    write(*result)
+
+    print(f"R_Factor series saved to {output_path}")
+    return output_path, year_list
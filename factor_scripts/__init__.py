@@ -0,0 +1,39 @@
+"""
+The RUSLE factors (R, K, LS, C), NDVI acquisition and the soil loss composer.
+
+The submodules pull in rasterio, numpy and (for the openEO fetches) openeo, so
+they are imported on first use of one of the names below rather than by
+`import factor_scripts`. Importing a submodule does no I/O.
+"""
+import importlib
+
+# Public name -> submodule that defines it
+_exports = {
+    'c_factor': 'C_Factor',
+    'fetch_NDVI_TERRASCOPE': 'C_Factor',
+    'k_factor': 'K_factor',
+    'ls_factor': 'LS_factor',
+    'calculate_rainfall_erosivity': 'R_factor',
+    'clip_bil_within_conus': 'R_factor',
+    'clip_raster_within_conus': 'R_factor',
+    'write_rainfall_erosivity_tiled': 'R_factor',
+    'rainfall_erosivity_series': 'R_timeseries',
+    'acquire_ndvi': 'ndvi_acquisition',
+    'ndvi_composite': 'ndvi_local',
+    'compose_soil_loss': 'rusle_composer',
+}
+
+__all__ = sorted(_exports)
+
+
+def __getattr__(name):
+    module = _exports.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(f"{__name__}.{module}"), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
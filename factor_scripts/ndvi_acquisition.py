@@ -0,0 +1,232 @@
+import asyncio
+import hashlib
+import json
+import math
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+
+import numpy as np
+import rasterio
+from rasterio.crs import CRS
+from rasterio.transform import from_origin
+from rasterio.warp import reproject, transform_bounds, Resampling
+from rasterio.windows import Window, from_bounds, transform as window_transform
+
+from raster_handling.cog import open_cog
+from raster_handling.rasterhandler import raster_grid
+
+
+def split_bbox(bbox, tile_degrees=1.0):
+    """
+    Splits a bounding box into a grid of tiles of at most tile_degrees on a side.
+
+    Parameters:
+    bbox (dict): A dictionary specifying the bounding box with keys 'west', 'south', 'east', 'north'.
+    tile_degrees (float): Maximum tile edge in degrees.
+
+    Returns:
+    list: Tile bounding boxes in the same format, row by row from the north-west corner.
+    """
+    cols = max(1, math.ceil((bbox['east'] - bbox['west']) / tile_degrees))
+    rows = max(1, math.ceil((bbox['north'] - bbox['south']) / tile_degrees))
+    xs = np.linspace(bbox['west'], bbox['east'], cols + 1)
+    ys = np.linspace(bbox['north'], bbox['south'], rows + 1)
+    return [{'west': float(xs[c]), 'south': float(ys[r + 1]), 'east': float(xs[c + 1]), 'north': float(ys[r])}
+            for r in range(rows) for c in range(cols)]
+
+
+def tile_name(bbox, datetime):
+    """
+    File name of a downloaded tile, derived from its bounding box and dates, so a
+    rerun with another extent, tiling or period never picks up a stale tile.
+    """
+    payload = json.dumps({'bbox': {k: float(v) for k, v in sorted(bbox.items())}, 'datetime': list(datetime)},
+                         sort_keys=True)
+    return f"ndvi_{hashlib.sha256(payload.encode()).hexdigest()[:24]}.tif"
+
+
+def default_fetch(bbox, datetime, output_path):
+    """Downloads one tile through fetch_NDVI_TERRASCOPE, using its shared connection and download cache."""
+    from factor_scripts.C_Factor import fetch_NDVI_TERRASCOPE
+    fetch_NDVI_TERRASCOPE(bbox, datetime, output_path)
+
+
+async def fetch_tile(fetch, bbox, datetime, output_path, semaphore, executor, retries=3, backoff=1.0):
+    """
+    Runs one blocking fetch in the executor, retrying with exponential backoff.
+
+    The file is downloaded to a temporary name and renamed into place, so a tile
+    that exists on disk is always complete and is not fetched again.
+
+    Returns:
+    str: output_path
+    """
+    if os.path.exists(output_path):
+        return output_path
+    loop = asyncio.get_running_loop()
+    tmp_path = f"{output_path}.part"
+    for attempt in range(retries + 1):
+        try:
+            async with semaphore:
+                await loop.run_in_executor(executor, fetch, bbox, datetime, tmp_path)
+            os.replace(tmp_path, output_path)
+            return output_path
+        except Exception as error:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            if attempt == retries:
+                raise
+            delay = backoff * 2 ** attempt
+            print(f"Fetching {bbox} failed ({error}), retrying in {delay:.1f} s")
+            # Sleep outside the semaphore so other tiles keep the slot busy
+            await asyncio.sleep(delay)
+
+
+def utm_zone(lon):
+    """Number of the 6-degree UTM zone of a longitude."""
+    return min(60, int((lon + 180) // 6) + 1)
+
+
+def is_utm(crs):
+    """Whether a CRS is a WGS 84 (EPSG:326xx/327xx) or NAD83 (EPSG:269xx) UTM zone."""
+    epsg = crs.to_epsg()
+    return epsg is not None and (32601 <= epsg <= 32760 or 26901 <= epsg <= 26923)
+
+
+def mosaic_grid(bbox, tile):
+    """
+    Builds the grid of the mosaic, covering the whole bounding box at about the
+    resolution of the first tile.
+
+    The mosaic takes the tile's CRS, unless that is a UTM zone and the bounding
+    box spans several zones: the other tiles then come in other zones and no
+    single one suits the whole extent, so the mosaic is in EPSG:4326 with the
+    tile's pixel size in degrees.
+
+    Returns:
+    tuple: (crs, transform, (height, width))
+    """
+    crs = tile.crs
+    xres, yres = tile.res
+    if is_utm(crs) and utm_zone(bbox['west']) != utm_zone(bbox['east']):
+        west, south, east, north = transform_bounds(crs, 'EPSG:4326', *tile.bounds, densify_pts=21)
+        crs = CRS.from_epsg(4326)
+        xres, yres = (east - west) / tile.width, (north - south) / tile.height
+    left, bottom, right, top = transform_bounds('EPSG:4326', crs, bbox['west'], bbox['south'],
+                                                bbox['east'], bbox['north'], densify_pts=21)
+    width = max(1, math.ceil((right - left) / xres))
+    height = max(1, math.ceil((top - bottom) / yres))
+    return crs, from_origin(left, top, xres, yres), (height, width)
+
+
+def add_to_mosaic(dest, tile_path, resampling=Resampling.nearest):
+    """
+    Warps one tile into the part of the mosaic it covers.
+
+    Only valid tile pixels are written, so tiles that overlap along their edges
+    don't blank each other out.
+    """
+    with rasterio.open(tile_path) as tile:
+        left, bottom, right, top = transform_bounds(tile.crs, dest.crs, *tile.bounds, densify_pts=21)
+        window = from_bounds(left, bottom, right, top, dest.transform)
+        window = window.round_offsets().round_lengths()
+        window = window.intersection(Window(0, 0, dest.width, dest.height))
+
+        mosaic = dest.read(1, window=window)
+        reproject(
+            source=rasterio.band(tile, 1),
+            destination=mosaic,
+            src_nodata=tile.nodata,
+            dst_transform=window_transform(window, dest.transform),
+            dst_crs=dest.crs,
+            dst_nodata=np.nan,
+            init_dest_nodata=False,
+            resampling=resampling
+        )
+        dest.write(mosaic, 1, window=window)
+
+
+async def acquire_ndvi_async(bbox, datetime, output_path, tile_degrees=1.0, concurrency=4, retries=3,
+                             backoff=1.0, fetch=None, tile_dir=None, grid=None):
+    """
+    Fetches NDVI for a large extent as concurrent tile downloads and mosaics them as they arrive.
+
+    At most `concurrency` fetches are in flight at a time. Each finished tile is
+    written to tile_dir and warped into the mosaic straight away, so the mosaic
+    grows while the remaining tiles are still downloading; it is written out as
+    a Cloud-Optimized GeoTIFF once the last tile is in. Tiles are named after
+    their own bounding box and dates (see tile_name), so tiles already in
+    tile_dir are reused only for the same request and an interrupted run can be
+    restarted; the mosaic is rebuilt from them on every run, whatever its grid.
+
+    Parameters:
+    bbox (dict): A dictionary specifying the bounding box with keys 'west', 'south', 'east', 'north'.
+    datetime (list): A list containing the start and end date strings.
+    output_path (str): Path of the NDVI mosaic GeoTIFF.
+    tile_degrees (float): Maximum tile edge in degrees.
+    concurrency (int): Maximum number of fetches in flight.
+    retries (int): Retries per tile before giving up.
+    backoff (float): Delay before the first retry in seconds, doubled on each further retry.
+    fetch (callable): Blocking function (bbox, datetime, output_path) that downloads one tile.
+        Defaults to fetch_NDVI_TERRASCOPE; pass a stand-in to run against a local backend.
+    tile_dir (str): Directory for the downloaded tiles (default: a folder next to output_path).
+    grid: Grid of the mosaic, as an open dataset or a (crs, transform, (height, width)) tuple.
+        Defaults to the CRS and resolution of the first tile that arrives, or EPSG:4326
+        if the extent spans several UTM zones (see mosaic_grid).
+
+    Returns:
+    str: output_path
+    """
+    fetch = fetch or default_fetch
+    tile_dir = tile_dir or f"{os.path.splitext(output_path)[0]}_tiles"
+    os.makedirs(tile_dir, exist_ok=True)
+
+    tiles = split_bbox(bbox, tile_degrees)
+    semaphore = asyncio.Semaphore(concurrency)
+    loop = asyncio.get_running_loop()
+    dest = None
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor, ExitStack() as stack:
+        tasks = [
+            asyncio.ensure_future(fetch_tile(fetch, tile, datetime, os.path.join(tile_dir, tile_name(tile, datetime)),
+                                             semaphore, executor, retries, backoff))
+            for tile in tiles
+        ]
+        try:
+            for done, next_task in enumerate(asyncio.as_completed(tasks), start=1):
+                tile_path = await next_task
+                if dest is None:
+                    if grid is None:
+                        with rasterio.open(tile_path) as first:
+                            grid = mosaic_grid(bbox, first)
+                    crs, transform, height, width = raster_grid(grid)
+                    profile = {'dtype': 'float32', 'count': 1, 'height': height, 'width': width,
+                               'crs': crs, 'transform': transform, 'nodata': np.nan}
+                    # The mosaic is built in a temporary file and becomes a COG once complete
+                    dest = stack.enter_context(open_cog(output_path, profile, mode='w+'))
+                # Mosaicking is done off the event loop, one tile at a time
+                await loop.run_in_executor(None, add_to_mosaic, dest, tile_path)
+                print(f"NDVI tile {done}/{len(tiles)} added to {output_path}")
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+    print(f"NDVI data saved to {output_path}")
+    return output_path
+
+
+def acquire_ndvi(bbox, datetime, output_path, **kwargs):
+    """
+    Synchronous wrapper around acquire_ndvi_async, taking the same arguments.
+    """
+    return asyncio.run(acquire_ndvi_async(bbox, datetime, output_path, **kwargs))
+
+
+if __name__ == "__main__":
+    conus = {'west': -125, 'south': 24, 'east': -66.5, 'north': 49}
+    acquire_ndvi(conus, ["2022-05-01", "2022-05-30"],
+                 os.path.join(tempfile.gettempdir(), "ndvi_conus.tif"), tile_degrees=2.0, concurrency=8)
@@ -0,0 +1,158 @@
+from contextlib import ExitStack
+
+import numpy as np
+import rasterio
+
+from raster_handling.cog import open_cog
+from raster_handling.rasterhandler import align_raster_obj, block_windows, grid_key, raster_grid
+
+# Sentinel-2 scene classification (SCL) classes that are not clear land or water:
+# 0 no data, 1 saturated/defective, 3 cloud shadow, 8 cloud medium probability,
+# 9 cloud high probability, 10 thin cirrus, 11 snow/ice
+scl_invalid = (0, 1, 3, 8, 9, 10, 11)
+
+ndvi_nodata = np.nan
+
+
+def scl_mask_table(invalid=scl_invalid):
+    """Lookup table mapping an SCL class to True when the pixel is usable."""
+    table = np.ones(256, dtype=bool)
+    table[list(invalid)] = False
+    return table
+
+
+def open_band(stack, path, key, resampling):
+    """Opens a band file and, if it is not on the grid of key (e.g. a 20 m band), a lazy view that is."""
+    src = stack.enter_context(rasterio.open(path))
+    if grid_key(raster_grid(src)) == key:
+        return src
+    crs, transform, height, width = key
+    grid = (crs, rasterio.Affine(*transform), (height, width))
+    return stack.enter_context(align_raster_obj(src, grid, resampling, lazy=True))
+
+
+def read_reflectance(band, window, out, offset):
+    """Reads a window of digital numbers into a float32 buffer and applies the radiometric offset."""
+    band.read(1, window=window, out=out, out_dtype='float32')
+    if band.nodata is not None:
+        out[out == band.nodata] = np.nan
+    if offset:
+        out += np.float32(offset)
+    return out
+
+
+def ndvi_into(red, nir, out):
+    """
+    Computes (nir - red) / (nir + red) into out, using nir as scratch space.
+    Pixels with a negative reflectance or a zero sum come out as NaN, so the result stays in [-1, 1].
+    """
+    # NaN compares False, so nodata pixels are invalid too
+    valid = (red >= 0) & (nir >= 0)
+    np.subtract(nir, red, out=out)
+    np.add(nir, red, out=nir)
+    valid &= nir > 0
+    np.divide(out, nir, out=out, where=valid)
+    out[~valid] = np.nan
+    return np.clip(out, -1, 1, out=out)
+
+
+def ndvi_composite(scenes, output_path, composite='max', nir_band='B08', offset=0,
+                   scl_invalid=scl_invalid, tile_size=512, reference=None):
+    """
+    Computes a per-pixel NDVI composite from local Sentinel-2 band files and saves it as a TIFF.
+
+    This is the local counterpart of ndvi_generation / fetch_NDVI_TERRASCOPE. The
+    scenes are read window by window, NDVI is computed in float32 buffers that are
+    allocated once, cloudy pixels are masked with the SCL band, and each window
+    keeps a running max (or sum and count for the mean) over the scenes, so memory
+    depends on tile_size and not on the number of scenes.
+
+    Parameters:
+    scenes (list): One dict per date with the paths of 'B04', the NIR band ('B08' or 'B8A')
+        and optionally 'SCL'. Bands on a different grid (20 m B8A and SCL) are warped onto
+        the reference grid on the fly, bilinear for reflectances and nearest for SCL.
+    output_path (str): Path of the NDVI GeoTIFF (float32, NaN nodata).
+    composite (str): 'max' or 'mean' over the clear observations of each pixel.
+    nir_band (str): Key of the NIR band in the scene dicts.
+    offset (float): Added to the digital numbers before the ratio, e.g. -1000 for
+        products of processing baseline 04.00 and later. The 0.0001 scale cancels out.
+    scl_invalid (tuple): SCL classes to mask out.
+    tile_size (int): Approximate tile edge in pixels.
+    reference: Raster path or open dataset whose grid the output uses; defaults to
+        the B04 band of the first scene.
+
+    Returns:
+    str: output_path
+    """
+    if composite not in ('max', 'mean'):
+        raise ValueError(f"Unknown composite {composite!r}, expected 'max' or 'mean'")
+    if not scenes:
+        raise ValueError("No scenes given")
+    clear_table = scl_mask_table(scl_invalid)
+
+    with ExitStack() as stack:
+        if reference is None:
+            reference = stack.enter_context(rasterio.open(scenes[0]['B04']))
+        elif isinstance(reference, str):
+            reference = stack.enter_context(rasterio.open(reference))
+        crs, transform, height, width = raster_grid(reference)
+        key = grid_key((crs, transform, height, width))
+
+        bands = []
+        for scene in scenes:
+            red = open_band(stack, scene['B04'], key, 'bilinear')
+            nir = open_band(stack, scene[nir_band], key, 'bilinear')
+            scl = open_band(stack, scene['SCL'], key, 'nearest') if scene.get('SCL') else None
+            bands.append((red, nir, scl))
+
+        windows = list(block_windows(reference, tile_size=tile_size))
+        tile_h = max(int(w.height) for w in windows)
+        tile_w = max(int(w.width) for w in windows)
+
+        # Buffers for the largest window; smaller edge windows use views into them
+        red_buf = np.empty((tile_h, tile_w), dtype=np.float32)
+        nir_buf = np.empty_like(red_buf)
+        ndvi_buf = np.empty_like(red_buf)
+        acc_buf = np.empty_like(red_buf)
+        count_buf = np.empty((tile_h, tile_w), dtype=np.uint16)
+        scl_buf = np.empty((tile_h, tile_w), dtype=np.uint8)
+
+        profile = {
+            'driver': 'GTiff',
+            'dtype': 'float32',
+            'count': 1,
+            'height': height,
+            'width': width,
+            'crs': crs,
+            'transform': transform,
+            'nodata': ndvi_nodata
+        }
+        with open_cog(output_path, profile) as dest:
+            for window in windows:
+                h, w = int(window.height), int(window.width)
+                red, nir, ndvi = red_buf[:h, :w], nir_buf[:h, :w], ndvi_buf[:h, :w]
+                acc, count, scl = acc_buf[:h, :w], count_buf[:h, :w], scl_buf[:h, :w]
+                acc.fill(-np.inf if composite == 'max' else 0)
+                count.fill(0)
+
+                for red_src, nir_src, scl_src in bands:
+                    read_reflectance(red_src, window, red, offset)
+                    read_reflectance(nir_src, window, nir, offset)
+                    ndvi_into(red, nir, ndvi)
+                    clear = ~np.isnan(ndvi)
+                    if scl_src is not None:
+                        scl_src.read(1, window=window, out=scl, out_dtype='uint8')
+                        clear &= clear_table[scl]
+                    if composite == 'max':
+                        np.maximum(acc, ndvi, out=acc, where=clear)
+                    else:
+                        np.add(acc, ndvi, out=acc, where=clear)
+                    count += clear
+
+                if composite == 'mean':
+                    np.divide(acc, count, out=acc, where=count > 0)
+                acc[count == 0] = ndvi_nodata
+                dest.write(acc, 1, window=window)
+
+    print(f"NDVI data saved to {output_path}")
+    return output_path
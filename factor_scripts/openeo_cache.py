@@ -0,0 +1,171 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+# openEO backend used by the fetch functions
+backend_url = "openeofed.dataspace.copernicus.eu"
+
+# One authenticated connection per (process, backend)
+_connections = {}
+_connections_lock = threading.Lock()
+
+
+def get_connection(url=backend_url, connect=None):
+    """
+    Returns an authenticated openEO connection, reusing it for the life of the process.
+
+    Connections are shared per backend and per connect factory, so a stand-in
+    passed after the real backend was used gets its own connection.
+
+    Parameters:
+    url (str): The openEO backend.
+    connect (callable): Factory taking the url and returning a connection; defaults to
+        openeo.connect followed by authenticate_oidc(). Pass a stand-in to run
+        without network access.
+
+    Returns:
+    openeo.Connection: The shared connection.
+    """
+    key = (os.getpid(), url, connect)
+    with _connections_lock:
+        if key not in _connections:
+            if connect is None:
+                # Imported here: openeo is slow to import and only needed once a fetch happens
+                import openeo
+
+                connection = openeo.connect(url)
+                connection.authenticate_oidc()
+            else:
+                connection = connect(url)
+            _connections[key] = connection
+        return _connections[key]
+
+
+def cache_key(collection, bands, bbox, temporal_extent, process_graph=None):
+    """
+    Hashes everything that determines a download into a cache key.
+
+    Parameters:
+    collection (str): The openEO collection id.
+    bands (list): Band names.
+    bbox (dict): Spatial extent with keys 'west', 'south', 'east', 'north'.
+    temporal_extent (list): Start and end date strings.
+    process_graph: The processing applied to the cube, as its process graph or a fixed
+        description, so the key can be built before connecting.
+
+    Returns:
+    str: Hex digest identifying the download.
+    """
+    graph_hash = hashlib.sha256(json.dumps(process_graph, sort_keys=True, default=str).encode()).hexdigest()
+    payload = {
+        'collection': collection,
+        'bands': list(bands),
+        'bbox': {k: float(v) for k, v in sorted(bbox.items())},
+        'temporal_extent': list(temporal_extent),
+        'graph': graph_hash,
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+class DownloadCache:
+    """
+    On-disk, content-addressed cache of downloaded GeoTIFFs with size-bounded LRU eviction.
+
+    Files are stored as <key>.tif; a file's modification time is bumped on every
+    hit and the least recently used files are removed once the cache grows past
+    max_bytes.
+    """
+
+    def __init__(self, cache_dir, max_bytes=5 * 2**30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.tif")
+
+    def get(self, key):
+        """
+        Returns the cached file for key, or None on a miss.
+        """
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, key, file_path):
+        """
+        Moves a downloaded file into the cache and evicts old entries if needed.
+
+        Returns:
+        str: Path of the cached file.
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self.path(key)
+        os.replace(file_path, path)
+        self.evict(keep=path)
+        return path
+
+    def evict(self, keep=None):
+        """Removes least recently used files, other than keep, until the cache fits in max_bytes."""
+        with self._lock:
+            entries = []
+            for entry in os.scandir(self.cache_dir):
+                if entry.name.endswith('.tif') and not entry.name.startswith('.'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                if path == keep:
+                    continue
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+    def fetch(self, key, download, output_path):
+        """
+        Places the file for key at output_path, downloading it only on a miss.
+
+        Parameters:
+        key (str): Cache key from cache_key.
+        download (callable): Called with a temporary path to download to on a miss.
+        output_path (str): Where the caller wants the file.
+
+        Returns:
+        bool: True on a cache hit.
+        """
+        cached = self.get(key)
+        hit = cached is not None
+        if not hit:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(suffix='.tif', dir=self.cache_dir, prefix='.download-')
+            os.close(fd)
+            try:
+                download(tmp_path)
+                cached = self.put(key, tmp_path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+        # A copy rather than a link, so editing output_path in place can't change the cached file
+        tmp_output = f"{output_path}.{os.getpid()}.{threading.get_ident()}.part"
+        try:
+            shutil.copyfile(cached, tmp_output)
+            os.replace(tmp_output, output_path)
+        finally:
+            if os.path.exists(tmp_output):
+                os.remove(tmp_output)
+        return hit
+
+
+# Shared by the fetch functions
+download_cache = DownloadCache(os.path.join(tempfile.gettempdir(), "soil_erosion", "openeo_cache"))
@@ -0,0 +1,134 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import rasterio
+from rasterio.windows import Window, transform as window_transform
+
+from raster_handling import profiling
+from raster_handling.cog import open_cog
+from raster_handling.rasterhandler import bounded_map, close_on_grid, grid_key, open_on_grid, raster_grid, read_float32
+
+# The RUSLE factors, in the order they appear in A = R × K × LS × C × P
+factor_names = ('R', 'K', 'LS', 'C', 'P')
+
+# Nodata value of the soil loss output
+soil_loss_nodata = -9999.0
+
+
+def compose_tile(factors, grid, window, resampling):
+    """
+    Computes soil loss for one tile of the target grid.
+
+    Every factor's window is read into the same scratch buffer (decoding
+    quantized factors) and multiplied into the result in place. Pixels where
+    any factor is nodata come out as nodata.
+
+    Parameters:
+    factors (list): (name, factor) pairs; a factor is a raster path, a number, or a
+        callable taking (window, transform, crs) and returning the tile on the target grid.
+    grid (tuple): Hashable grid key from grid_key.
+    window (tuple): (col_off, row_off, width, height) of the tile.
+    resampling (str): Resampling used to align raster factors.
+
+    Returns:
+    tuple: (window, soil loss tile as float32)
+    """
+    crs, transform, _, _ = grid
+    window_obj = Window(*window)
+    tile_transform = window_transform(window_obj, rasterio.Affine(*transform))
+    shape = (window[3], window[2])
+
+    soil_loss = np.ones(shape, dtype=np.float32)
+    valid = np.ones(shape, dtype=bool)
+    buffer = np.empty(shape, dtype=np.float32)
+
+    for name, factor in factors:
+        if isinstance(factor, (int, float, np.number)):
+            soil_loss *= np.float32(factor)
+            continue
+        if callable(factor):
+            np.copyto(buffer, factor(window_obj, tile_transform, crs), casting='unsafe')
+        else:
+            # Quantized factors are decoded here, one tile at a time; nodata comes out as NaN
+            read_float32(open_on_grid(factor, grid, resampling), 1, window_obj, out=buffer)
+        valid &= ~np.isnan(buffer)
+        np.multiply(soil_loss, buffer, out=soil_loss)
+
+    soil_loss[~valid] = soil_loss_nodata
+    return window, soil_loss
+
+
+@profiling.profiled('compose')
+def compose_soil_loss(output_path, R=None, K=None, LS=None, C=None, P=None, grid=None,
+                      tile_size=512, workers=None, resampling='bilinear'):
+    """
+    Combines the RUSLE factors into soil loss, A = R × K × LS × C × P, in t/ha/yr.
+
+    The factors are snapped to one target grid, and the grid is split into tiles
+    that run on a process pool. Each worker reads every factor's window for its
+    tile, multiplies them in place and hands the tile back to be written into a
+    tiled GeoTIFF, so memory is bounded by tile_size and the number of workers.
+
+    Parameters:
+    output_path (str): Path of the soil loss GeoTIFF to write.
+    R, K, LS, C, P: Each factor is a raster path, a constant, a callable taking
+        (window, transform, crs) and returning that tile on the target grid (it must be
+        a module-level function so it can be sent to the workers), or None.
+        Missing factors default to 1.0, so the composer works with only R and C.
+    grid: Target grid, as a raster path, an open dataset or a
+        (crs, transform, (height, width)) tuple. Defaults to the grid of the first raster factor.
+    tile_size (int): Tile edge in pixels, rounded up to a multiple of the 256-pixel output blocks.
+    workers (int): Number of worker processes (default: all cores; 1 runs in-process).
+    resampling (str): Resampling used to align raster factors to the grid.
+
+    Returns:
+    str: output_path
+    """
+    given = [(name, factor) for name, factor in zip(factor_names, (R, K, LS, C, P)) if factor is not None]
+
+    if grid is None:
+        grid = next((factor for _, factor in given if isinstance(factor, str)), None)
+        if grid is None:
+            raise ValueError("A target grid is needed when no factor is given as a raster path")
+    if isinstance(grid, str):
+        with rasterio.open(grid) as ref:
+            grid = raster_grid(ref)
+    else:
+        grid = raster_grid(grid)
+    key = grid_key(grid)
+    crs, transform, height, width = grid
+
+    tile_size = -(-tile_size // 256) * 256
+    tiles = [(col, row, min(tile_size, width - col), min(tile_size, height - row))
+             for row in range(0, height, tile_size) for col in range(0, width, tile_size)]
+
+    profile = {
+        'driver': 'GTiff',
+        'dtype': 'float32',
+        'count': 1,
+        'height': height,
+        'width': width,
+        'crs': crs,
+        'transform': transform,
+        'nodata': soil_loss_nodata
+    }
+
+    workers = workers or os.cpu_count() or 1
+    with open_cog(output_path, profile, blocksize=256) as dest:
+        if workers == 1:
+            try:
+                for tile in tiles:
+                    window, soil_loss = compose_tile(given, key, tile, resampling)
+                    dest.write(soil_loss, 1, window=Window(*window))
+            finally:
+                close_on_grid()
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                # Keep a couple of tiles per worker in flight so finished tiles don't pile up in memory
+                jobs = ((given, key, tile, resampling) for tile in tiles)
+                for window, soil_loss in bounded_map(pool, compose_tile, jobs, 2 * workers):
+                    dest.write(soil_loss, 1, window=Window(*window))
+
+    print(f"Soil loss saved to {output_path}")
+    return output_path
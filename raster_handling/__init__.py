@@ -0,0 +1,45 @@
+"""
+Raster I/O shared by the factor scripts and the web app: COG writing, grid
+alignment, tiling, zonal statistics and the PRISM .bil reader.
+
+The submodules pull in rasterio, shapely and PIL, so they are imported on first
+use of one of the names below rather than by `import raster_handling`.
+"""
+import importlib
+
+# Public name -> submodule that defines it
+_exports = {
+    'BilRaster': 'bilreader',
+    'open_bil': 'bilreader',
+    'cog_profile': 'cog',
+    'open_cog': 'cog',
+    'write_cog': 'cog',
+    'TileManifest': 'manifest',
+    'quantizer': 'quantize',
+    'align_raster_obj': 'rasterhandler',
+    'block_windows': 'rasterhandler',
+    'dataset_cache': 'rasterhandler',
+    'raster_grid': 'rasterhandler',
+    'read_float32': 'rasterhandler',
+    'TileCache': 'tiles',
+    'build_overviews': 'tiles',
+    'render_tile': 'tiles',
+    'aggregate_by_zones': 'zonal',
+    'build_summed_area_table': 'zonal',
+    'zonal_stats': 'zonal',
+}
+
+__all__ = sorted(_exports)
+
+
+def __getattr__(name):
+    module = _exports.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(f"{__name__}.{module}"), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
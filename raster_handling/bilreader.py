@@ -0,0 +1,156 @@
+import os
+
+import numpy as np
+from rasterio.crs import CRS
+from rasterio.transform import Affine
+from rasterio.windows import Window, transform as window_transform
+
+# PIXELTYPE keyword of the .hdr to numpy kind
+pixel_kinds = {'FLOAT': 'f', 'SIGNEDINT': 'i', 'UNSIGNEDINT': 'u'}
+
+
+def read_header(hdr_path):
+    """
+    Parse an ESRI .hdr file (one "KEYWORD value" pair per line) into a dict with upper-case keys.
+    """
+    header = {}
+    with open(hdr_path) as f:
+        for line in f:
+            parts = line.split(None, 1)
+            if len(parts) == 2:
+                header[parts[0].upper()] = parts[1].strip()
+    return header
+
+
+def sidecar(path, extension):
+    """Path of the file next to path with another extension (e.g. the .hdr of a .bil), or None."""
+    stem = os.path.splitext(path)[0]
+    for candidate in (stem + extension, stem + extension.upper()):
+        if os.path.exists(candidate):
+            return candidate
+    return None
+
+
+class BilRaster:
+    """
+    A raw .bil/.bsq/.bip raster (e.g. PRISM) exposed as a read-only memory map.
+
+    Nothing is decoded or copied when the file is opened or clipped: read()
+    returns a numpy view into the page cache, so a clip costs a slice and pages
+    are only loaded from disk when the view's pixels are touched. The object has
+    the crs, transform, width, height, nodata and meta attributes of a rasterio
+    dataset, so window helpers written for rasterio work on it.
+
+    Parameters:
+    - path: path of the data file (.bil) or of its .hdr
+    """
+
+    def __init__(self, path):
+        data_path = path
+        if path.lower().endswith('.hdr'):
+            data_path = next((p for p in (sidecar(path, ext) for ext in ('.bil', '.bsq', '.bip')) if p), None)
+            if data_path is None:
+                raise FileNotFoundError(f"No data file next to {path}")
+        hdr_path = sidecar(data_path, '.hdr')
+        if hdr_path is None:
+            raise FileNotFoundError(f"No .hdr file next to {data_path}")
+        header = read_header(hdr_path)
+
+        self.name = data_path
+        self.height = int(header['NROWS'])
+        self.width = int(header['NCOLS'])
+        self.count = int(header.get('NBANDS', 1))
+        nbits = int(header.get('NBITS', 8))
+        kind = pixel_kinds.get(header.get('PIXELTYPE', '').upper(), 'f' if nbits > 32 else 'u')
+        byteorder = '>' if header.get('BYTEORDER', 'I').upper() in ('M', 'MOTOROLA') else '<'
+        self.dtype = np.dtype(f"{byteorder}{kind}{nbits // 8}")
+        self.nodata = float(header['NODATA']) if 'NODATA' in header else None
+
+        # ULXMAP/ULYMAP are the center of the upper-left pixel, the transform wants its corner
+        xdim = float(header.get('XDIM', 1))
+        ydim = float(header.get('YDIM', 1))
+        ulx = float(header.get('ULXMAP', xdim / 2)) - xdim / 2
+        uly = float(header.get('ULYMAP', self.height * ydim - ydim / 2)) + ydim / 2
+        self.transform = Affine(xdim, 0, ulx, 0, -ydim, uly)
+
+        prj_path = sidecar(data_path, '.prj')
+        if prj_path is not None:
+            with open(prj_path) as f:
+                self.crs = CRS.from_wkt(f.read())
+        else:
+            self.crs = CRS.from_epsg(4326)
+
+        self._buffer = np.memmap(data_path, dtype=np.uint8, mode='r')
+        self._bands = self._band_view(header)
+
+    def _band_view(self, header):
+        """(count, height, width) strided view of the mapped bytes, honoring the layout's row and band gaps."""
+        item = self.dtype.itemsize
+        skip = int(header.get('SKIPBYTES', 0))
+        layout = header.get('LAYOUT', 'BIL').upper()
+        if layout == 'BIP':
+            row_bytes = int(header.get('TOTALROWBYTES', self.width * self.count * item))
+            strides = (item, row_bytes, self.count * item)
+        elif layout == 'BSQ':
+            row_bytes = int(header.get('BANDROWBYTES', self.width * item))
+            band_bytes = self.height * row_bytes + int(header.get('BANDGAPBYTES', 0))
+            strides = (band_bytes, row_bytes, item)
+        else:
+            band_row_bytes = int(header.get('BANDROWBYTES', self.width * item))
+            row_bytes = int(header.get('TOTALROWBYTES', self.count * band_row_bytes))
+            strides = (band_row_bytes, row_bytes, item)
+        shape = (self.count, self.height, self.width)
+        end = skip + sum((n - 1) * s for n, s in zip(shape, strides)) + item
+        if end > len(self._buffer):
+            raise ValueError(f"{self.name} is smaller than its header describes")
+        bands = np.ndarray(shape, dtype=self.dtype, buffer=self._buffer, offset=skip, strides=strides)
+        bands.setflags(write=False)
+        return bands
+
+    @property
+    def bounds(self):
+        left, top = self.transform * (0, 0)
+        right, bottom = self.transform * (self.width, self.height)
+        return left, bottom, right, top
+
+    @property
+    def meta(self):
+        return {
+            'driver': 'EHdr', 'dtype': self.dtype.name, 'nodata': self.nodata, 'width': self.width,
+            'height': self.height, 'count': self.count, 'crs': self.crs, 'transform': self.transform
+        }
+
+    def window_transform(self, window):
+        return window_transform(window, self.transform)
+
+    def read(self, band=1, window=None):
+        """
+        Zero-copy view of a band, or of a window of it.
+
+        Parameters:
+        - band: 1-based band index
+        - window: rasterio Window with whole-pixel offsets (default: the whole band)
+
+        Returns:
+        - read-only ndarray view (copy it to modify or to keep it past close())
+        """
+        data = self._bands[band - 1]
+        if window is None:
+            return data
+        rows, cols = Window(*(int(v) for v in window.flatten())).toslices()
+        return data[rows, cols]
+
+    def close(self):
+        """Drop the memory map; views handed out keep it alive until they are released."""
+        self._bands = self._buffer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_bil(path):
+    """Open a raw .bil raster as a BilRaster."""
+    return BilRaster(path)
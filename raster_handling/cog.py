@@ -0,0 +1,172 @@
+import os
+from contextlib import contextmanager
+
+import numpy as np
+import rasterio
+import rasterio.shutil
+from rasterio.dtypes import in_dtype_range
+from rasterio.io import MemoryFile
+
+# Options that describe the source file layout and must not leak into the output
+layout_keys = ('blockxsize', 'blockysize', 'tiled', 'compress', 'predictor', 'interleave',
+               'zstd_level', 'zlevel', 'photometric', 'bigtiff')
+
+# Compression methods known to work with this GDAL build, filled on first use
+_codecs = {}
+
+
+def codec_available(compress):
+    """
+    Check whether GDAL was built with a compression method, by writing a one-pixel file.
+    """
+    compress = compress.lower()
+    if compress not in _codecs:
+        try:
+            with MemoryFile() as memfile:
+                with memfile.open(driver='GTiff', width=1, height=1, count=1, dtype='uint8',
+                                  transform=rasterio.Affine(1, 0, 0, 0, -1, 1), compress=compress) as dataset:
+                    dataset.write(np.zeros((1, 1, 1), dtype='uint8'))
+                # GDAL only warns about unknown methods and writes the file uncompressed
+                with memfile.open() as dataset:
+                    _codecs[compress] = dataset.compression is not None
+        except Exception:
+            _codecs[compress] = False
+    return _codecs[compress]
+
+
+def pick_codec(compress):
+    """Return compress if available, else DEFLATE, which every GDAL build has."""
+    return compress if codec_available(compress) else 'deflate'
+
+
+def tiled_profile(profile, blocksize=256):
+    """
+    Copy of a profile with a tiled, uncompressed GeoTIFF layout, for in-memory outputs.
+    """
+    out = {k: v for k, v in profile.items() if k.lower() not in layout_keys}
+    out.update({'driver': 'GTiff', 'tiled': True, 'blockxsize': blocksize, 'blockysize': blocksize})
+    return out
+
+
+def cog_profile(profile, blocksize=512, compress='zstd', nodata=None):
+    """
+    Copy of a profile with the tiled, compressed layout shared by all factor outputs.
+
+    A floating-point predictor is used for float data and a horizontal one for
+    integers, which typically halves the compressed size of smooth factor grids.
+
+    Parameters:
+    - profile: rasterio profile or meta of the output (dtype, count, width, height, crs, transform, nodata)
+    - blocksize: internal tile edge in pixels, a multiple of 16
+    - compress: 'zstd', 'deflate', 'lzw', ...; falls back to DEFLATE if GDAL lacks it
+    - nodata: nodata value, overriding the one in profile
+
+    Returns:
+    - profile dict for rasterio.open(..., 'w')
+    """
+    if blocksize % 16:
+        raise ValueError(f"blocksize must be a multiple of 16, got {blocksize}")
+    out = {k: v for k, v in profile.items() if k.lower() not in layout_keys}
+    if nodata is not None:
+        out['nodata'] = nodata
+    dtype = np.dtype(out['dtype'])
+    if out.get('nodata') is not None and not np.isnan(out['nodata']) and not in_dtype_range(out['nodata'], dtype):
+        raise ValueError(f"nodata {out['nodata']} does not fit in {dtype}")
+    out.update({
+        'driver': 'GTiff',
+        'tiled': True,
+        'blockxsize': blocksize,
+        'blockysize': blocksize,
+        'compress': pick_codec(compress),
+        'predictor': 3 if dtype.kind == 'f' else 2,
+        'bigtiff': 'IF_SAFER'
+    })
+    return out
+
+
+def copy_to_cog(src_path, output_path, blocksize=512, compress='zstd', overview_resampling='average'):
+    """
+    Rewrite a raster as a Cloud-Optimized GeoTIFF with GDAL's COG driver.
+
+    Parameters:
+    - src_path: raster to copy, ideally a tiled GeoTIFF with the same blocksize
+    - output_path: path of the COG
+    - blocksize: internal tile edge in pixels
+    - compress: compression method, falls back to DEFLATE if GDAL lacks it
+    - overview_resampling: GDAL resampling name for the overviews
+    """
+    rasterio.shutil.copy(
+        src_path, output_path, driver='COG',
+        blocksize=blocksize,
+        compress=pick_codec(compress).upper(),
+        predictor='YES',
+        overviews='AUTO',
+        overview_resampling=overview_resampling.upper(),
+        bigtiff='IF_SAFER',
+        num_threads='ALL_CPUS'
+    )
+
+
+@contextmanager
+def open_cog(output_path, profile, blocksize=512, compress='zstd', nodata=None,
+             overview_resampling='average', mode='w', summed_area_table=False):
+    """
+    Open a Cloud-Optimized GeoTIFF for writing.
+
+    The caller writes into a tiled GeoTIFF next to output_path (window by window
+    if it likes). When the with block ends, the file is rewritten with GDAL's COG
+    driver, which adds internal overviews and puts them and the tile index at the
+    front of the file, and the temporary file is removed. If the block raises,
+    nothing is written to output_path.
+
+    Parameters:
+    - output_path: path of the COG
+    - profile: rasterio profile or meta of the output
+    - blocksize: internal tile edge in pixels
+    - compress: 'zstd' (default), 'deflate', 'lzw', ...
+    - nodata: nodata value, overriding the one in profile
+    - overview_resampling: GDAL resampling name for the overviews ('average', 'nearest', ...)
+    - mode: 'w', or 'w+' if the caller also reads back what it wrote
+    - summed_area_table: also build the summed-area table of the first band next to
+      the output (see raster_handling.zonal); 16 bytes per pixel, so only for layers
+      whose rectangle statistics are served
+
+    Yields:
+    - writable rasterio dataset
+    """
+    profile = cog_profile(profile, blocksize, compress, nodata)
+    directory, name = os.path.split(os.path.abspath(output_path))
+    tmp_path = os.path.join(directory, f".{name}.{os.getpid()}.tmp.tif")
+    try:
+        with rasterio.open(tmp_path, mode, **profile) as dataset:
+            yield dataset
+        copy_to_cog(tmp_path, output_path, blocksize, profile['compress'], overview_resampling)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    if summed_area_table:
+        # Imported here because zonal builds on this module
+        from raster_handling.zonal import build_summed_area_table
+        build_summed_area_table(output_path, force=True)
+
+
+def write_cog(output_path, data, profile, **kwargs):
+    """
+    Write a whole array as a Cloud-Optimized GeoTIFF.
+
+    Parameters:
+    - output_path: path of the COG
+    - data: array of shape (count, height, width) or (height, width)
+    - profile: rasterio profile or meta of the output
+    - kwargs: passed to open_cog
+
+    Returns:
+    - output_path
+    """
+    data = np.asarray(data)
+    if data.ndim == 2:
+        data = data[np.newaxis]
+    profile = dict(profile, count=data.shape[0], height=data.shape[1], width=data.shape[2])
+    with open_cog(output_path, profile, **kwargs) as dataset:
+        dataset.write(data)
+    return output_path
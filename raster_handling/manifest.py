@@ -0,0 +1,227 @@
+import hashlib
+import json
+import os
+import sqlite3
+
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+from raster_handling.cog import copy_to_cog, cog_profile, tiled_profile
+from raster_handling.quantize import set_scaling
+from raster_handling.zonal import build_summed_area_table
+
+schema = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS tiles (
+    col INTEGER, row INTEGER, width INTEGER, height INTEGER,
+    stamp TEXT, signature TEXT,
+    PRIMARY KEY (col, row, width, height)
+);
+CREATE TABLE IF NOT EXISTS memo (key TEXT PRIMARY KEY, stamp TEXT, value TEXT);
+"""
+
+
+def file_stamp(paths):
+    """
+    Cheap fingerprint of input files (size and modification time), to tell
+    without reading them whether they changed since a tile was built.
+    """
+    parts = []
+    for path in paths:
+        stat = os.stat(path)
+        parts.append(f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}")
+    return hashlib.blake2b('|'.join(parts).encode(), digest_size=16).hexdigest()
+
+
+def params_digest(params):
+    return hashlib.blake2b(json.dumps(params, sort_keys=True, default=str).encode(), digest_size=16).hexdigest()
+
+
+def tile_signature(arrays):
+    """Digest of the input pixels a tile is computed from."""
+    digest = hashlib.blake2b(digest_size=16)
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        digest.update(f"{array.dtype.str}{array.shape}".encode())
+        digest.update(array.data)
+    return digest.hexdigest()
+
+
+class TileManifest:
+    """
+    Build manifest of a raster output computed tile by tile.
+
+    It is a small sqlite3 database next to the output that records, for every
+    output tile, the parameters it was built with, a stamp of its input files
+    (size and mtime) and a digest of the input pixels it was computed from. A
+    rerun then skips a tile without reading anything if its inputs' stamps are
+    unchanged, and when a file did change it only recomputes the tiles whose
+    input pixels differ. The tiles live in an uncompressed tiled working GeoTIFF
+    next to the output, which is re-exported as a COG only when a tile changed.
+
+    Tiles are recorded in batches, each after its pixels are flushed to disk, so
+    an interrupted run resumes from the last finished batch.
+
+    The working GeoTIFF (output_path + '.work.tif', the uncompressed size of the
+    output) and the manifest stay next to the output between runs, since that
+    is what lets a rerun rewrite only the changed tiles. Call discard() once no
+    more reruns are expected; the next build then starts over.
+
+    Parameters:
+    - output_path: path of the COG the manifest belongs to
+    """
+
+    def __init__(self, output_path):
+        self.output_path = output_path
+        self.work_path = f"{output_path}.work.tif"
+        self.path = f"{output_path}.manifest.sqlite"
+        self.db = sqlite3.connect(self.path)
+        self.db.executescript(schema)
+
+    def close(self):
+        self.db.close()
+
+    def discard(self):
+        """Close the manifest and delete it and the working GeoTIFF, keeping the output."""
+        self.close()
+        for path in (self.work_path, self.path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _meta(self, key):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def _set_meta(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, value))
+
+    def memo(self, key, inputs, compute):
+        """
+        Value derived from whole input files (e.g. a global min/max), recomputed only when they change.
+
+        Parameters:
+        - key: name of the value
+        - inputs: paths the value depends on
+        - compute: function returning a JSON-serializable value
+
+        Returns:
+        - the value
+        """
+        stamp = file_stamp(inputs)
+        row = self.db.execute("SELECT stamp, value FROM memo WHERE key = ?", (key,)).fetchone()
+        if row is not None and row[0] == stamp:
+            return json.loads(row[1])
+        value = compute()
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO memo VALUES (?, ?, ?)", (key, stamp, json.dumps(value)))
+        return value
+
+    def build(self, profile, tiles, inputs, read, compute, params=None, blocksize=512, compress='zstd',
+              overview_resampling='average', flush_every=16, quantizer=None, summed_area_table=False):
+        """
+        Bring the output up to date, recomputing only the tiles whose inputs changed.
+
+        Parameters:
+        - profile: rasterio profile of the output (dtype, count, width, height, crs, transform, nodata)
+        - tiles: output Windows covering the grid, e.g. from output_tiles or the source
+          blocks (see block_windows) shifted to the output; the same tiles on every run
+        - inputs: paths of the input files
+        - read: function taking an output window and returning the input arrays it depends on
+        - compute: function taking (window, arrays) and returning the output tile, (height, width)
+          or (count, height, width); it may work in place on the arrays
+        - params: JSON-serializable parameters of the computation; changing them rebuilds every tile
+        - blocksize, compress, overview_resampling: COG layout, see open_cog
+        - flush_every: number of rebuilt tiles between flushes to disk
+        - quantizer: Quantizer whose scale/offset to record if compute returns codes
+        - summed_area_table: keep the summed-area table of the output up to date, see open_cog
+
+        Returns:
+        - dict with the number of tiles 'skipped' (stamps unchanged), 'verified' (inputs
+          read, pixels unchanged) and 'rebuilt'
+        """
+        profile = cog_profile(profile, blocksize, compress)
+        digest = params_digest([params, quantizer, {k: v for k, v in profile.items() if k != 'compress'}])
+        if self._meta('params') != digest or not os.path.exists(self.work_path):
+            # New parameters or grid, or the working file is gone: start over
+            with self.db:
+                self.db.execute("DELETE FROM tiles")
+                self._set_meta('params', digest)
+                self._set_meta('output', None)
+            # Uncompressed, so rewriting a tile reuses its blocks instead of appending new ones
+            with rasterio.open(self.work_path, 'w', **tiled_profile(profile, blocksize)) as work:
+                if quantizer is not None:
+                    set_scaling(work, quantizer)
+
+        stamp = file_stamp(inputs)
+        known = {tuple(row[:4]): row[4:] for row in self.db.execute("SELECT * FROM tiles")}
+        counts = {'skipped': 0, 'verified': 0, 'rebuilt': 0}
+        pending = []
+
+        dest = None
+        try:
+            for window in tiles:
+                key = tuple(int(v) for v in (window.col_off, window.row_off, window.width, window.height))
+                old_stamp, old_signature = known.get(key, (None, None))
+                if old_stamp == stamp:
+                    counts['skipped'] += 1
+                    continue
+                arrays = read(window)
+                signature = tile_signature(arrays)
+                if signature == old_signature:
+                    counts['verified'] += 1
+                    pending.append((*key, stamp, signature))
+                    continue
+
+                if dest is None:
+                    dest = rasterio.open(self.work_path, 'r+')
+                tile = np.asarray(compute(window, arrays))
+                dest.write(tile.astype(profile['dtype'], copy=False), window=window,
+                           indexes=1 if tile.ndim == 2 else None)
+                counts['rebuilt'] += 1
+                pending.append((*key, stamp, signature))
+
+                if counts['rebuilt'] % flush_every == 0:
+                    dest.close()
+                    dest = None
+                    self._record(pending)
+                    pending = []
+        finally:
+            if dest is not None:
+                dest.close()
+            # Everything written so far is on disk now
+            self._record(pending)
+
+        output_stamp = file_stamp([self.output_path]) if os.path.exists(self.output_path) else None
+        if counts['rebuilt'] or output_stamp is None or self._meta('output') != output_stamp:
+            tmp_path = f"{self.output_path}.{os.getpid()}.tmp.tif"
+            try:
+                copy_to_cog(self.work_path, tmp_path, blocksize, compress, overview_resampling)
+                os.replace(tmp_path, self.output_path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            with self.db:
+                self._set_meta('output', file_stamp([self.output_path]))
+        if summed_area_table:
+            # Rebuilt only if it is older than the output
+            build_summed_area_table(self.output_path)
+        return counts
+
+    def _record(self, rows):
+        if rows:
+            with self.db:
+                self.db.executemany("INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+
+def output_tiles(height, width, tile_size=512, blocksize=512):
+    """Windows covering a height x width grid, with edges on multiples of blocksize."""
+    tile_size = -(-tile_size // blocksize) * blocksize
+    return [Window(col, row, min(tile_size, width - col), min(tile_size, height - row))
+            for row in range(0, height, tile_size) for col in range(0, width, tile_size)]
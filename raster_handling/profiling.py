@@ -0,0 +1,314 @@
+"""
+Stage-level profiling: timed spans around GDAL reads, warps, NumPy math and encoding.
+
+A span records its duration and the bytes read, bytes written and arrays
+allocated inside it (counted where the code reports them, see read/wrote/
+allocated). Finished spans are logged as one JSON line each on the
+'soil_erosion.profiling' logger and added up in `metrics`, which the web app
+serves in the Prometheus text format.
+
+Profiling is off unless the SOIL_EROSION_PROFILE environment variable is set to
+something other than 0, or enable() is called; while it is off, span() returns
+a shared no-op object and profiled functions call straight through, so leaving
+the spans in hot code costs a flag check. Only the standard library is imported.
+"""
+import functools
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger('soil_erosion.profiling')
+
+# Upper bounds of the duration histogram buckets, in seconds
+buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_enabled = os.environ.get('SOIL_EROSION_PROFILE', '0') not in ('', '0')
+
+# Open spans of each thread, innermost last
+_local = threading.local()
+
+
+def enabled():
+    return _enabled
+
+
+def enable(on=True):
+    """Turn profiling on (or off with on=False) for this process."""
+    global _enabled
+    _enabled = bool(on)
+
+
+def _nbytes(value):
+    return value if isinstance(value, int) else value.nbytes
+
+
+class _NullSpan:
+    """What span() returns while profiling is off."""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def read(self, value):
+        pass
+
+    def wrote(self, value):
+        pass
+
+    def allocated(self, value):
+        pass
+
+    def annotate(self, **fields):
+        pass
+
+
+_null_span = _NullSpan()
+
+
+class Span:
+    """
+    One timed stage. Use it through span() or profiled().
+
+    Bytes and allocations are counted on the span they are reported to; the
+    spans around it only get its duration.
+    """
+
+    __slots__ = ('name', 'fields', 'parent', 'start', 'bytes_read', 'bytes_written', 'allocations',
+                 'allocated_bytes')
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+        self.parent = None
+        self.start = None
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.allocations = 0
+        self.allocated_bytes = 0
+
+    def __enter__(self):
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        self.parent = stack[-1].name if stack else None
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self.start
+        stack = _local.stack
+        if stack and stack[-1] is self:
+            stack.pop()
+        failed = exc_type is not None
+        metrics.record(self, seconds, failed)
+        if logger.isEnabledFor(logging.INFO):
+            record = {
+                'span': self.name, 'parent': self.parent, 'seconds': round(seconds, 6),
+                'bytes_read': self.bytes_read, 'bytes_written': self.bytes_written,
+                'allocations': self.allocations, 'allocated_bytes': self.allocated_bytes,
+                'error': failed, 'pid': os.getpid(), **self.fields
+            }
+            logger.info(json.dumps(record, default=str), extra={'span': record})
+        return False
+
+    def read(self, value):
+        """Count bytes read: an int, or an array (its nbytes)."""
+        self.bytes_read += _nbytes(value)
+
+    def wrote(self, value):
+        """Count bytes written: an int, or an array (its nbytes)."""
+        self.bytes_written += _nbytes(value)
+
+    def allocated(self, value):
+        """Count an array allocation: the array, or its size in bytes."""
+        self.allocations += 1
+        self.allocated_bytes += _nbytes(value)
+
+    def annotate(self, **fields):
+        """Add values to the span's log line."""
+        self.fields.update(fields)
+
+
+def span(name, **fields):
+    """
+    Context manager timing a stage:
+
+        with profiling.span('tile.encode_png', z=z) as s:
+            png = encode(rgba)
+            s.wrote(len(png))
+
+    Parameters:
+    - name: stage name, the 'span' label of the metrics
+    - fields: extra values for the log line only (not metric labels)
+    """
+    if not _enabled:
+        return _null_span
+    return Span(name, fields)
+
+
+def current():
+    """Innermost open span of this thread, or a no-op one."""
+    stack = getattr(_local, 'stack', None) if _enabled else None
+    return stack[-1] if stack else _null_span
+
+
+def read(value):
+    """Count bytes read on the innermost open span, if any."""
+    if _enabled:
+        current().read(value)
+
+
+def wrote(value):
+    """Count bytes written on the innermost open span, if any."""
+    if _enabled:
+        current().wrote(value)
+
+
+def allocated(value):
+    """Count an array allocation on the innermost open span, if any."""
+    if _enabled:
+        current().allocated(value)
+
+
+def profiled(name=None):
+    """
+    Decorator running every call of a function in a span.
+
+    Parameters:
+    - name: span name (default: the function's module and name, e.g. 'R_factor.clip_raster_within_conus')
+    """
+    def decorate(fn):
+        label = name or f"{fn.__module__.rsplit('.', 1)[-1]}.{fn.__qualname__}"
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+            with Span(label, {}):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+class Metrics:
+    """
+    Totals of the finished spans of a process, per span name.
+
+    Worker processes send theirs back with their results (see run_collecting)
+    and the parent merges them, so one /metrics endpoint covers the pool.
+    """
+
+    # Counter fields, after the count, the duration sum and the histogram
+    counters = ('errors', 'bytes_read', 'bytes_written', 'allocations', 'allocated_bytes')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._spans = {}
+
+    def _entry(self, name):
+        entry = self._spans.get(name)
+        if entry is None:
+            entry = self._spans[name] = {'count': 0, 'seconds': 0.0, 'buckets': [0] * len(buckets),
+                                         **dict.fromkeys(self.counters, 0)}
+        return entry
+
+    def record(self, span, seconds, failed=False):
+        with self._lock:
+            entry = self._entry(span.name)
+            entry['count'] += 1
+            entry['seconds'] += seconds
+            for i, bound in enumerate(buckets):
+                if seconds <= bound:
+                    entry['buckets'][i] += 1
+                    break
+            entry['errors'] += failed
+            entry['bytes_read'] += span.bytes_read
+            entry['bytes_written'] += span.bytes_written
+            entry['allocations'] += span.allocations
+            entry['allocated_bytes'] += span.allocated_bytes
+
+    def snapshot(self):
+        """Copy of the totals as plain, picklable dicts."""
+        with self._lock:
+            return {name: dict(entry, buckets=list(entry['buckets'])) for name, entry in self._spans.items()}
+
+    def merge(self, snapshot):
+        """Add totals from snapshot() of another process."""
+        with self._lock:
+            for name, other in snapshot.items():
+                entry = self._entry(name)
+                entry['count'] += other['count']
+                entry['seconds'] += other['seconds']
+                entry['buckets'] = [a + b for a, b in zip(entry['buckets'], other['buckets'])]
+                for key in self.counters:
+                    entry[key] += other[key]
+
+    def reset(self):
+        with self._lock:
+            self._spans.clear()
+
+    def prometheus(self, prefix='soil_erosion'):
+        """The totals in the Prometheus text exposition format (version 0.0.4)."""
+        spans = self.snapshot()
+        lines = [
+            f"# HELP {prefix}_profiling_enabled Whether stage profiling is on in this process.",
+            f"# TYPE {prefix}_profiling_enabled gauge",
+            f"{prefix}_profiling_enabled {int(_enabled)}",
+            f"# HELP {prefix}_span_seconds Time spent in each instrumented stage.",
+            f"# TYPE {prefix}_span_seconds histogram",
+        ]
+        for name, entry in sorted(spans.items()):
+            label = _label(name)
+            cumulative = 0
+            for bound, count in zip(buckets, entry['buckets']):
+                cumulative += count
+                lines.append(f'{prefix}_span_seconds_bucket{{span="{label}",le="{bound}"}} {cumulative}')
+            lines.append(f'{prefix}_span_seconds_bucket{{span="{label}",le="+Inf"}} {entry["count"]}')
+            lines.append(f'{prefix}_span_seconds_sum{{span="{label}"}} {entry["seconds"]:.6f}')
+            lines.append(f'{prefix}_span_seconds_count{{span="{label}"}} {entry["count"]}')
+        descriptions = {
+            'errors': "Stage runs that raised an exception.",
+            'bytes_read': "Bytes read by each stage.",
+            'bytes_written': "Bytes written by each stage.",
+            'allocations': "Arrays allocated by each stage.",
+            'allocated_bytes': "Bytes of the arrays allocated by each stage.",
+        }
+        for key in self.counters:
+            lines.append(f"# HELP {prefix}_span_{key}_total {descriptions[key]}")
+            lines.append(f"# TYPE {prefix}_span_{key}_total counter")
+            for name, entry in sorted(spans.items()):
+                lines.append(f'{prefix}_span_{key}_total{{span="{_label(name)}"}} {entry[key]}')
+        return '\n'.join(lines) + '\n'
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# Totals of this process
+metrics = Metrics()
+
+
+def run_collecting(profile, fn, *args):
+    """
+    Run fn(*args) in a worker process and return (result, metrics snapshot of the call).
+
+    Parameters:
+    - profile: whether profiling is on in the parent (enable() doesn't reach spawned workers)
+    - fn, args: the job
+    """
+    enable(profile)
+    # A forked worker inherits the open spans of the thread that started it
+    _local.stack = []
+    if not profile:
+        return fn(*args), {}
+    metrics.reset()
+    result = fn(*args)
+    return result, metrics.snapshot()
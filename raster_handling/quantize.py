@@ -0,0 +1,119 @@
+from collections import namedtuple
+
+import numpy as np
+
+# Largest code of each storage type; the one above it is nodata
+code_max = {'uint8': 254, 'uint16': 65534}
+
+
+class Quantizer(namedtuple('Quantizer', 'dtype scale offset nodata')):
+    """
+    Linear quantization of a factor into unsigned integer codes: value = code * scale + offset.
+
+    The scale and offset are stored as the band's GDAL scale/offset, so GDAL,
+    QGIS and decode() all read the codes back as physical values. The largest
+    code of the type is reserved for nodata.
+    """
+
+    @property
+    def max_error(self):
+        """Largest difference between a value inside the range and its decoded code."""
+        return self.scale / 2
+
+    def profile(self, profile):
+        """Copy of a rasterio profile for writing the codes."""
+        return dict(profile, dtype=self.dtype, nodata=self.nodata)
+
+    def encode(self, values, nodata=None, out=None):
+        """
+        Quantize float values to codes; NaN and nodata become the code nodata.
+
+        Values outside the range are clipped to it.
+
+        Parameters:
+        - values: float array
+        - nodata: nodata value of values
+        - out: array of self.dtype to write the codes into
+
+        Returns:
+        - array of codes
+        """
+        values = np.asarray(values)
+        invalid = np.isnan(values)
+        if nodata is not None:
+            invalid |= values == nodata
+        scaled = np.subtract(values, self.offset, dtype=np.float32)
+        scaled /= self.scale
+        np.rint(scaled, out=scaled)
+        np.clip(scaled, 0, code_max[self.dtype], out=scaled)
+        scaled[invalid] = self.nodata
+        if out is None:
+            return scaled.astype(self.dtype)
+        np.copyto(out, scaled, casting='unsafe')
+        return out
+
+    def decode(self, codes, nodata=np.nan, out=None):
+        """
+        Codes back to float32 values; the code nodata becomes nodata.
+
+        Parameters:
+        - codes: array of codes
+        - nodata: float value for nodata pixels
+        - out: float32 array to decode into (may be codes itself if it is float32)
+
+        Returns:
+        - float32 array
+        """
+        return decode(codes, self.scale, self.offset, self.nodata, nodata, out)
+
+
+def quantizer(dtype, vmin, vmax):
+    """
+    Quantizer spreading [vmin, vmax] over the codes of dtype ('uint8' or 'uint16').
+    """
+    dtype = np.dtype(dtype).name
+    if dtype not in code_max:
+        raise ValueError(f"Quantized storage is uint8 or uint16, got {dtype}")
+    if not np.isfinite(vmin) or not np.isfinite(vmax) or vmax < vmin:
+        raise ValueError(f"Invalid range [{vmin}, {vmax}]")
+    scale = (vmax - vmin) / code_max[dtype] if vmax > vmin else 1.0
+    return Quantizer(dtype, float(scale), float(vmin), code_max[dtype] + 1)
+
+
+def decode(codes, scale, offset, code_nodata=None, nodata=np.nan, out=None):
+    """
+    Apply a band's scale/offset to codes, as float32, block by block if the caller reads that way.
+
+    Parameters:
+    - codes: array read from the band (any numeric dtype)
+    - scale, offset: the band's scale and offset
+    - code_nodata: nodata value of the band
+    - nodata: float value for nodata pixels
+    - out: float32 array to decode into (may be codes itself if it is float32)
+
+    Returns:
+    - float32 array
+    """
+    invalid = None if code_nodata is None else codes == code_nodata
+    out = np.multiply(codes, np.float32(scale), out=out, dtype=np.float32, casting='unsafe')
+    out += np.float32(offset)
+    if invalid is not None:
+        out[invalid] = nodata
+    return out
+
+
+def set_scaling(dataset, quant, band=1):
+    """Record a Quantizer's scale and offset on a band of a dataset open for writing."""
+    scales, offsets = list(dataset.scales), list(dataset.offsets)
+    scales[band - 1], offsets[band - 1] = quant.scale, quant.offset
+    dataset.scales, dataset.offsets = scales, offsets
+    dataset.update_tags(band, QUANTIZED=quant.dtype)
+
+
+def copy_scaling(src, dataset):
+    """Record the scales and offsets of src's bands (quantized storage or not) on a dataset open for writing."""
+    dataset.scales, dataset.offsets = src.scales, src.offsets
+    for band in range(1, src.count + 1):
+        quantized = src.tags(band).get('QUANTIZED')
+        if quantized:
+            dataset.update_tags(band, QUANTIZED=quantized)
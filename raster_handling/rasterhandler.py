@@ -1,18 +1,283 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, as_completed, wait
+from contextlib import contextmanager
+
+import numpy as np
 import rasterio
-from rasterio.warp import calculate_default_transform, reproject
+from rasterio.transform import array_bounds
+from rasterio.warp import calculate_default_transform, reproject, transform_bounds
 from rasterio.enums import Resampling
 from rasterio.io import MemoryFile
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import Window
+
+from raster_handling import profiling
+from raster_handling.cog import tiled_profile
+from raster_handling.quantize import copy_scaling, decode
+
+class _Handle:
+    """An open dataset of a DatasetCache, with the lock its readers hold and how many are in."""
+
+    __slots__ = ('dataset', 'lock', 'users', 'evicted')
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+        # Reentrant, so a thread already reading the dataset can open it again
+        self.lock = threading.RLock()
+        self.users = 0
+        self.evicted = False
+
+
+class DatasetCache:
+    """
+    Bounded LRU cache of open rasterio datasets that can be shared between threads.
+
+    A rasterio dataset must not be read from two threads at once, so each handle
+    carries its own lock and is only handed out through the open() context manager.
+    Once more than maxsize are open the least recently used handle is evicted; it
+    is closed right away if nobody is reading it, otherwise by its last reader.
+    """
+
+    def __init__(self, maxsize=16):
+        self.maxsize = maxsize
+        # Guards the entries and the handles' users/evicted; never held while opening, closing or reading
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    @contextmanager
+    def open(self, path, overview_level=None):
+        """
+        Yield the open dataset for path, opening it on first use.
+
+        Parameters:
+        - path: path of the raster file
+        - overview_level: open this overview of the file instead of full resolution
+
+        Yields:
+        - rasterio DatasetReader object, locked for the duration of the with block
+        """
+        key = (path, overview_level)
+        with self._lock:
+            handle = self._entries.get(key)
+            if handle is not None:
+                self._entries.move_to_end(key)
+                handle.users += 1
+
+        if handle is None:
+            options = {} if overview_level is None else {'overview_level': overview_level}
+            dataset = rasterio.open(path, **options)
+            to_close = []
+            with self._lock:
+                handle = self._entries.get(key)
+                if handle is None:
+                    handle = self._entries[key] = _Handle(dataset)
+                    while len(self._entries) > self.maxsize:
+                        to_close.extend(self._evict(self._entries.popitem(last=False)[1]))
+                else:
+                    # Another thread opened it meanwhile
+                    self._entries.move_to_end(key)
+                    to_close.append(dataset)
+                handle.users += 1
+            for stale in to_close:
+                stale.close()
+
+        try:
+            with handle.lock:
+                yield handle.dataset
+        finally:
+            with self._lock:
+                handle.users -= 1
+                close = handle.evicted and handle.users == 0
+            if close:
+                handle.dataset.close()
+
+    def _evict(self, handle):
+        """Mark a handle removed from the entries; returns its dataset if it can be closed now."""
+        handle.evicted = True
+        return [handle.dataset] if handle.users == 0 else []
 
-def reproject_raster_obj(raster, dst_crs='EPSG:4269', resampling=Resampling.nearest):
+    def close(self):
+        """Close every cached dataset (those in use when their readers are done)."""
+        with self._lock:
+            to_close = [dataset for handle in self._entries.values() for dataset in self._evict(handle)]
+            self._entries.clear()
+        for dataset in to_close:
+            dataset.close()
+
+
+# Shared by every caller in the process
+dataset_cache = DatasetCache()
+
+
+def block_windows(raster, window=None, tile_size=512):
+    """
+    Split a window of a raster into tiles that line up with the raster's internal blocks.
+
+    Tile edges are rounded up to whole blocks (a striped file with one-row blocks
+    gets full-width strips of about tile_size rows), and tiles are cut on the
+    dataset's block grid so no source block is decoded twice.
+
+    Parameters:
+    - raster: rasterio DatasetReader object
+    - window: rasterio Window to cover (default: the whole raster)
+    - tile_size: approximate tile edge in pixels
+
+    Yields:
+    - rasterio Window objects in row-major order, clipped to window
+    """
+    if window is None:
+        window = Window(0, 0, raster.width, raster.height)
+    block_height, block_width = raster.block_shapes[0]
+    tile_height = -(-tile_size // block_height) * block_height
+    tile_width = -(-tile_size // block_width) * block_width
+
+    row_start, col_start = int(window.row_off), int(window.col_off)
+    row_stop, col_stop = row_start + int(window.height), col_start + int(window.width)
+
+    # Snap the first tile back onto the block grid, then step a whole tile at a time
+    for row in range(row_start - row_start % tile_height, row_stop, tile_height):
+        row0, row1 = max(row, row_start), min(row + tile_height, row_stop)
+        for col in range(col_start - col_start % tile_width, col_stop, tile_width):
+            col0, col1 = max(col, col_start), min(col + tile_width, col_stop)
+            yield Window(col0, row0, col1 - col0, row1 - row0)
+
+
+def bounded_map(pool, fn, jobs, in_flight):
+    """
+    Run fn(*job) for every job on a process pool, keeping at most in_flight
+    submitted at once, so finished results don't pile up in memory when the
+    caller writes them out as they come.
+
+    Parameters:
+    - pool: concurrent.futures executor
+    - fn: module-level function
+    - jobs: iterable of argument tuples
+    - in_flight: largest number of submitted, unconsumed jobs
+
+    Yields:
+    - the results, in completion order
+    """
+    pending = set()
+    for job in jobs:
+        pending.add(pool.submit(fn, *job))
+        if len(pending) >= in_flight:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    for future in as_completed(pending):
+        yield future.result()
+
+
+def read_float32(dataset, band=1, window=None, out=None, nodata=np.nan):
+    """
+    Read a band as float32, decoding quantized storage (see raster_handling.quantize).
+
+    A band with a scale/offset holds integer codes: they are read straight into
+    the float32 buffer and scaled there, so a window is decoded only when it is
+    read and no full-size copy is made. Nodata pixels come out as nodata, for
+    plain and quantized bands alike.
+
+    Parameters:
+    - dataset: rasterio dataset or WarpedVRT
+    - band: 1-based band index
+    - window: rasterio Window (default: the whole band)
+    - out: float32 array of the window's shape to read into
+    - nodata: float value for nodata pixels
+
+    Returns:
+    - float32 array (out, if given)
+    """
+    if out is None:
+        height, width = (dataset.height, dataset.width) if window is None else (int(window.height), int(window.width))
+        out = np.empty((height, width), dtype=np.float32)
+        profiling.allocated(out)
+    dataset.read(band, window=window, out=out)
+    profiling.read(out)
+    src_nodata = dataset.nodatavals[band - 1]
+    scale, offset = dataset.scales[band - 1], dataset.offsets[band - 1]
+    if scale != 1 or offset != 0:
+        return decode(out, scale, offset, src_nodata, nodata, out=out)
+    if src_nodata is not None and not np.isnan(src_nodata):
+        out[out == np.float32(src_nodata)] = nodata
+    elif not np.isnan(nodata):
+        out[np.isnan(out)] = nodata
+    return out
+
+
+def merge_windows(windows, max_growth=1.25):
+    """
+    Group overlapping windows so the pixels they share can be read once.
+
+    Windows are swept in row order and a window joins an overlapping group only
+    if the group's bounding window stays at most max_growth times the summed
+    area of its windows, so a chain of slightly overlapping windows never turns
+    into one read much larger than its parts. Merged windows may still overlap.
+
+    Parameters:
+    - windows: int array of shape (N, 4) holding col_off, row_off, width, height
+    - max_growth: largest ratio of a merged window's area to the summed area of its windows
+
+    Returns:
+    - labels: int array of shape (N,), index of the merged window for each input
+    - merged: int array of shape (M, 4) of merged windows, same layout as windows
+    """
+    windows = np.asarray(windows, dtype=np.int64).reshape(-1, 4)
+    labels = np.empty(len(windows), dtype=np.int64)
+    boxes = []  # [col0, row0, col1, row1, summed area of the windows in it]
+    active = []  # boxes that later windows (starting at or below this row) can still overlap
+
+    for i in np.lexsort((windows[:, 0], windows[:, 1])):
+        col0, row0, width, height = (int(v) for v in windows[i])
+        col1, row1, area = col0 + width, row0 + height, width * height
+        active = [b for b in active if boxes[b][3] > row0]
+        label = None
+        for b in active:
+            c0, r0, c1, r1, parts = boxes[b]
+            if not (col0 < c1 and c0 < col1 and row0 < r1 and r0 < row1):
+                continue
+            union = [min(c0, col0), min(r0, row0), max(c1, col1), max(r1, row1)]
+            if (union[2] - union[0]) * (union[3] - union[1]) <= max_growth * (parts + area):
+                boxes[b] = union + [parts + area]
+                label = b
+                break
+        if label is None:
+            label = len(boxes)
+            boxes.append([col0, row0, col1, row1, area])
+            active.append(label)
+        labels[i] = label
+
+    boxes = np.array(boxes, dtype=np.int64).reshape(-1, 5)[:, :4]
+    return labels, np.column_stack([boxes[:, :2], boxes[:, 2:] - boxes[:, :2]])
+
+
+@profiling.profiled('reproject')
+def reproject_raster_obj(raster, dst_crs='EPSG:4269', resampling=Resampling.nearest,
+                         lazy=False, num_threads=1, warp_mem_limit=0):
     """
     Reproject a rasterio DatasetReader object to a target CRS (default NAD83).
     
     Returns a new rasterio DatasetReader object in memory.
+
+    Parameters:
+    - raster: rasterio DatasetReader object
+    - dst_crs: target CRS
+    - resampling: Resampling enum (default nearest)
+    - lazy: return a WarpedVRT that reprojects only the windows the caller reads,
+      instead of warping the whole raster up front. raster must stay open while
+      the VRT is in use; close the VRT when done.
+    - num_threads: number of GDAL warp threads, in both modes
+    - warp_mem_limit: GDAL warp working memory in MB (0 uses the GDAL default), in both modes
     """
     transform, width, height = calculate_default_transform(
         raster.crs, dst_crs, raster.width, raster.height, *raster.bounds)
 
-    kwargs = raster.meta.copy()
+    if lazy:
+        return WarpedVRT(raster, crs=dst_crs, transform=transform, width=width, height=height,
+                         resampling=resampling, warp_mem_limit=warp_mem_limit, NUM_THREADS=num_threads)
+
+    # Tiled rather than the source's layout, so windowed reads of the result stay cheap
+    kwargs = tiled_profile(raster.meta)
     kwargs.update({
         'crs': dst_crs,
         'transform': transform,
@@ -21,31 +286,30 @@ def reproject_raster_obj(raster, dst_crs='EPSG:4269', resampling=Resampling.near
     })
 
     memfile = MemoryFile()
-    with memfile.open(**kwargs) as dst:
-        for i in range(1, raster.count + 1):
-            reproject(
-                source=rasterio.band(raster, i),
-                destination=rasterio.band(dst, i),
-                src_transform=raster.transform,
-                src_crs=raster.crs,
-                dst_transform=transform,
-                dst_crs=dst_crs,
-                resampling=resampling
-            )
+    with memfile.open(**kwargs) as dst, profiling.span('reproject.warp', threads=num_threads) as span:
+        # The profile doesn't carry them, and quantized codes would otherwise read as values
+        copy_scaling(raster, dst)
+        # Warp all bands in one pass so GDAL chunks the work once
+        bands = list(range(1, raster.count + 1))
+        reproject(
+            source=rasterio.band(raster, bands),
+            destination=rasterio.band(dst, bands),
+            src_transform=raster.transform,
+            src_crs=raster.crs,
+            dst_transform=transform,
+            dst_crs=dst_crs,
+            resampling=resampling,
+            num_threads=num_threads,
+            warp_mem_limit=warp_mem_limit
+        )
+        span.wrote(dst.count * width * height * np.dtype(dst.dtypes[0]).itemsize)
     return memfile.open()
 
 
-def resample_raster_obj(src_raster, reference_raster, resampling='bilinear'):
+def resampling_method(resampling):
     """
-    Resample one raster (src_raster) to match the resolution and transform of another (reference_raster).
-    
-    Parameters:
-    - src_raster: rasterio DatasetReader object (the one to resample)
-    - reference_raster: rasterio DatasetReader object (defines target resolution/transform)
-    - resampling: str or Resampling enum (default 'bilinear')
-
-    Returns:
-    - rasterio DatasetReader object (in memory, resampled)
+    Turn a resampling name ('nearest', 'bilinear', ...) into a Resampling enum.
+    Enums are passed through; unknown names fall back to bilinear.
     """
     # allow string or enum
     resampling_methods = {
@@ -58,20 +322,198 @@ def resample_raster_obj(src_raster, reference_raster, resampling='bilinear'):
     }
     if isinstance(resampling, str):
         resampling = resampling_methods.get(resampling.lower(), Resampling.bilinear)
+    return resampling
+
+
+def raster_grid(reference):
+    """
+    Describe a target pixel grid.
+
+    Parameters:
+    - reference: rasterio dataset, or a (crs, transform, (height, width)) tuple
+
+    Returns:
+    - (crs, transform, height, width)
+    """
+    if isinstance(reference, tuple):
+        crs, transform, (height, width) = reference
+        return crs, transform, height, width
+    return reference.crs, reference.transform, reference.height, reference.width
+
+
+def warp_scale(src_raster, grid):
+    """
+    Destination pixels per source pixel along x and y, over the whole target grid.
+
+    Parameters:
+    - src_raster: rasterio dataset
+    - grid: (crs, transform, height, width) of the target
+
+    Returns:
+    - (xscale, yscale), below 1 when downsampling
+    """
+    crs, transform, height, width = grid
+    left, bottom, right, top = transform_bounds(crs, src_raster.crs, *array_bounds(height, width, transform))
+    xres, yres = src_raster.res
+    return width / max((right - left) / xres, 1e-12), height / max((top - bottom) / yres, 1e-12)
+
+
+def fill_value(src_raster):
+    """
+    Value align_raster_obj gives pixels without source data by default: the source
+    nodata or, for a source without one, NaN for float data and the largest value
+    of the type for integers.
+    """
+    if src_raster.nodata is not None:
+        return src_raster.nodata
+    dtype = np.dtype(src_raster.dtypes[0])
+    return np.nan if dtype.kind == 'f' else np.iinfo(dtype).max
+
+
+def align_raster_obj(src_raster, reference, resampling='bilinear', lazy=False, tile_size=None, nodata=None,
+                     tolerance=0.125):
+    """
+    Resample src_raster onto the exact pixel grid of a reference (CRS, transform and shape).
+
+    Only the part of the source that intersects the reference footprint is read;
+    reference pixels outside the source come out as nodata. The result is
+    pixel-aligned with the reference, so factors aligned to the same grid can be
+    multiplied element-wise.
+
+    Parameters:
+    - src_raster: rasterio DatasetReader object (the one to resample)
+    - reference: rasterio dataset or (crs, transform, (height, width)) tuple defining the grid
+    - resampling: str or Resampling enum (default 'bilinear')
+    - lazy: return a WarpedVRT on the reference grid that resamples only the
+      windows the caller reads (src_raster must stay open while it is in use)
+    - tile_size: if given, fill the array one tile of this size at a time to
+      bound GDAL's warp memory
+    - nodata: value for pixels without source data (default: fill_value(src_raster),
+      since GDAL would otherwise fill them with 0 like valid data)
+    - tolerance: error threshold of GDAL's approximate transformer in pixels;
+      with a tiny value such as 1e-6 the result doesn't depend on how it is tiled
+
+    Returns:
+    - ndarray of shape (count, height, width), or a WarpedVRT if lazy
+    """
+    crs, transform, height, width = raster_grid(reference)
+    if nodata is None:
+        nodata = fill_value(src_raster)
+
+    # GDAL otherwise picks the resampling kernel's scale per warp chunk, so tiles and
+    # the whole grid (itself warped in chunks) would differ wherever it varies
+    xscale, yscale = warp_scale(src_raster, (crs, transform, height, width))
+    vrt = WarpedVRT(src_raster, crs=crs, transform=transform, width=width, height=height,
+                    resampling=resampling_method(resampling), nodata=nodata, tolerance=tolerance,
+                    XSCALE=xscale, YSCALE=yscale)
+    if lazy:
+        return vrt
+
+    with vrt, profiling.span('align.warp', tiled=tile_size is not None) as span:
+        if tile_size is None:
+            data = vrt.read()
+            span.allocated(data)
+            return data
+        data = np.empty((vrt.count, height, width), dtype=vrt.dtypes[0])
+        span.allocated(data)
+        for row in range(0, height, tile_size):
+            for col in range(0, width, tile_size):
+                window = Window(col, row, min(tile_size, width - col), min(tile_size, height - row))
+                rows, cols = window.toslices()
+                vrt.read(window=window, out=data[:, rows, cols])
+        return data
+
+
+def grid_key(grid):
+    """
+    Turn a (crs, transform, height, width) grid into a hashable, picklable key
+    that can be sent to worker processes.
+    """
+    crs, transform, height, width = grid
+    return (str(crs), tuple(transform)[:6], height, width)
+
+
+# Per-process cache of rasters opened on a target grid, see open_on_grid; least recently used first
+_on_grid = OrderedDict()
+on_grid_maxsize = 16
 
-    out_shape = (src_raster.count, reference_raster.height, reference_raster.width)
-    transform = reference_raster.transform
 
-    data = src_raster.read(out_shape=out_shape, resampling=resampling)
+def open_on_grid(path, key, resampling='bilinear'):
+    """
+    Open a raster as a lazy view on a target grid, once per process.
+
+    Worker processes call this for every tile, so the file is opened and the
+    warp set up only on first use. A raster already on the grid is returned as is.
+    At most on_grid_maxsize rasters stay open, the least recently used one is
+    closed beyond that; close_on_grid() closes them all.
+
+    Parameters:
+    - path: path of the raster file
+    - key: target grid key from grid_key
+    - resampling: str or Resampling enum used when the raster has to be warped
+
+    Returns:
+    - rasterio dataset or WarpedVRT on the target grid
+    """
+    cache_key = (path, key, str(resampling))
+    if cache_key in _on_grid:
+        _on_grid.move_to_end(cache_key)
+    else:
+        crs, transform, height, width = key
+        src = rasterio.open(path)
+        if grid_key(raster_grid(src)) == key:
+            _on_grid[cache_key] = (src, src)
+        else:
+            grid = (crs, rasterio.Affine(*transform), (height, width))
+            _on_grid[cache_key] = (src, align_raster_obj(src, grid, resampling, lazy=True))
+        while len(_on_grid) > on_grid_maxsize:
+            _close_handles(_on_grid.popitem(last=False)[1])
+    return _on_grid[cache_key][1]
+
+
+def _close_handles(handles):
+    src, view = handles
+    if view is not src:
+        view.close()
+    src.close()
+
+
+def close_on_grid():
+    """Close every raster opened by open_on_grid in this process."""
+    while _on_grid:
+        _close_handles(_on_grid.popitem()[1])
+
+
+@profiling.profiled('resample')
+def resample_raster_obj(src_raster, reference_raster, resampling='bilinear'):
+    """
+    Resample one raster (src_raster) to match the grid (CRS, resolution and transform) of another (reference_raster).
+    
+    Parameters:
+    - src_raster: rasterio DatasetReader object (the one to resample)
+    - reference_raster: rasterio DatasetReader object (defines target resolution/transform)
+    - resampling: str or Resampling enum (default 'bilinear')
+
+    Returns:
+    - rasterio DatasetReader object (in memory, resampled)
+    """
+    nodata = fill_value(src_raster)
+    data = align_raster_obj(src_raster, reference_raster, resampling, nodata=nodata)
 
-    kwargs = src_raster.meta.copy()
+    kwargs = tiled_profile(src_raster.meta)
     kwargs.update({
+        # Marks the pixels outside the source, also when the source has no nodata
+        'nodata': nodata,
+        'crs': reference_raster.crs,
         'height': reference_raster.height,
         'width': reference_raster.width,
-        'transform': transform
+        'transform': reference_raster.transform
     })
 
     memfile = MemoryFile()
-    with memfile.open(**kwargs) as dst:
+    with memfile.open(**kwargs) as dst, profiling.span('resample.write') as span:
+        # The profile doesn't carry them, and quantized codes would otherwise read as values
+        copy_scaling(src_raster, dst)
         dst.write(data)
+        span.wrote(data)
     return memfile.open()
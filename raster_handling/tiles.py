@@ -0,0 +1,294 @@
+import io
+import math
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import rasterio
+from PIL import Image
+from rasterio.transform import from_bounds
+from rasterio.warp import reproject, transform_bounds
+
+from raster_handling import profiling
+from raster_handling.rasterhandler import dataset_cache, resampling_method
+
+# Half the width of the web mercator world, in metres
+origin_shift = math.pi * 6378137
+
+# Colour ramp for single-band layers, low to high (light yellow to dark red)
+color_stops = np.array([
+    [255, 255, 204],
+    [254, 217, 118],
+    [253, 141, 60],
+    [227, 26, 28],
+    [128, 0, 38],
+], dtype=np.float64)
+
+# Lookup table of 256 RGB colours interpolated along color_stops
+color_table = np.stack([
+    np.interp(np.linspace(0, 1, 256), np.linspace(0, 1, len(color_stops)), color_stops[:, i])
+    for i in range(3)
+], axis=1).astype(np.uint8)
+
+# Per-file display range of single-band layers
+_stretch = {}
+_stretch_lock = threading.Lock()
+
+
+def tile_bounds(z, x, y):
+    """
+    Bounds of an XYZ (slippy map) tile in EPSG:3857.
+
+    Returns:
+    - (left, bottom, right, top) in metres
+    """
+    size = 2 * origin_shift / 2 ** z
+    left = -origin_shift + x * size
+    top = origin_shift - y * size
+    return left, top - size, left + size, top
+
+
+@profiling.profiled('upload.overviews')
+def build_overviews(path, resampling='average', min_size=256):
+    """
+    Add internal overviews to a raster so zoomed-out tiles read few pixels.
+
+    Levels are powers of two until the coarsest one fits in min_size pixels.
+    Rasters that already have overviews are left alone.
+
+    Parameters:
+    - path: path of a GeoTIFF that can be opened for update
+    - resampling: str or Resampling enum used to build the overviews
+    - min_size: edge length of the coarsest level, in pixels
+
+    Returns:
+    - list of overview factors of the first band
+    """
+    with rasterio.open(path, 'r+') as dataset:
+        if dataset.overviews(1):
+            return dataset.overviews(1)
+        factors = []
+        factor = 2
+        while max(dataset.width, dataset.height) / factor >= min_size:
+            factors.append(factor)
+            factor *= 2
+        if factors:
+            resampling = resampling_method(resampling)
+            dataset.build_overviews(factors, resampling)
+            dataset.update_tags(ns='rio_overview', resampling=resampling.name)
+        return factors
+
+
+def overview_level(dataset, resolution):
+    """
+    Pick the coarsest overview that is still at least as fine as resolution.
+
+    Parameters:
+    - dataset: rasterio dataset at full resolution
+    - resolution: wanted pixel size in the dataset's CRS units
+
+    Returns:
+    - overview index for rasterio.open(..., overview_level=), or None for full resolution
+    """
+    level = None
+    for i, factor in enumerate(dataset.overviews(1)):
+        if dataset.res[0] * factor <= resolution:
+            level = i
+    return level
+
+
+def display_range(path):
+    """
+    2nd and 98th percentile of the first band, from the coarsest overview, once per file.
+    """
+    with _stretch_lock:
+        if path in _stretch:
+            return _stretch[path]
+    with dataset_cache.open(path) as dataset:
+        overviews = dataset.overviews(1)
+    level = len(overviews) - 1 if overviews else None
+    with dataset_cache.open(path, level) as dataset:
+        data = dataset.read(1, masked=True).astype(np.float64).filled(np.nan)
+    values = data[np.isfinite(data)]
+    if values.size:
+        low, high = np.percentile(values, [2, 98])
+    else:
+        low, high = 0.0, 1.0
+    if high <= low:
+        high = low + 1.0
+    with _stretch_lock:
+        _stretch[path] = (float(low), float(high))
+    return _stretch[path]
+
+
+def colorize(data, path, rgb):
+    """
+    Turn warped tile data into an RGBA image; NaN pixels become transparent.
+
+    Parameters:
+    - data: float32 array of shape (bands, size, size)
+    - path: raster path, used for the display range of single-band layers
+    - rgb: render the first three bands as colour instead of applying the colour ramp
+
+    Returns:
+    - uint8 array of shape (size, size, 4)
+    """
+    valid = ~np.isnan(data).any(axis=0)
+    rgba = np.zeros(data.shape[1:] + (4,), dtype=np.uint8)
+    if rgb:
+        rgba[..., :3] = np.moveaxis(np.nan_to_num(data[:3]).clip(0, 255), 0, -1)
+    else:
+        low, high = display_range(path)
+        index = np.nan_to_num((data[0] - low) * (255 / (high - low))).clip(0, 255).astype(np.uint8)
+        rgba[..., :3] = color_table[index]
+    rgba[..., 3] = np.where(valid, 255, 0)
+    return rgba
+
+
+def encode_png(rgba):
+    buffer = io.BytesIO()
+    Image.fromarray(rgba, mode='RGBA').save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+# Returned for tiles outside the raster
+empty_tile = encode_png(np.zeros((256, 256, 4), dtype=np.uint8))
+
+
+@profiling.profiled('tile.render')
+def render_tile(path, z, x, y, tile_size=256, resampling='bilinear'):
+    """
+    Render one XYZ tile of a raster as a PNG.
+
+    Only the source pixels under the tile are read, from the overview level
+    closest to the tile's resolution, and warped to EPSG:3857. Three-band uint8
+    rasters are drawn as RGB; anything else is drawn from its first band with a
+    colour ramp stretched over the layer's 2nd-98th percentile.
+
+    Parameters:
+    - path: path of the raster file
+    - z, x, y: tile coordinates
+    - tile_size: tile edge in pixels
+    - resampling: str or Resampling enum used for the warp
+
+    Returns:
+    - PNG bytes
+    """
+    bounds = tile_bounds(z, x, y)
+    with dataset_cache.open(path) as dataset:
+        left, bottom, right, top = transform_bounds('EPSG:3857', dataset.crs, *bounds, densify_pts=21)
+        src_left, src_bottom, src_right, src_top = dataset.bounds
+        if left >= src_right or right <= src_left or bottom >= src_top or top <= src_bottom:
+            return empty_tile
+        level = overview_level(dataset, (right - left) / tile_size)
+        rgb = dataset.count >= 3 and dataset.dtypes[0] == 'uint8'
+
+    indexes = [1, 2, 3] if rgb else [1]
+    data = np.full((len(indexes), tile_size, tile_size), np.nan, dtype=np.float32)
+    with dataset_cache.open(path, level) as dataset, profiling.span('tile.warp', z=z) as span:
+        span.allocated(data)
+        reproject(
+            source=rasterio.band(dataset, indexes),
+            destination=data,
+            src_nodata=dataset.nodata,
+            dst_transform=from_bounds(*bounds, tile_size, tile_size),
+            dst_crs='EPSG:3857',
+            dst_nodata=np.nan,
+            resampling=resampling_method(resampling)
+        )
+    with profiling.span('tile.colorize') as span:
+        rgba = colorize(data, path, rgb)
+        span.allocated(rgba)
+    with profiling.span('tile.encode_png') as span:
+        png = encode_png(rgba)
+        span.wrote(len(png))
+    return png
+
+
+class TileCache:
+    """
+    Bounded two-level LRU cache of rendered tiles: in memory, backed by a directory on disk.
+
+    The most recently used max_items tiles are kept in memory. Every tile is also
+    written to cache_dir, which is trimmed back to 90% of max_bytes (oldest access
+    first) whenever it grows past max_bytes, so tiles survive a restart.
+    """
+
+    def __init__(self, cache_dir=None, max_items=1024, max_bytes=512 * 2**20):
+        self.cache_dir = cache_dir or os.path.join(tempfile.gettempdir(), "soil_erosion", "tiles")
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._disk_bytes = sum(entry.stat().st_size for entry in os.scandir(self.cache_dir)
+                               if entry.name.endswith('.png'))
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.png")
+
+    def get(self, key):
+        """Return the cached PNG bytes for key, or None."""
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key]
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        self._remember(key, data)
+        return data
+
+    def put(self, key, data):
+        """Store PNG bytes under key, in memory and on disk."""
+        self._remember(key, data)
+        path = self.path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._disk_bytes += len(data)
+            trim = self._disk_bytes > self.max_bytes
+        if trim:
+            self.trim()
+
+    def _remember(self, key, data):
+        with self._lock:
+            self._memory[key] = data
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_items:
+                self._memory.popitem(last=False)
+
+    def trim(self):
+        """Remove the least recently used tiles from disk until they fit in 90% of max_bytes."""
+        with self._lock:
+            entries = []
+            for entry in os.scandir(self.cache_dir):
+                if entry.name.endswith('.png'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= 0.9 * self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+            self._disk_bytes = total
+
+    def tile(self, key, render):
+        """Return the tile for key, calling render() and caching the result on a miss."""
+        data = self.get(key)
+        if data is None:
+            data = render()
+            self.put(key, data)
+        return data
@@ -0,0 +1,306 @@
+import csv
+import hashlib
+import json
+import math
+import os
+import tempfile
+
+import numpy as np
+import rasterio
+import shapely
+from rasterio.crs import CRS
+from rasterio.features import geometry_mask, rasterize
+from rasterio.warp import transform_geom
+from rasterio.windows import Window, bounds as window_bounds, transform as window_transform
+from shapely.geometry import box, mapping, shape
+
+from raster_handling import profiling
+from raster_handling.cog import cog_profile
+from raster_handling.rasterhandler import block_windows, dataset_cache, grid_key, raster_grid, read_float32
+
+# Where zone label rasters are kept between runs
+label_cache_dir = os.path.join(tempfile.gettempdir(), "soil_erosion", "zone_labels")
+
+
+def sat_path(path):
+    """Path of the summed-area table stored next to a raster."""
+    return f"{path}.sat.npy"
+
+
+@profiling.profiled('zonal.summed_area_table')
+def build_summed_area_table(path, tile_size=512, force=False):
+    """
+    Build the summed-area table (integral image) of a raster's first band, next to it.
+
+    The table has shape (2, height + 1, width + 1) in float64: layer 0 is the
+    running sum of the valid values and layer 1 the running count of valid
+    pixels, both with a leading row and column of zeros. The sum and count of
+    any rectangle of pixels then take four lookups each. It is built in one
+    streaming pass of row strips and written to a memory-mapped .npy, so memory
+    stays at a few strips; on disk it takes 16 bytes per pixel.
+
+    Parameters:
+    - path: path of the raster file
+    - tile_size: approximate strip height in rows
+    - force: rebuild even if an up-to-date table exists
+
+    Returns:
+    - path of the .npy table
+    """
+    out_path = sat_path(path)
+    if not force and os.path.exists(out_path) and os.path.getmtime(out_path) >= os.path.getmtime(path):
+        return out_path
+
+    tmp_path = f"{out_path}.{os.getpid()}.tmp.npy"
+    with rasterio.open(path) as src:
+        sat = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float64, shape=(2, src.height + 1, src.width + 1))
+        sat[:, 0, :] = 0
+        sat[:, :, 0] = 0
+        # Full-width strips whose height is a whole number of blocks
+        block_height = src.block_shapes[0][0]
+        strip_height = -(-tile_size // block_height) * block_height
+        for row in range(0, src.height, strip_height):
+            window = Window(0, row, src.width, min(strip_height, src.height - row))
+            # Decoded, so a quantized output's table holds values rather than codes
+            data = read_float32(src, window=window)
+            valid = np.isfinite(data)
+            values = np.where(valid, data, 0).astype(np.float64)
+            row0, row1 = int(window.row_off) + 1, int(window.row_off + window.height) + 1
+            for layer, block in ((0, values), (1, valid.astype(np.float64))):
+                block = block.cumsum(axis=0).cumsum(axis=1)
+                block += sat[layer, row0 - 1, 1:]
+                sat[layer, row0:row1, 1:] = block
+        sat.flush()
+        del sat
+    os.replace(tmp_path, out_path)
+    return out_path
+
+
+def pixel_span(transform, bounds, width, height):
+    """
+    Rows and columns of the pixels whose centres lie inside bounds, clipped to the raster.
+
+    Returns:
+    - (row0, row1, col0, col1) half-open ranges; empty if row1 <= row0 or col1 <= col0
+    """
+    left, bottom, right, top = bounds
+    inverse = ~transform
+    cols, rows = zip(*(inverse * corner for corner in ((left, top), (right, bottom))))
+    col0 = max(0, math.ceil(min(cols) - 0.5))
+    col1 = min(width, math.floor(max(cols) - 0.5) + 1)
+    row0 = max(0, math.ceil(min(rows) - 0.5))
+    row1 = min(height, math.floor(max(rows) - 0.5) + 1)
+    return row0, row1, col0, col1
+
+
+def rectangle_sum(sat, row0, row1, col0, col1):
+    """Sum and count of valid pixels in rows [row0, row1) and columns [col0, col1), from the table."""
+    corners = sat[:, [row1, row0, row1, row0], [col1, col1, col0, col0]]
+    total = corners[:, 0] - corners[:, 1] - corners[:, 2] + corners[:, 3]
+    return float(total[0]), int(round(total[1]))
+
+
+def summarize(values, percentiles):
+    """Statistics of a 1-D array of valid values."""
+    stats = {'count': int(values.size), 'sum': float(values.sum(dtype=np.float64))}
+    if values.size:
+        stats.update(mean=stats['sum'] / values.size, min=float(values.min()), max=float(values.max()))
+        stats['percentiles'] = {str(p): float(v) for p, v in zip(percentiles, np.percentile(values, percentiles))}
+    else:
+        stats.update(mean=None, min=None, max=None, percentiles={str(p): None for p in percentiles})
+    return stats
+
+
+@profiling.profiled('zonal_stats')
+def zonal_stats(path, geometry, crs='EPSG:4326', percentiles=(5, 25, 50, 75, 95)):
+    """
+    Statistics of a raster's first band inside a polygon.
+
+    The polygon is reprojected to the raster's CRS, and only the window of pixels
+    under its bounding box is read. Pixels count as inside when their centre is,
+    and nodata and NaN pixels are skipped. If the polygon is an axis-aligned
+    rectangle in the raster's CRS (e.g. drawn on a geographic raster) and no
+    percentiles are asked for, the answer comes from the summed-area table in
+    constant time without reading any pixels.
+
+    Parameters:
+    - path: path of the raster file
+    - geometry: GeoJSON-like polygon or a shapely geometry
+    - crs: CRS of the geometry
+    - percentiles: percentiles to compute; empty to skip them (and allow the constant-time path)
+
+    Returns:
+    - dict with count, sum, mean, min, max (None for the table path) and percentiles
+    """
+    geometry = shape(geometry) if isinstance(geometry, dict) else geometry
+    percentiles = list(percentiles)
+
+    with dataset_cache.open(path) as src:
+        raster_crs, transform, width, height = src.crs, src.transform, src.width, src.height
+    if crs is not None and raster_crs is not None and CRS.from_user_input(crs) != raster_crs:
+        geometry = shape(transform_geom(crs, raster_crs, mapping(geometry)))
+    row0, row1, col0, col1 = pixel_span(transform, geometry.bounds, width, height)
+    if row1 <= row0 or col1 <= col0:
+        return summarize(np.zeros(0), percentiles)
+
+    rectangle = geometry.equals(box(*geometry.bounds)) and transform.b == 0 and transform.d == 0
+    table = sat_path(path)
+    if rectangle and not percentiles and os.path.exists(table) and os.path.getmtime(table) >= os.path.getmtime(path):
+        sat = np.load(table, mmap_mode='r')
+        total, count = rectangle_sum(sat, row0, row1, col0, col1)
+        return {'count': count, 'sum': total, 'mean': total / count if count else None,
+                'min': None, 'max': None, 'percentiles': {}}
+
+    window = Window(col0, row0, col1 - col0, row1 - row0)
+    with dataset_cache.open(path) as src:
+        if src.scales[0] != 1 or src.offsets[0] != 0:
+            # Quantized storage: statistics of the values, as in the summed-area table
+            data = np.ma.masked_invalid(read_float32(src, window=window))
+        else:
+            data = src.read(1, window=window, masked=True)
+    inside = ~geometry_mask([geometry], out_shape=data.shape, transform=window_transform(window, transform))
+    values = data.data[inside & ~np.ma.getmaskarray(data)]
+    values = values[np.isfinite(values)] if values.dtype.kind == 'f' else values
+    return summarize(values, percentiles)
+
+
+def build_zone_labels(zones_path, reference_path, id_field=None, tile_size=1024, cache_dir=None):
+    """
+    Rasterize a zone layer (counties, HUCs, ...) once into an integer label raster on a factor grid.
+
+    Zone i of the layer (in file order) gets label i + 1; pixels outside every
+    zone are 0. Where zones overlap, the later one wins. The grid is cut into
+    tiles and each tile only rasterizes the zones whose bounds touch it. The
+    result is cached under a hash of the zone file, id_field and target grid, so
+    aggregating more rasters on the same grid reuses it.
+
+    Parameters:
+    - zones_path: path of the zone layer (anything geopandas reads)
+    - reference_path: raster whose grid the labels use (e.g. the R-factor output)
+    - id_field: attribute holding the zone id (default: the row number)
+    - tile_size: approximate tile edge in pixels
+    - cache_dir: directory of cached label rasters (default: label_cache_dir)
+
+    Returns:
+    - (path of the label raster, list of zone ids indexed by label - 1)
+    """
+    with rasterio.open(reference_path) as ref:
+        grid = raster_grid(ref)
+    stat = os.stat(zones_path)
+    digest = hashlib.sha256(json.dumps([
+        os.path.abspath(zones_path), stat.st_size, stat.st_mtime_ns, id_field, grid_key(grid)
+    ], default=str).encode()).hexdigest()[:32]
+    cache_dir = cache_dir or label_cache_dir
+    os.makedirs(cache_dir, exist_ok=True)
+    label_path = os.path.join(cache_dir, f"zones_{digest}.tif")
+    ids_path = f"{label_path}.ids.json"
+    if os.path.exists(label_path) and os.path.exists(ids_path):
+        with open(ids_path) as f:
+            return label_path, json.load(f)
+
+    import geopandas as gpd
+
+    crs, transform, height, width = grid
+    zones = gpd.read_file(zones_path)
+    if zones.crs is not None and crs is not None and not zones.crs.equals(crs):
+        zones = zones.to_crs(crs)
+    ids = list(range(len(zones))) if id_field is None else zones[id_field].tolist()
+    if len(ids) >= 2**32 - 1:
+        raise ValueError("Too many zones for a uint32 label raster")
+    geometries = zones.geometry.values
+    labels = np.arange(1, len(zones) + 1, dtype=np.uint32)
+    tree = shapely.STRtree(geometries)
+
+    profile = cog_profile({'dtype': 'uint32', 'count': 1, 'height': height, 'width': width,
+                           'crs': crs, 'transform': transform, 'nodata': 0}, blocksize=256)
+    tmp_path = f"{label_path}.{os.getpid()}.tmp.tif"
+    with rasterio.open(tmp_path, 'w', **profile) as dest:
+        for window in block_windows(dest, tile_size=tile_size):
+            hits = np.sort(tree.query(box(*window_bounds(window, transform))))
+            tile = np.zeros((int(window.height), int(window.width)), dtype=np.uint32)
+            if len(hits):
+                rasterize(zip(geometries[hits], labels[hits]), out=tile,
+                          transform=window_transform(window, transform))
+            dest.write(tile, 1, window=window)
+    os.replace(tmp_path, label_path)
+    with open(ids_path, 'w') as f:
+        json.dump([i.item() if hasattr(i, 'item') else i for i in ids], f)
+    return label_path, ids
+
+
+def aggregate_labels(value_path, label_path, n_zones, tile_size=1024):
+    """
+    Per-zone count, sum, min and max of a raster in one streaming pass.
+
+    Each tile of values and labels is reduced with np.bincount (count, sum) and
+    np.minimum.at / np.maximum.at (min, max) into arrays indexed by label, so the
+    cost is one read of each raster whatever the number of zones.
+
+    Parameters:
+    - value_path: path of the value raster (first band, decoded if quantized)
+    - label_path: label raster on the same grid, from build_zone_labels
+    - n_zones: number of zones
+    - tile_size: approximate tile edge in pixels
+
+    Returns:
+    - dict of arrays of length n_zones + 1 (index 0 is "no zone"): count, sum, min, max
+    """
+    count = np.zeros(n_zones + 1, dtype=np.int64)
+    total = np.zeros(n_zones + 1, dtype=np.float64)
+    low = np.full(n_zones + 1, np.inf)
+    high = np.full(n_zones + 1, -np.inf)
+
+    with rasterio.open(value_path) as values_src, rasterio.open(label_path) as labels_src:
+        if grid_key(raster_grid(values_src)) != grid_key(raster_grid(labels_src)):
+            raise ValueError("The label raster is not on the grid of the value raster")
+        for window in block_windows(values_src, tile_size=tile_size):
+            # Decoded, so quantized outputs are summarized as values rather than codes
+            data = read_float32(values_src, window=window)
+            labels = labels_src.read(1, window=window)
+            valid = np.isfinite(data) & (labels > 0)
+            if not valid.any():
+                continue
+            zone = labels[valid].astype(np.intp)
+            value = data[valid].astype(np.float64)
+            count += np.bincount(zone, minlength=n_zones + 1)
+            total += np.bincount(zone, weights=value, minlength=n_zones + 1)
+            np.minimum.at(low, zone, value)
+            np.maximum.at(high, zone, value)
+    return {'count': count, 'sum': total, 'min': low, 'max': high}
+
+
+@profiling.profiled('aggregate_by_zones')
+def aggregate_by_zones(value_path, zones_path, output_path, id_field=None, tile_size=1024, cache_dir=None):
+    """
+    Summarize a factor or soil loss raster per zone (county, HUC, ...) and write the table as CSV.
+
+    The zones are rasterized once onto the raster's grid (and cached, see
+    build_zone_labels), then aggregated in a single pass (see aggregate_labels).
+    Works for any single-band output, e.g. the R factor or the RUSLE soil loss.
+
+    Parameters:
+    - value_path: path of the raster to summarize
+    - zones_path: path of the zone layer
+    - output_path: path of the CSV to write
+    - id_field: attribute holding the zone id (default: the row number)
+    - tile_size: approximate tile edge in pixels
+    - cache_dir: directory of cached label rasters
+
+    Returns:
+    - output_path
+    """
+    label_path, ids = build_zone_labels(zones_path, value_path, id_field, tile_size, cache_dir)
+    stats = aggregate_labels(value_path, label_path, len(ids), tile_size)
+
+    with open(output_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['zone', 'count', 'sum', 'mean', 'min', 'max'])
+        for label, zone in enumerate(ids, start=1):
+            n = int(stats['count'][label])
+            if n:
+                writer.writerow([zone, n, stats['sum'][label], stats['sum'][label] / n,
+                                 stats['min'][label], stats['max'][label]])
+            else:
+                writer.writerow([zone, 0, 0.0, '', '', ''])
+    print(f"Zonal statistics saved to {output_path}")
+    return output_path
@@ -1,24 +1,97 @@
-from flask import Flask, render_template, request, jsonify
-import folium
-from folium.plugins import Draw
-import geopandas as gpd
+from flask import Flask, render_template, request, jsonify, Response, abort, g
 import os
-import numpy as np
-import rasterio
-from rasterio.warp import calculate_default_transform, Resampling, transform_bounds
-from PIL import Image
-import io
+import re
+import hashlib
+import shutil
+import threading
+import uuid
 import zipfile
-import base64
 import logging
 
+# folium, rasterio and the raster modules are imported by the routes that use them, so the app starts fast
+from raster_handling import profiling
+from soil_erosion_alg_automated.jobs import JobQueue, process_raster, process_shapefile, save_upload
+from soil_erosion_alg_automated.vector_cache import CACHE_NAME, VectorLayerCache
+
 app = Flask(__name__)
 UPLOAD_FOLDER = "uploads"
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
-def create_map():
+# Rendered map tiles, shared by all requests; created by the first tile request
+_tile_cache = None
+_tile_cache_lock = threading.Lock()
+
+# Upload processing runs here instead of in the request threads
+job_queue = JobQueue(max_workers=int(os.environ.get("UPLOAD_WORKERS", 2)))
+
+# Shapefile layers loaded from their vector caches
+vector_layers = VectorLayerCache()
+
+# Layer names are "<file name>-<content hash>", used as file names in UPLOAD_FOLDER
+LAYER_PATTERN = re.compile(r'^[A-Za-z0-9_.-]+-[0-9a-f]{16}$')
+
+# Shapefile layers are folders named "shapefile-<content hash>" in UPLOAD_FOLDER
+VECTOR_PATTERN = re.compile(r'^shapefile-[0-9a-f]{16}$')
+
+def layer_path(layer):
+    return os.path.join(UPLOAD_FOLDER, f"{layer}.tif")
+
+def staging_path(layer):
+    """Where an uploaded raster waits until its job has checked it; not listed as a layer."""
+    return os.path.join(UPLOAD_FOLDER, "staging", f"{layer}.tif")
+
+def tile_url(layer):
+    return f"/tiles/{layer}/{{z}}/{{x}}/{{y}}.png"
+
+def uploaded_layers():
+    """Raster layers uploaded so far, so they are still on the map after a reload."""
+    return sorted(os.path.splitext(name)[0] for name in os.listdir(UPLOAD_FOLDER)
+                  if name.endswith('.tif') and LAYER_PATTERN.match(os.path.splitext(name)[0]))
+
+@app.before_request
+def start_request_span():
+    # One span per request, named after the route; /metrics itself isn't measured
+    if request.endpoint not in (None, 'metrics', 'static'):
+        g.span = profiling.span(f"http.{request.endpoint}", method=request.method).__enter__()
+
+@app.after_request
+def record_response(response):
+    span = g.get('span')
+    if span is not None:
+        span.wrote(response.calculate_content_length() or 0)
+        span.annotate(status=response.status_code)
+    return response
+
+@app.teardown_request
+def finish_request_span(exc):
+    span = g.pop('span', None)
+    if span is not None:
+        span.__exit__(type(exc) if exc else None, exc, None)
+
+@app.route('/metrics')
+def metrics():
+    """Profiling totals of the app and its upload workers, in the Prometheus text format."""
+    return Response(profiling.metrics.prometheus(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+@app.before_request
+def ensure_upload_folder():
+    # Created on the first request rather than on import
+    os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+
+def get_tile_cache():
+    global _tile_cache
+    with _tile_cache_lock:
+        if _tile_cache is None:
+            from raster_handling.tiles import TileCache
+
+            _tile_cache = TileCache(os.path.join(UPLOAD_FOLDER, "tile_cache"))
+        return _tile_cache
+
+def create_map(layers=()):
+    import folium
+    from folium.plugins import Draw
+
     folium_map = folium.Map(location=[20, 0], zoom_start=2, control_scale=True, tiles="openstreetmap", name="Street Map")
     folium.TileLayer(
         tiles="https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}",
@@ -26,13 +99,21 @@ def create_map():
         name="Satellite Imagery",
         overlay=False
     ).add_to(folium_map)
+    for layer in layers:
+        folium.TileLayer(
+            tiles=tile_url(layer),
+            attr="Uploaded raster",
+            name=layer.rsplit('-', 1)[0],
+            overlay=True,
+            opacity=0.6
+        ).add_to(folium_map)
     Draw(export=True).add_to(folium_map)
     folium.LayerControl(collapsed=False).add_to(folium_map)
     return folium_map
 
 @app.route('/')
 def index():
-    folium_map = create_map()
+    folium_map = create_map(uploaded_layers())
     map_data = folium_map._repr_html_()
     logger.debug(f"Generated map HTML: {map_data[:500]}")
     return render_template("base_map.html", map_data=map_data)
@@ -47,30 +128,77 @@ def upload_raster():
     if file_extension not in ['.tif', '.tiff']:
         return jsonify(status="error", message="Please upload a raster file (.tif, .tiff)"), 400
 
-    file_path = os.path.join(UPLOAD_FOLDER, file.filename)
-    file.save(file_path)
+    # Name the layer after the file contents, so a changed file never gets stale cached tiles
+    tmp_path = os.path.join(UPLOAD_FOLDER, f".upload-{uuid.uuid4().hex}.tif")
+    with profiling.span('upload.save') as span:
+        digest = save_upload(file, tmp_path).hexdigest()
+        span.wrote(os.path.getsize(tmp_path))
+    stem = re.sub(r'[^A-Za-z0-9_.-]', '_', os.path.splitext(os.path.basename(file.filename))[0])
+    layer = f"{stem}-{digest[:16]}"
+    file_path = layer_path(layer)
+    info = {'status': "success", 'type': "raster", 'tile_url': tile_url(layer), 'layer': layer, 'name': file.filename}
+    if os.path.exists(file_path):
+        # Published by an earlier upload of the same file
+        os.remove(tmp_path)
+        return queue_job(('raster', digest), process_raster, file_path, info=info)
+
+    # The job publishes the file once it has checked it, so a broken upload never becomes a layer
+    staged = staging_path(layer)
+    os.makedirs(os.path.dirname(staged), exist_ok=True)
+    if os.path.exists(staged):
+        # The same file is waiting for its job already
+        os.remove(tmp_path)
+    else:
+        os.replace(tmp_path, staged)
+    return queue_job(('raster', digest), process_raster, file_path, staged, info=info)
+
+@app.route('/tiles/<layer>/<int:z>/<int:x>/<int:y>.png')
+def tiles(layer, z, x, y):
+    if not LAYER_PATTERN.match(layer) or not 0 <= x < 2 ** z or not 0 <= y < 2 ** z:
+        abort(404)
+    file_path = layer_path(layer)
+    if not os.path.exists(file_path):
+        abort(404)
+    from raster_handling.tiles import render_tile
+
+    png = get_tile_cache().tile(f"{layer}-{z}-{x}-{y}", lambda: render_tile(file_path, z, x, y))
+    # Layer names change with the file contents, so a tile never changes
+    return Response(png, mimetype='image/png', headers={'Cache-Control': 'public, max-age=86400'})
+
+@app.route('/zonal_stats', methods=['POST'])
+def zonal_statistics():
+    """
+    Statistics of a raster layer inside a drawn polygon.
 
+    JSON body:
+    - layer: raster layer name, as returned by /upload_raster
+    - geometry: GeoJSON polygon in EPSG:4326 (a Feature is accepted too)
+    - percentiles: list of percentiles (default 5, 25, 50, 75, 95); an empty list
+      lets rectangles be answered from the summed-area table
+    """
+    body = request.get_json(silent=True) or {}
+    layer = body.get('layer', '')
+    geometry = body.get('geometry')
+    if isinstance(geometry, dict) and geometry.get('type') == 'Feature':
+        geometry = geometry.get('geometry')
+    if not LAYER_PATTERN.match(layer) or not os.path.exists(layer_path(layer)):
+        return jsonify(status="error", message="Unknown layer"), 404
+    if not isinstance(geometry, dict) or geometry.get('type') not in ('Polygon', 'MultiPolygon'):
+        return jsonify(status="error", message="geometry must be a GeoJSON Polygon or MultiPolygon"), 400
     try:
-        logger.debug(f"Processing raster: {file_path}")
-        with rasterio.open(file_path) as src:
-            transform, width, height = calculate_default_transform(src.crs, 'EPSG:3857', src.width, src.height, *src.bounds)
-            kwargs = src.meta.copy()
-            kwargs.update({'crs': 'EPSG:3857', 'transform': transform, 'width': width, 'height': height})
-            img = src.read(out_shape=(src.count, height, width), resampling=Resampling.bilinear)
-            img = np.moveaxis(img, 0, -1)
-            if img.dtype != np.uint8:
-                img = (img * 255).astype(np.uint8)
-            png_image = Image.fromarray(img[:, :, :3] if img.shape[2] >= 3 else img[:, :, 0])
-            png_buffer = io.BytesIO()
-            png_image.save(png_buffer, format="PNG")
-            png_data = base64.b64encode(png_buffer.getvalue()).decode('utf-8')
-            bounds = transform_bounds(src.crs, 'EPSG:4326', *src.bounds)
-            img_bounds = [[bounds[1], bounds[0]], [bounds[3], bounds[2]]]
-            logger.debug(f"Raster bounds: {img_bounds}")
-        return jsonify(status="success", type="raster", image_data=png_data, bounds=img_bounds, name=file.filename)
+        percentiles = [float(p) for p in body.get('percentiles', (5, 25, 50, 75, 95))]
+        if any(not 0 <= p <= 100 for p in percentiles):
+            raise ValueError
+    except (TypeError, ValueError):
+        return jsonify(status="error", message="percentiles must be numbers between 0 and 100"), 400
+    from raster_handling.zonal import zonal_stats
+
+    try:
+        stats = zonal_stats(layer_path(layer), geometry, 'EPSG:4326', percentiles)
     except Exception as e:
-        logger.error(f"Raster processing error: {str(e)}")
-        return jsonify(status="error", message=f"Error processing raster: {str(e)}"), 500
+        logger.error(f"Zonal statistics error: {str(e)}")
+        return jsonify(status="error", message=f"Error computing statistics: {str(e)}"), 500
+    return jsonify(status="success", layer=layer, **stats)
 
 @app.route('/upload_shapefile', methods=['POST'])
 def upload_shapefile():
@@ -78,42 +206,105 @@ def upload_shapefile():
     if not files:
         return jsonify(status="error", message="No files uploaded"), 400
     logger.debug(f"Received shapefile(s): {[f.filename for f in files]}")
-    
-    file_paths = []
-    for f in files:
-        file_path = os.path.join(UPLOAD_FOLDER, f.filename)
-        f.save(file_path)
-        file_paths.append(file_path)
 
+    names = [os.path.basename(f.filename) for f in files]
+    zip_name = next((name for name in names if name.lower().endswith('.zip')), None)
+    shp_name = next((name for name in names if name.lower().endswith('.shp')), None)
+    if not zip_name and not shp_name:
+        return jsonify(status="error", message="Please upload a shapefile (.shp with .shx and .dbf, or .zip containing them)"), 400
+    if not zip_name:
+        base_name = os.path.splitext(shp_name)[0]
+        required_extensions = ['.shx', '.dbf']
+        missing_files = [ext for ext in required_extensions if base_name + ext not in names]
+        if missing_files:
+            return jsonify(status="error", message=f"Missing required files: {', '.join(base_name + ext for ext in missing_files)}. Please upload .shp, .shx, and .dbf together or use a .zip."), 400
+
+    # Stream the parts into a staging folder, hashing them together in a fixed order
+    staging = os.path.join(UPLOAD_FOLDER, f".upload-{uuid.uuid4().hex}")
+    os.makedirs(staging)
+    digest = hashlib.sha256()
+    for name, f in sorted(zip(names, files), key=lambda item: item[0]):
+        digest.update(name.encode())
+        save_upload(f, os.path.join(staging, name), digest)
+    digest = digest.hexdigest()
+
+    layer = f"shapefile-{digest[:16]}"
+    folder = os.path.join(UPLOAD_FOLDER, layer)
+    if os.path.exists(folder):
+        shutil.rmtree(staging)
+    else:
+        if zip_name:
+            try:
+                with zipfile.ZipFile(os.path.join(staging, zip_name), 'r') as zip_ref:
+                    zip_ref.extractall(staging)
+            except zipfile.BadZipFile:
+                shutil.rmtree(staging)
+                return jsonify(status="error", message="The .zip archive could not be read"), 400
+        try:
+            os.replace(staging, folder)
+        except OSError:
+            # The same files were uploaded concurrently and got there first
+            shutil.rmtree(staging)
+
+    shp_path = next((os.path.join(root, name) for root, _, names_in in os.walk(folder)
+                     for name in sorted(names_in) if name.lower().endswith('.shp')), None)
+    if not shp_path:
+        return jsonify(status="error", message="No .shp file found in the zip archive"), 400
+
+    info = {'status': "success", 'type': "shapefile", 'name': shp_name or zip_name, 'layer': layer,
+            'vector_url': f"/vector/{layer}.geojson"}
+    return queue_job(('shapefile', digest), process_shapefile, shp_path, os.path.join(folder, CACHE_NAME), info=info)
+
+@app.route('/vector/<layer>.geojson')
+def vector(layer):
+    """
+    GeoJSON of a shapefile layer, from its cache, for the current map view.
+
+    Query parameters:
+    - bbox: west,south,east,north in degrees; features are cropped to it (default: the whole layer)
+    - zoom: web map zoom level; geometry is simplified to about half a pixel at it (default: full detail)
+    """
+    cache_path = os.path.join(UPLOAD_FOLDER, layer, CACHE_NAME)
+    if not VECTOR_PATTERN.match(layer) or not os.path.exists(cache_path):
+        abort(404)
     try:
-        shp_file = next((f for f in files if f.filename.lower().endswith('.shp')), None)
-        if not shp_file:
-            return jsonify(status="error", message="No .shp file found. Please upload a .shp file with .shx and .dbf, or a .zip."), 400
-        
-        file_extension = os.path.splitext(shp_file.filename)[1].lower()
-        if file_extension == '.zip':
-            with zipfile.ZipFile(os.path.join(UPLOAD_FOLDER, shp_file.filename), 'r') as zip_ref:
-                zip_ref.extractall(UPLOAD_FOLDER)
-            shp_file_path = os.path.join(UPLOAD_FOLDER, os.path.splitext(shp_file.filename)[0] + '.shp')
-            if not os.path.exists(shp_file_path):
-                return jsonify(status="error", message="No .shp file found in the zip archive"), 400
-            gdf = gpd.read_file(shp_file_path)
-        elif file_extension == '.shp':
-            base_name = os.path.splitext(shp_file.filename)[0]
-            required_extensions = ['.shx', '.dbf']
-            missing_files = [ext for ext in required_extensions if not any(f.filename == base_name + ext for f in files)]
-            if missing_files:
-                return jsonify(status="error", message=f"Missing required files: {', '.join(base_name + ext for ext in missing_files)}. Please upload .shp, .shx, and .dbf together or use a .zip."), 400
-            gdf = gpd.read_file(os.path.join(UPLOAD_FOLDER, shp_file.filename))
-        else:
-            return jsonify(status="error", message="Please upload a shapefile (.shp with .shx and .dbf, or .zip containing them)"), 400
-        geo_json = json.loads(gdf.to_json())
-        bounds = gdf.total_bounds
-        logger.debug(f"Shapefile bounds: {bounds}")
-        return jsonify(status="success", type="shapefile", geojson=geo_json, bounds=[[bounds[1], bounds[0]], [bounds[3], bounds[2]]])
-    except Exception as e:
-        logger.error(f"Shapefile processing error: {str(e)}")
-        return jsonify(status="error", message=f"Error processing shapefile: {str(e)}"), 500
+        bbox = request.args.get('bbox')
+        bbox = tuple(float(v) for v in bbox.split(',')) if bbox else None
+        if bbox is not None and len(bbox) != 4:
+            raise ValueError
+        zoom = request.args.get('zoom', type=int)
+    except ValueError:
+        return jsonify(status="error", message="bbox must be west,south,east,north"), 400
+    if zoom is not None:
+        zoom = min(max(zoom, 0), 24)
+    geojson = vector_layers.get(cache_path).geojson(bbox, zoom)
+    return Response(geojson, mimetype='application/geo+json')
+
+def queue_job(key, fn, *args, info=None):
+    """Hand an upload to the job queue and answer with where to find the job."""
+    job_id, _ = job_queue.submit(key, fn, *args, info=info)
+    if job_id is None:
+        return jsonify(status="error", message="The server is busy, please try again shortly"), 503
+    return jsonify(status="queued", job_id=job_id, status_url=f"/jobs/{job_id}", result_url=f"/jobs/{job_id}/result"), 202
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    status = job_queue.status(job_id)
+    if status is None:
+        return jsonify(status="error", message="Unknown job"), 404
+    return jsonify(status)
+
+@app.route('/jobs/<job_id>/result')
+def job_result(job_id):
+    status = job_queue.status(job_id)
+    if status is None:
+        return jsonify(status="error", message="Unknown job"), 404
+    if status['state'] == 'failed':
+        logger.error(f"Job {job_id} failed: {status['error']}")
+        return jsonify(status="error", message=f"Error processing upload: {status['error']}"), 500
+    if status['state'] != 'done':
+        return jsonify(status=status['state'], job_id=job_id), 202
+    return jsonify(job_queue.result(job_id))
 
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    app.run(threaded=True)
\ No newline at end of file
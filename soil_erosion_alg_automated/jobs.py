@@ -0,0 +1,230 @@
+import hashlib
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from raster_handling import profiling
+
+# The jobs import rasterio and the raster modules when they run, so importing this
+# module (which every worker does on start) stays cheap
+
+CHUNK_SIZE = 2**20
+
+
+def save_upload(file, path, digest=None):
+    """
+    Stream an uploaded file to disk in chunks, hashing it on the way.
+
+    Parameters:
+    - file: werkzeug FileStorage
+    - path: where to write the file
+    - digest: hashlib object to update, e.g. to hash several files together
+
+    Returns:
+    - the digest object
+    """
+    digest = digest or hashlib.sha256()
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.part"
+    with open(tmp_path, 'wb') as out:
+        for chunk in iter(lambda: file.stream.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+            out.write(chunk)
+    os.replace(tmp_path, path)
+    return digest
+
+
+def leaflet_bounds(bounds):
+    """(west, south, east, north) to Leaflet's [[south, west], [north, east]]."""
+    return [[bounds[1], bounds[0]], [bounds[3], bounds[2]]]
+
+
+def process_raster(file_path, staging_path=None):
+    """
+    Job: check an uploaded raster and prepare it for tiling.
+
+    Parameters:
+    - file_path: where the layer is published
+    - staging_path: where the upload waits until it has been checked; it is moved
+      to file_path on success and deleted on failure. None if it is published already.
+
+    Returns:
+    - dict with the raster's bounds in EPSG:4326
+    """
+    import rasterio
+    from rasterio.warp import transform_bounds
+    from rasterio.windows import Window
+
+    from raster_handling.tiles import build_overviews
+    from raster_handling.zonal import build_summed_area_table, sat_path
+
+    if staging_path is not None:
+        try:
+            # Fails on anything GDAL can't read, before the layer shows up on the map
+            with rasterio.open(staging_path) as src:
+                if src.crs is None:
+                    raise ValueError("The raster has no coordinate reference system")
+                src.read(1, window=Window(0, 0, min(src.width, 256), min(src.height, 256)))
+            # Overviews let zoomed-out tiles read a few pixels instead of the whole raster.
+            # They are written in place, so only while no tile request can open the file.
+            build_overviews(staging_path)
+            # The summed-area table answers rectangle statistics without reading pixels
+            build_summed_area_table(staging_path)
+        except Exception:
+            for path in (staging_path, sat_path(staging_path)):
+                if os.path.exists(path):
+                    os.remove(path)
+            raise
+        # The table first, so the published raster never goes without it
+        os.replace(sat_path(staging_path), sat_path(file_path))
+        os.replace(staging_path, file_path)
+    else:
+        # Published with its overviews already; the table is rebuilt if it went missing
+        build_summed_area_table(file_path)
+
+    with rasterio.open(file_path) as src:
+        bounds = transform_bounds(src.crs, 'EPSG:4326', *src.bounds)
+    return {'bounds': leaflet_bounds(bounds)}
+
+
+def process_shapefile(shp_path, cache_path):
+    """
+    Job: convert an uploaded shapefile into its columnar vector cache.
+
+    Returns:
+    - dict with the layer's bounds and number of features
+    """
+    from soil_erosion_alg_automated.vector_cache import build_vector_cache, read_cache_summary
+
+    if os.path.exists(cache_path):
+        # Converted before (e.g. by an earlier run of the server); don't parse the .shp again
+        bounds, count = read_cache_summary(cache_path)
+    else:
+        bounds, count = build_vector_cache(shp_path, cache_path)
+    return {'bounds': leaflet_bounds(bounds), 'features': count}
+
+
+class JobQueue:
+    """
+    Runs upload processing on a process pool and keeps track of the jobs.
+
+    At most max_workers jobs run at once and at most max_pending wait for a
+    worker, so a burst of uploads can't starve the request threads. Jobs are
+    keyed by what they process (e.g. a content hash): submitting a key that
+    already has a queued, running or finished job returns the existing job.
+    The records of the oldest finished jobs are dropped beyond max_jobs.
+    """
+
+    def __init__(self, max_workers=2, max_pending=16, max_jobs=1000):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.max_jobs = max_jobs
+        self._pool = None
+        self._lock = threading.Lock()
+        self._jobs = OrderedDict()
+        self._by_key = {}
+
+    @property
+    def pool(self):
+        # Created on first use, so importing the app doesn't start processes
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.max_workers)
+        return self._pool
+
+    def submit(self, key, fn, *args, info=None):
+        """
+        Queue fn(*args) unless a job for key exists already.
+
+        Parameters:
+        - key: hashable identity of the work
+        - fn: module-level function, run in a worker process; returns a dict
+        - args: arguments of fn
+        - info: dict merged into the job's result (e.g. layer name)
+
+        Returns:
+        - (job id, whether the job is new), or (None, False) if the queue is full
+        """
+        with self._lock:
+            job_id = self._by_key.get(key)
+            if job_id is not None and self._jobs[job_id]['state'] != 'failed':
+                return job_id, False
+            pending = sum(job['state'] == 'queued' for job in self._jobs.values())
+            if pending >= self.max_pending + self.max_workers:
+                return None, False
+
+            job_id = uuid.uuid4().hex
+            self._jobs[job_id] = {
+                'id': job_id,
+                'state': 'queued',
+                'submitted': time.time(),
+                'finished': None,
+                'info': info or {},
+                'result': None,
+                'error': None,
+                'future': None,
+            }
+            self._by_key[key] = job_id
+            # Workers send back the totals of their profiling spans with the result
+            future = self.pool.submit(profiling.run_collecting, profiling.enabled(), fn, *args)
+            self._jobs[job_id]['future'] = future
+            self._prune()
+        future.add_done_callback(lambda f: self._finish(job_id, f))
+        return job_id, True
+
+    def _finish(self, job_id, future):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+            job['finished'] = time.time()
+            error = future.exception()
+            if error is None:
+                result, spans = future.result()
+                profiling.metrics.merge(spans)
+                job['state'] = 'done'
+                job['result'] = dict(job['info'], **result)
+            else:
+                job['state'] = 'failed'
+                job['error'] = str(error)
+
+    def _prune(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job['state'] in ('done', 'failed')]
+        for job_id in finished[:max(0, len(self._jobs) - self.max_jobs)]:
+            del self._jobs[job_id]
+        live = set(self._jobs)
+        self._by_key = {key: job_id for key, job_id in self._by_key.items() if job_id in live}
+
+    def status(self, job_id):
+        """
+        Returns:
+        - dict describing the job, or None if it is unknown
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            state = job['state']
+            if state == 'queued' and job['future'] is not None and job['future'].running():
+                state = 'running'
+            return {
+                'id': job_id,
+                'state': state,
+                'submitted': job['submitted'],
+                'finished': job['finished'],
+                'error': job['error'],
+            }
+
+    def result(self, job_id):
+        """
+        Returns:
+        - the job's result dict, or None if it has none (yet)
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return None if job is None else job['result']
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
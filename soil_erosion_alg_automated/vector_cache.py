@@ -0,0 +1,197 @@
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import shapely
+
+# File holding the columnar cache of a shapefile
+CACHE_NAME = "vector_cache.npz"
+
+# Simplification tolerance, in screen pixels at the requested zoom
+TOLERANCE_PIXELS = 0.5
+
+# Cropped geometries keep this fraction of the viewport around it, so panning a little shows no edges
+CROP_MARGIN = 0.25
+
+
+def zoom_tolerance(zoom):
+    """Size in degrees of TOLERANCE_PIXELS web map pixels at a zoom level (at the equator)."""
+    return TOLERANCE_PIXELS * 360.0 / (256 * 2 ** zoom)
+
+
+def pack(chunks):
+    """Concatenate byte strings into one uint8 array plus an offsets array of length N + 1."""
+    offsets = np.zeros(len(chunks) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(chunk) for chunk in chunks])
+    return np.frombuffer(b''.join(chunks), dtype=np.uint8), offsets
+
+
+def build_vector_cache(shp_path, cache_path):
+    """
+    Convert a shapefile once into a compact columnar cache.
+
+    The cache is a single .npz holding the geometries as WKB in EPSG:4326, each
+    feature's properties as a ready-made JSON object, both packed into flat byte
+    arrays with offsets, and the feature bounds. Loading it needs no shapefile
+    parsing and no pickling.
+
+    Parameters:
+    - shp_path: path of the .shp file
+    - cache_path: path of the .npz to write
+
+    Returns:
+    - (bounds of the layer as (west, south, east, north), number of features)
+    """
+    import geopandas as gpd
+
+    gdf = gpd.read_file(shp_path)
+    if gdf.crs is not None and not gdf.crs.equals('EPSG:4326'):
+        gdf = gdf.to_crs('EPSG:4326')
+    gdf = gdf[~(gdf.geometry.isna() | gdf.geometry.is_empty)]
+
+    geometries = gdf.geometry.values
+    wkb, wkb_offsets = pack(list(shapely.to_wkb(geometries)))
+    records = json.loads(gdf.drop(columns=gdf.geometry.name).to_json(orient='records', date_format='iso'))
+    props, props_offsets = pack([json.dumps(record, separators=(',', ':')).encode() for record in records])
+    bounds = shapely.bounds(geometries).reshape(-1, 4)
+
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp.npz"
+    np.savez(tmp_path, wkb=wkb, wkb_offsets=wkb_offsets, props=props, props_offsets=props_offsets, bounds=bounds)
+    os.replace(tmp_path, cache_path)
+    return layer_bounds(bounds), len(bounds)
+
+
+def layer_bounds(bounds):
+    """Total (west, south, east, north) of an (N, 4) array of feature bounds."""
+    if not len(bounds):
+        return (0.0, 0.0, 0.0, 0.0)
+    return (float(bounds[:, 0].min()), float(bounds[:, 1].min()), float(bounds[:, 2].max()), float(bounds[:, 3].max()))
+
+
+def read_cache_summary(cache_path):
+    """(bounds, number of features) of an existing cache, without decoding any geometry."""
+    with np.load(cache_path, allow_pickle=False) as data:
+        bounds = data['bounds']
+    return layer_bounds(bounds), len(bounds)
+
+
+class VectorLayer:
+    """
+    A shapefile loaded from its columnar cache, with a spatial index.
+
+    Geometries are decoded from WKB only when a query first needs them, and
+    simplified versions are kept for the max_zooms most recently viewed zoom
+    levels, so repeat views of a layer cost an index lookup and JSON assembly
+    while zooming through every level doesn't keep a copy of the layer per level.
+    """
+
+    def __init__(self, cache_path, max_zooms=4):
+        with np.load(cache_path, allow_pickle=False) as data:
+            self._wkb = data['wkb']
+            self._wkb_offsets = data['wkb_offsets']
+            self._props = data['props']
+            self._props_offsets = data['props_offsets']
+            self.bounds = data['bounds']
+        self._lock = threading.Lock()
+        self._geometries = np.full(len(self.bounds), None, dtype=object)
+        self.max_zooms = max_zooms
+        self._simplified = OrderedDict()
+        self.tree = shapely.STRtree(shapely.box(*self.bounds.T)) if len(self.bounds) else None
+
+    def __len__(self):
+        return len(self.bounds)
+
+    def _decode(self, index):
+        missing = index[shapely.is_missing(self._geometries[index])]
+        if len(missing):
+            self._geometries[missing] = shapely.from_wkb([
+                self._wkb[self._wkb_offsets[i]:self._wkb_offsets[i + 1]].tobytes() for i in missing
+            ])
+        return self._geometries[index]
+
+    def geometries(self, index, zoom=None):
+        """
+        Geometries of the features at index, simplified for zoom (None for full detail).
+        """
+        with self._lock:
+            geometries = self._decode(index)
+            if zoom is None:
+                return geometries
+            cache = self._simplified.get(zoom)
+            if cache is None:
+                cache = self._simplified[zoom] = np.full(len(self), None, dtype=object)
+                while len(self._simplified) > self.max_zooms:
+                    self._simplified.popitem(last=False)
+            else:
+                self._simplified.move_to_end(zoom)
+            missing = index[shapely.is_missing(cache[index])]
+            if len(missing):
+                # Plain Douglas-Peucker is an order of magnitude faster than the topology-preserving
+                # variant, and self-intersections of half a pixel don't show on screen. Features it
+                # collapses entirely are redone with the topology-preserving one so they stay visible.
+                tolerance = zoom_tolerance(zoom)
+                simplified = shapely.simplify(self._geometries[missing], tolerance, preserve_topology=False)
+                collapsed = shapely.is_empty(simplified)
+                simplified[collapsed] = shapely.simplify(self._geometries[missing[collapsed]], tolerance,
+                                                         preserve_topology=True)
+                cache[missing] = simplified
+            return cache[index]
+
+    def query(self, bbox=None):
+        """Indices of the features whose bounds intersect bbox (west, south, east, north), in file order."""
+        if self.tree is None:
+            return np.zeros(0, dtype=np.intp)
+        if bbox is None:
+            return np.arange(len(self))
+        return np.sort(self.tree.query(shapely.box(*bbox)))
+
+    def geojson(self, bbox=None, zoom=None):
+        """
+        GeoJSON FeatureCollection text of the features in bbox, simplified for zoom and cropped to bbox.
+
+        Parameters:
+        - bbox: (west, south, east, north) viewport in degrees, or None for the whole layer
+        - zoom: web map zoom level, or None for full detail
+
+        Returns:
+        - str
+        """
+        index = self.query(bbox)
+        geometries = self.geometries(index, zoom)
+        if bbox is not None and len(index):
+            west, south, east, north = bbox
+            dx, dy = CROP_MARGIN * (east - west), CROP_MARGIN * (north - south)
+            geometries = shapely.clip_by_rect(geometries, west - dx, south - dy, east + dx, north + dy)
+            # Bounds can touch the viewport while the geometry itself does not
+            keep = ~shapely.is_empty(geometries)
+            index, geometries = index[keep], geometries[keep]
+        features = [
+            f'{{"type":"Feature","geometry":{geometry},"properties":'
+            f'{self._props[self._props_offsets[i]:self._props_offsets[i + 1]].tobytes().decode()}}}'
+            for i, geometry in zip(index, shapely.to_geojson(geometries))
+        ]
+        return '{"type":"FeatureCollection","features":[' + ','.join(features) + ']}'
+
+
+class VectorLayerCache:
+    """Keeps the most recently used VectorLayers loaded in memory."""
+
+    def __init__(self, maxsize=8):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._layers = OrderedDict()
+
+    def get(self, cache_path):
+        with self._lock:
+            layer = self._layers.get(cache_path)
+            if layer is not None:
+                self._layers.move_to_end(cache_path)
+                return layer
+        layer = VectorLayer(cache_path)
+        with self._lock:
+            self._layers[cache_path] = layer
+            while len(self._layers) > self.maxsize:
+                self._layers.popitem(last=False)
+        return layer
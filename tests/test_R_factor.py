@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+
+from factor_scripts.R_factor import calculate_rainfall_erosivity
+
+
+def precip(shape, seed=0):
+    # Both sides of the jump at 850 mm
+    return np.random.default_rng(seed).uniform(0, 2000, shape).astype(np.float32)
+
+
+def test_in_place_matches_a_new_array():
+    P = precip((40, 70))
+    expected = calculate_rainfall_erosivity(P)
+    assert calculate_rainfall_erosivity(P, out=P) is P
+    assert np.array_equal(P, expected)
+
+
+def test_writes_through_a_strided_view():
+    P = precip((3, 40, 70))
+    big = np.zeros((3, 40, 100), dtype=np.float32)
+    calculate_rainfall_erosivity(P, out=big[..., :70])
+    assert np.array_equal(big[..., :70], calculate_rainfall_erosivity(P))
+    assert not big[..., 70:].any()
+
+
+def test_rejects_an_out_it_cannot_write_through():
+    big = np.zeros((3, 40, 100), dtype=np.float32)
+    with pytest.raises(ValueError):
+        calculate_rainfall_erosivity(precip((3, 20, 70)), out=big[:, :20, :70])
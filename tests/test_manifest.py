@@ -0,0 +1,105 @@
+import os
+
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+
+from raster_handling.manifest import TileManifest, output_tiles
+
+size = 512
+profile = {'dtype': 'float32', 'count': 1, 'width': size, 'height': size, 'crs': 'EPSG:5070',
+           'transform': from_origin(0, 0, 30, 30), 'nodata': None}
+
+
+def write_input(path, data):
+    with rasterio.open(path, 'w', driver='GTiff', **dict(profile, dtype=data.dtype.name)) as dest:
+        dest.write(data, 1)
+
+
+class Run:
+    """read/compute callbacks for TileManifest.build doubling an input raster, counting the computed tiles."""
+
+    def __init__(self, input_path, fail_after=None):
+        self.input_path = input_path
+        self.fail_after = fail_after
+        self.computed = 0
+
+    def read(self, window):
+        with rasterio.open(self.input_path) as src:
+            return [src.read(1, window=window)]
+
+    def compute(self, window, arrays):
+        if self.fail_after is not None and self.computed == self.fail_after:
+            raise RuntimeError("interrupted")
+        self.computed += 1
+        return arrays[0] * 2
+
+    def build(self, manifest, **kwargs):
+        tiles = output_tiles(size, size, tile_size=128, blocksize=128)
+        return manifest.build(profile, tiles, [self.input_path], self.read, self.compute, params={'factor': 2},
+                              blocksize=128, **kwargs)
+
+
+@pytest.fixture
+def paths(tmp_path):
+    input_path = str(tmp_path / 'input.tif')
+    write_input(input_path, np.arange(size * size, dtype=np.float32).reshape(size, size))
+    return input_path, str(tmp_path / 'output.tif')
+
+
+def output(path):
+    with rasterio.open(path) as src:
+        return src.read(1)
+
+
+def test_rerun_skips_verifies_and_rebuilds_only_changed_tiles(paths):
+    input_path, output_path = paths
+    with TileManifest(output_path) as manifest:
+        assert Run(input_path).build(manifest) == {'skipped': 0, 'verified': 0, 'rebuilt': 16}
+        assert Run(input_path).build(manifest) == {'skipped': 16, 'verified': 0, 'rebuilt': 0}
+
+        # Same pixels, new stamp: every tile is read but none recomputed
+        stat = os.stat(input_path)
+        os.utime(input_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        assert Run(input_path).build(manifest) == {'skipped': 0, 'verified': 16, 'rebuilt': 0}
+
+        data = np.arange(size * size, dtype=np.float32).reshape(size, size)
+        data[200, 400] = -1
+        write_input(input_path, data)
+        assert Run(input_path).build(manifest) == {'skipped': 0, 'verified': 15, 'rebuilt': 1}
+    assert np.array_equal(output(output_path), data * 2)
+
+
+def test_interrupted_build_resumes_from_the_last_flush(paths):
+    input_path, output_path = paths
+    with TileManifest(output_path) as manifest:
+        with pytest.raises(RuntimeError):
+            Run(input_path, fail_after=5).build(manifest, flush_every=2)
+        run = Run(input_path)
+        counts = run.build(manifest, flush_every=2)
+    # The five finished tiles were recorded, the last one when the failure closed the file
+    assert counts == {'skipped': 5, 'verified': 0, 'rebuilt': 11}
+    assert run.computed == counts['rebuilt']
+    assert np.array_equal(output(output_path), np.arange(size * size, dtype=np.float32).reshape(size, size) * 2)
+
+
+def test_new_parameters_rebuild_everything(paths):
+    input_path, output_path = paths
+    with TileManifest(output_path) as manifest:
+        Run(input_path).build(manifest)
+        run = Run(input_path)
+        tiles = output_tiles(size, size, tile_size=128, blocksize=128)
+        counts = manifest.build(profile, tiles, [input_path], run.read, run.compute, params={'factor': 3},
+                                blocksize=128)
+    assert counts['rebuilt'] == 16
+
+
+def test_discard_keeps_only_the_output(paths):
+    input_path, output_path = paths
+    manifest = TileManifest(output_path)
+    Run(input_path).build(manifest)
+    assert os.path.exists(manifest.work_path)
+    manifest.discard()
+    assert os.path.exists(output_path)
+    assert not os.path.exists(manifest.work_path) and not os.path.exists(manifest.path)
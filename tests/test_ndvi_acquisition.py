@@ -0,0 +1,95 @@
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_bounds
+from rasterio.warp import transform_bounds
+
+from factor_scripts.ndvi_acquisition import acquire_ndvi, split_bbox, utm_zone
+
+bbox = {'west': 5.0, 'south': 51.0, 'east': 5.2, 'north': 51.1}
+
+
+class StandInFetch:
+    """Local backend: writes a tile whose NDVI is the month of the start date divided by 20."""
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, tile, datetime, output_path):
+        self.calls.append((tile, tuple(datetime)))
+        value = int(datetime[0][5:7]) / 20
+        transform = from_bounds(tile['west'], tile['south'], tile['east'], tile['north'], 20, 20)
+        with rasterio.open(output_path, 'w', driver='GTiff', width=20, height=20, count=1, dtype='float32',
+                           crs='EPSG:4326', transform=transform, nodata=np.nan) as dest:
+            dest.write(np.full((1, 20, 20), value, dtype=np.float32))
+
+
+class UTMStandInFetch(StandInFetch):
+    """Like StandInFetch, but each tile comes in the UTM zone of its centre, as Sentinel-2 tiles do."""
+
+    def __call__(self, tile, datetime, output_path):
+        self.calls.append((tile, tuple(datetime)))
+        crs = f"EPSG:{32600 + utm_zone((tile['west'] + tile['east']) / 2)}"
+        left, bottom, right, top = transform_bounds('EPSG:4326', crs, tile['west'], tile['south'], tile['east'],
+                                                    tile['north'], densify_pts=21)
+        width, height = int((right - left) // 500) + 1, int((top - bottom) // 500) + 1
+        with rasterio.open(output_path, 'w', driver='GTiff', width=width, height=height, count=1, dtype='float32',
+                           crs=crs, transform=from_bounds(left, bottom, right, top, width, height),
+                           nodata=np.nan) as dest:
+            dest.write(np.full((1, height, width), 0.5, dtype=np.float32))
+
+
+def mosaic(path):
+    with rasterio.open(path) as src:
+        return src.read(1)
+
+
+def test_mosaic_covers_every_tile(tmp_path):
+    fetch = StandInFetch()
+    output = str(tmp_path / 'ndvi.tif')
+    acquire_ndvi(bbox, ['2022-05-01', '2022-05-30'], output, tile_degrees=0.05, fetch=fetch)
+    assert len(fetch.calls) == len(split_bbox(bbox, 0.05))
+    values = mosaic(output)
+    assert np.allclose(values[~np.isnan(values)], 0.25)
+    assert np.isnan(values).mean() < 0.05
+
+
+def test_rerun_reuses_tiles_of_the_same_request(tmp_path):
+    fetch = StandInFetch()
+    output = str(tmp_path / 'ndvi.tif')
+    acquire_ndvi(bbox, ['2022-05-01', '2022-05-30'], output, tile_degrees=0.1, fetch=fetch)
+    acquire_ndvi(bbox, ['2022-05-01', '2022-05-30'], output, tile_degrees=0.1, fetch=fetch)
+    assert len(fetch.calls) == len(split_bbox(bbox, 0.1))
+
+
+def test_other_dates_or_tiling_fetch_new_tiles(tmp_path):
+    fetch = StandInFetch()
+    output = str(tmp_path / 'ndvi.tif')
+    acquire_ndvi(bbox, ['2022-05-01', '2022-05-30'], output, tile_degrees=0.1, fetch=fetch)
+
+    acquire_ndvi(bbox, ['2022-07-01', '2022-07-30'], output, tile_degrees=0.1, fetch=fetch)
+    values = mosaic(output)
+    assert np.allclose(values[~np.isnan(values)], 0.35)
+
+    calls = len(fetch.calls)
+    acquire_ndvi(bbox, ['2022-07-01', '2022-07-30'], output, tile_degrees=0.05, fetch=fetch)
+    assert len(fetch.calls) == calls + len(split_bbox(bbox, 0.05))
+
+
+def test_mosaic_across_utm_zones_is_geographic(tmp_path):
+    output = str(tmp_path / 'ndvi.tif')
+    across = {'west': 5.0, 'south': 51.0, 'east': 7.0, 'north': 52.0}
+    acquire_ndvi(across, ['2022-05-01', '2022-05-30'], output, tile_degrees=1.0, fetch=UTMStandInFetch())
+    with rasterio.open(output) as src:
+        assert src.crs.to_epsg() == 4326
+        assert src.bounds.left == pytest.approx(5.0) and src.bounds.top == pytest.approx(52.0)
+        values = src.read(1)
+    assert np.allclose(values[~np.isnan(values)], 0.5)
+    assert np.isnan(values).mean() < 0.05
+
+
+def test_mosaic_within_one_utm_zone_keeps_the_tile_crs(tmp_path):
+    output = str(tmp_path / 'ndvi.tif')
+    acquire_ndvi(bbox, ['2022-05-01', '2022-05-30'], output, tile_degrees=0.1, fetch=UTMStandInFetch())
+    with rasterio.open(output) as src:
+        assert src.crs.to_epsg() == 32631
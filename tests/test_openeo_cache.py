@@ -0,0 +1,112 @@
+import os
+
+from factor_scripts.C_Factor import fetch_NDVI_TERRASCOPE
+from factor_scripts.openeo_cache import DownloadCache, cache_key, get_connection
+
+
+class StandInCube:
+    """Just enough of an openEO data cube for fetch_NDVI_TERRASCOPE, counting downloads."""
+
+    def __init__(self, backend, collection, bands):
+        self.backend = backend
+        self.graph = {'collection': collection, 'bands': bands, 'steps': []}
+
+    def apply(self, process):
+        self.graph['steps'].append('apply')
+        return self
+
+    def max_time(self):
+        self.graph['steps'].append('max_time')
+        return self
+
+    def flat_graph(self):
+        return self.graph
+
+    def download(self, path):
+        self.backend.downloads += 1
+        with open(path, 'wb') as f:
+            f.write(b'ndvi ' + repr(self.graph).encode())
+
+
+class StandInBackend:
+    """Local openEO backend: load_collection returns a StandInCube."""
+
+    def __init__(self, url=None):
+        self.url = url
+        self.downloads = 0
+        self.loads = 0
+
+    def load_collection(self, collection, spatial_extent, temporal_extent, bands, **kwargs):
+        self.loads += 1
+        return StandInCube(self, collection, bands)
+
+
+bbox = {'west': 5.05, 'south': 51.21, 'east': 5.06, 'north': 51.22}
+dates = ['2022-07-01', '2022-07-30']
+
+
+def test_second_fetch_hits_the_cache(tmp_path):
+    cache = DownloadCache(str(tmp_path / 'cache'))
+    calls = []
+
+    def download(path):
+        calls.append(path)
+        with open(path, 'wb') as f:
+            f.write(b'tile')
+
+    key = cache_key('C', ['B'], bbox, dates)
+    assert not cache.fetch(key, download, str(tmp_path / 'a.tif'))
+    assert cache.fetch(key, download, str(tmp_path / 'b.tif'))
+    assert len(calls) == 1
+    assert (tmp_path / 'b.tif').read_bytes() == b'tile'
+
+
+def test_output_is_a_copy_of_the_cache_entry(tmp_path):
+    cache = DownloadCache(str(tmp_path / 'cache'))
+    key = cache_key('C', ['B'], bbox, dates)
+    output = tmp_path / 'out.tif'
+    cache.fetch(key, lambda path: open(path, 'wb').write(b'original'), str(output))
+
+    with open(output, 'r+b') as f:
+        f.write(b'EDITED')
+    with open(cache.get(key), 'rb') as f:
+        assert f.read() == b'original'
+    assert not os.path.samefile(output, cache.get(key))
+
+
+def test_fetch_ndvi_against_a_stand_in_backend(tmp_path):
+    backend = StandInBackend()
+    cache = DownloadCache(str(tmp_path / 'cache'))
+    for name in ('first.tif', 'second.tif'):
+        fetch_NDVI_TERRASCOPE(bbox, dates, str(tmp_path / name), cache=cache, connection=backend)
+    assert backend.downloads == backend.loads == 1
+    assert (tmp_path / 'first.tif').read_bytes() == (tmp_path / 'second.tif').read_bytes()
+
+    # Other dates are another download
+    fetch_NDVI_TERRASCOPE(bbox, ['2022-08-01', '2022-08-30'], str(tmp_path / 'third.tif'), cache=cache,
+                          connection=backend)
+    assert backend.downloads == 2
+
+
+def test_cache_hit_needs_no_connection(tmp_path, monkeypatch):
+    cache = DownloadCache(str(tmp_path / 'cache'))
+    fetch_NDVI_TERRASCOPE(bbox, dates, str(tmp_path / 'first.tif'), cache=cache, connection=StandInBackend())
+
+    def offline(*args, **kwargs):
+        raise AssertionError("connected on a cache hit")
+
+    monkeypatch.setattr('factor_scripts.C_Factor.get_connection', offline)
+    assert fetch_NDVI_TERRASCOPE(bbox, dates, str(tmp_path / 'second.tif'), cache=cache) is None
+    assert (tmp_path / 'first.tif').read_bytes() == (tmp_path / 'second.tif').read_bytes()
+
+
+def test_connection_is_shared_per_connect_factory():
+    url = 'stand-in.invalid'
+    first = get_connection(url, connect=StandInBackend)
+    assert get_connection(url, connect=StandInBackend) is first
+
+    def other_connect(url):
+        return StandInBackend(url)
+
+    # A different stand-in isn't silently replaced by the first connection
+    assert get_connection(url, connect=other_connect) is not first
@@ -0,0 +1,150 @@
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+
+from factor_scripts.R_factor import calculate_rainfall_erosivity, erosivity_quantizer
+from raster_handling.quantize import code_max, quantizer, set_scaling
+from raster_handling.rasterhandler import read_float32, reproject_raster_obj, resample_raster_obj
+from raster_handling.zonal import aggregate_labels
+
+dtypes = ['uint8', 'uint16']
+
+
+def error_bound(q, values):
+    """Half a step, plus the float32 rounding of the decoded values."""
+    return q.max_error + 2 * np.spacing(np.nanmax(np.abs(values)).astype(np.float32))
+
+
+def sample(vmin, vmax, shape=(64, 64), seed=0):
+    values = np.random.default_rng(seed).uniform(vmin, vmax, shape).astype(np.float32)
+    # The ends of the range are the codes most likely to be off by one
+    values.flat[:2] = vmin, vmax
+    return values
+
+
+def write_codes(path, q, values):
+    """Write values quantized with q to a GeoTIFF on a 30 m grid; returns its path."""
+    height, width = values.shape
+    profile = {'driver': 'GTiff', 'width': width, 'height': height, 'count': 1, 'crs': 'EPSG:5070',
+               'transform': from_origin(0, 0, 30, 30)}
+    with rasterio.open(path, 'w', **q.profile(profile)) as dest:
+        set_scaling(dest, q)
+        dest.write(q.encode(values), 1)
+    return path
+
+
+@pytest.mark.parametrize('dtype', dtypes)
+def test_round_trip_is_within_half_a_step(dtype):
+    q = quantizer(dtype, -3.5, 120.0)
+    values = sample(-3.5, 120.0)
+    codes = q.encode(values)
+    assert codes.dtype == np.dtype(dtype)
+    assert codes.max() <= code_max[dtype]
+    assert np.abs(q.decode(codes) - values).max() <= error_bound(q, values)
+
+
+@pytest.mark.parametrize('dtype', dtypes)
+def test_nodata_stays_nodata(dtype):
+    q = quantizer(dtype, 0.0, 1.0)
+    values = sample(0.0, 1.0, (4, 4))
+    values[0, 0] = np.nan
+    values[1, 1] = -9999.0
+    codes = q.encode(values, nodata=-9999.0)
+    assert codes[0, 0] == codes[1, 1] == q.nodata
+    assert np.count_nonzero(codes == q.nodata) == 2
+
+    decoded = q.decode(codes)
+    assert np.isnan(decoded[0, 0]) and np.isnan(decoded[1, 1])
+    assert np.count_nonzero(np.isnan(decoded)) == 2
+    assert q.decode(codes, nodata=-1.0)[1, 1] == -1.0
+
+
+@pytest.mark.parametrize('dtype', dtypes)
+def test_read_float32_decodes_a_quantized_band(tmp_path, dtype):
+    q = quantizer(dtype, 10.0, 5000.0)
+    values = sample(10.0, 5000.0)
+    values[5:9, 3:7] = np.nan
+    path = write_codes(str(tmp_path / 'codes.tif'), q, values)
+
+    with rasterio.open(path) as src:
+        decoded = read_float32(src)
+        window = Window(2, 4, 10, 8)
+        part = read_float32(src, window=window)
+        filled = read_float32(src, nodata=-9999.0)
+
+    valid = ~np.isnan(values)
+    assert decoded.dtype == np.float32
+    assert np.array_equal(np.isnan(decoded), ~valid)
+    assert np.abs(decoded[valid] - values[valid]).max() <= error_bound(q, values)
+    assert np.array_equal(part, decoded[window.toslices()], equal_nan=True)
+    assert np.all(filled[~valid] == -9999.0)
+
+
+def test_read_float32_marks_nodata_of_a_plain_band(tmp_path):
+    values = sample(0.0, 1.0, (8, 8))
+    values[2, 2] = -9999.0
+    path = str(tmp_path / 'plain.tif')
+    with rasterio.open(path, 'w', driver='GTiff', width=8, height=8, count=1, dtype='float32', nodata=-9999.0,
+                       crs='EPSG:5070', transform=from_origin(0, 0, 30, 30)) as dest:
+        dest.write(values, 1)
+
+    with rasterio.open(path) as src:
+        decoded = read_float32(src)
+    assert np.isnan(decoded[2, 2])
+    assert np.array_equal(np.isnan(decoded), values == -9999.0)
+
+
+@pytest.mark.parametrize('dtype', dtypes)
+def test_erosivity_quantizer_covers_the_r_of_the_precipitation_range(dtype):
+    p_range = (200.0, 1500.0)
+    q = erosivity_quantizer(dtype, p_range)
+    # Across the jump of the R formula at 850 mm too
+    precip = sample(*p_range)
+    R = calculate_rainfall_erosivity(precip.copy())
+    assert q.offset == pytest.approx(R.min(), rel=1e-6)
+    assert np.abs(q.decode(q.encode(R)) - R).max() <= error_bound(q, R)
+
+
+def test_erosivity_quantizer_clips_negative_precipitation():
+    q = erosivity_quantizer('uint16', (-50.0, 900.0))
+    assert q.offset == pytest.approx(float(calculate_rainfall_erosivity(np.zeros(1, dtype=np.float32))[0]))
+
+
+@pytest.mark.parametrize('dtype', dtypes)
+def test_resampled_and_reprojected_rasters_keep_the_scaling(tmp_path, dtype):
+    q = quantizer(dtype, 0.0, 300.0)
+    path = write_codes(str(tmp_path / 'codes.tif'), q, sample(0.0, 300.0))
+    with rasterio.open(path) as src:
+        coarse = {'driver': 'GTiff', 'width': 32, 'height': 32, 'count': 1, 'dtype': 'float32',
+                  'crs': src.crs, 'transform': from_origin(0, 0, 60, 60)}
+        with rasterio.open(str(tmp_path / 'grid.tif'), 'w', **coarse) as grid:
+            pass
+        with rasterio.open(str(tmp_path / 'grid.tif')) as grid:
+            outputs = [resample_raster_obj(src, grid, 'nearest'), reproject_raster_obj(src, 'EPSG:4326')]
+    for out in outputs:
+        with out:
+            assert out.scales == (q.scale,) and out.offsets == (q.offset,)
+            decoded = read_float32(out)
+            assert np.nanmin(decoded) >= -q.max_error and np.nanmax(decoded) <= 300.0 + q.max_error
+
+
+def test_aggregate_labels_decodes_quantized_values(tmp_path):
+    q = quantizer('uint16', 0.0, 1000.0)
+    values = sample(0.0, 1000.0, (32, 32))
+    values[0, :4] = np.nan
+    value_path = write_codes(str(tmp_path / 'codes.tif'), q, values)
+    labels = np.ones((32, 32), dtype=np.uint8)
+    labels[16:] = 2
+    label_path = str(tmp_path / 'labels.tif')
+    with rasterio.open(label_path, 'w', driver='GTiff', width=32, height=32, count=1, dtype='uint8',
+                       crs='EPSG:5070', transform=from_origin(0, 0, 30, 30)) as dest:
+        dest.write(labels, 1)
+
+    stats = aggregate_labels(value_path, label_path, 2, tile_size=16)
+    for label, rows in ((1, slice(0, 16)), (2, slice(16, 32))):
+        zone = values[rows]
+        assert stats['count'][label] == np.count_nonzero(~np.isnan(zone))
+        assert stats['sum'][label] == pytest.approx(np.nansum(zone, dtype=np.float64), abs=q.max_error * zone.size)
+        assert stats['max'][label] <= 1000.0 + q.max_error
@@ -0,0 +1,128 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+
+from raster_handling.rasterhandler import DatasetCache, bounded_map, merge_windows
+
+
+def write_raster(path, data):
+    height, width = data.shape
+    with rasterio.open(path, 'w', driver='GTiff', width=width, height=height, count=1, dtype=data.dtype,
+                       crs='EPSG:5070', transform=from_origin(0, 0, 30, 30)) as dest:
+        dest.write(data, 1)
+    return path
+
+
+def contains(outer, inner):
+    return (outer[0] <= inner[0] and outer[1] <= inner[1] and
+            inner[0] + inner[2] <= outer[0] + outer[2] and inner[1] + inner[3] <= outer[1] + outer[3])
+
+
+def test_merge_windows_groups_overlapping_windows():
+    windows = [(0, 0, 10, 10), (5, 5, 10, 10), (100, 100, 10, 10)]
+    labels, merged = merge_windows(windows)
+    assert labels[0] == labels[1] != labels[2]
+    assert merged.tolist()[labels[0]] == [0, 0, 15, 15]
+    assert merged.tolist()[labels[2]] == [100, 100, 10, 10]
+
+
+def test_merged_windows_cover_their_parts_and_stay_small():
+    rng = np.random.default_rng(0)
+    windows = np.column_stack([rng.integers(0, 500, (200, 2)), rng.integers(5, 60, (200, 2))])
+    labels, merged = merge_windows(windows, max_growth=1.25)
+    for label, window in enumerate(merged):
+        parts = windows[labels == label]
+        assert len(parts)
+        assert all(contains(window, part) for part in parts)
+        assert window[2] * window[3] <= 1.25 * (parts[:, 2] * parts[:, 3]).sum()
+
+
+def test_a_chain_of_slight_overlaps_is_not_merged_into_one_read():
+    windows = [(i * 9, i * 9, 10, 10) for i in range(20)]
+    _, merged = merge_windows(windows)
+    assert len(merged) > 1
+    assert (merged[:, 2] * merged[:, 3]).max() < 20 * 100
+
+
+def test_dataset_cache_reuses_and_evicts_handles(tmp_path):
+    paths = [write_raster(str(tmp_path / f"r{i}.tif"), np.full((4, 4), i, dtype=np.uint8)) for i in range(3)]
+    cache = DatasetCache(maxsize=2)
+    with cache.open(paths[0]) as first:
+        pass
+    with cache.open(paths[0]) as again:
+        assert again is first
+    with cache.open(paths[1]), cache.open(paths[2]):
+        pass
+    # The least recently used handle was closed when the third came in
+    assert first.closed
+    cache.close()
+
+
+def test_an_evicted_handle_stays_open_until_its_reader_is_done(tmp_path):
+    paths = [write_raster(str(tmp_path / f"r{i}.tif"), np.full((4, 4), i, dtype=np.uint8)) for i in range(2)]
+    cache = DatasetCache(maxsize=1)
+    with cache.open(paths[0]) as reading:
+        def open_other():
+            with cache.open(paths[1]):
+                pass
+
+        # Another thread evicts it while it is being read
+        thread = threading.Thread(target=open_other)
+        thread.start()
+        thread.join()
+        assert not reading.closed
+        assert reading.read(1)[0, 0] == 0
+    assert reading.closed
+    cache.close()
+
+
+def test_dataset_cache_serves_threads_concurrently(tmp_path):
+    data = np.arange(64 * 64, dtype=np.int32).reshape(64, 64)
+    paths = [write_raster(str(tmp_path / f"r{i}.tif"), data + i) for i in range(4)]
+    cache = DatasetCache(maxsize=2)
+
+    def read(i):
+        with cache.open(paths[i % 4]) as src:
+            return np.array_equal(src.read(1), data + i % 4)
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        assert all(pool.map(read, range(200)))
+    cache.close()
+
+
+class CountingPool(ThreadPoolExecutor):
+    """Thread pool counting the jobs submitted to it."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.submitted = 0
+
+    def submit(self, fn, *args, **kwargs):
+        self.submitted += 1
+        return super().submit(fn, *args, **kwargs)
+
+
+def square(x):
+    return x * x
+
+
+def test_bounded_map_keeps_at_most_in_flight_jobs_unconsumed():
+    with CountingPool(max_workers=3) as pool:
+        results = []
+        for result in bounded_map(pool, square, ((i,) for i in range(50)), in_flight=4):
+            assert pool.submitted - len(results) <= 4
+            results.append(result)
+    assert sorted(results) == [i * i for i in range(50)]
+
+
+def test_bounded_map_passes_on_worker_errors():
+    def fail(x):
+        raise RuntimeError(f"job {x}")
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        with pytest.raises(RuntimeError, match="job 1"):
+            list(bounded_map(pool, fail, [(1,)], in_flight=2))
@@ -0,0 +1,92 @@
+import numpy as np
+import pytest
+import rasterio
+from rasterio.crs import CRS
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+
+from factor_scripts.rusle_composer import compose_soil_loss, compose_tile, soil_loss_nodata
+from raster_handling.quantize import quantizer, set_scaling
+from raster_handling.rasterhandler import close_on_grid, grid_key, raster_grid
+
+size = 32
+transform = from_origin(0, 0, 30, 30)
+grid = raster_grid((CRS.from_epsg(5070), transform, (size, size)))
+window = (8, 4, 16, 12)
+rows, cols = slice(4, 16), slice(8, 24)
+
+
+def sample(vmin, vmax, seed=0):
+    return np.random.default_rng(seed).uniform(vmin, vmax, (size, size)).astype(np.float32)
+
+
+def write_factor(path, values, q=None, nodata=None):
+    profile = {'driver': 'GTiff', 'width': size, 'height': size, 'count': 1, 'dtype': 'float32',
+               'crs': 'EPSG:5070', 'transform': transform, 'nodata': nodata}
+    if q is not None:
+        profile = q.profile(profile)
+    with rasterio.open(path, 'w', **profile) as dest:
+        if q is not None:
+            set_scaling(dest, q)
+            values = q.encode(values)
+        dest.write(values, 1)
+    return path
+
+
+def ramp(window, transform, crs):
+    """Callable factor: the column offset of every pixel of the tile."""
+    return np.tile(np.arange(window.width, dtype=np.float64) + window.col_off, (window.height, 1))
+
+
+@pytest.fixture(autouse=True)
+def close_handles():
+    yield
+    close_on_grid()
+
+
+def test_multiplies_rasters_constants_and_callables(tmp_path):
+    R, K = sample(100, 2000, seed=1), sample(0.01, 0.6, seed=2)
+    factors = [('R', write_factor(str(tmp_path / 'R.tif'), R)), ('K', write_factor(str(tmp_path / 'K.tif'), K)),
+               ('LS', 2.5), ('C', ramp)]
+    out_window, soil_loss = compose_tile(factors, grid_key(grid), window, 'bilinear')
+
+    expected = R[rows, cols] * K[rows, cols] * np.float32(2.5) * ramp(Window(*window), None, None)
+    assert out_window == window
+    assert soil_loss.dtype == np.float32 and soil_loss.shape == (12, 16)
+    assert np.allclose(soil_loss, expected, rtol=1e-5)
+
+
+def test_nodata_in_any_factor_is_nodata_in_the_output(tmp_path):
+    R, C = sample(100, 2000, seed=1), sample(0.0, 1.0, seed=2)
+    R[5, 10] = -9999.0
+    C[6, 12] = np.nan
+    factors = [('R', write_factor(str(tmp_path / 'R.tif'), R, nodata=-9999.0)),
+               ('C', write_factor(str(tmp_path / 'C.tif'), C))]
+    _, soil_loss = compose_tile(factors, grid_key(grid), window, 'bilinear')
+
+    missing = np.zeros((size, size), dtype=bool)
+    missing[5, 10] = missing[6, 12] = True
+    assert np.array_equal(soil_loss == soil_loss_nodata, missing[rows, cols])
+    assert np.allclose(soil_loss[~missing[rows, cols]], (R * C)[rows, cols][~missing[rows, cols]], rtol=1e-5)
+
+
+def test_decodes_quantized_factors(tmp_path):
+    q = quantizer('uint16', 0.0, 5000.0)
+    R = sample(0.0, 5000.0)
+    R[7, 9] = np.nan
+    factors = [('R', write_factor(str(tmp_path / 'R.tif'), R, q=q)), ('K', 0.5)]
+    _, soil_loss = compose_tile(factors, grid_key(grid), window, 'nearest')
+
+    expected = R[rows, cols] * np.float32(0.5)
+    valid = ~np.isnan(expected)
+    assert np.all(soil_loss[~valid] == soil_loss_nodata)
+    assert np.abs(soil_loss[valid] - expected[valid]).max() <= 0.5 * q.max_error + 1e-3
+
+
+def test_compose_soil_loss_writes_every_tile(tmp_path):
+    R, K = sample(100, 2000, seed=1), sample(0.01, 0.6, seed=2)
+    output_path = compose_soil_loss(str(tmp_path / 'A.tif'), R=write_factor(str(tmp_path / 'R.tif'), R),
+                                    K=write_factor(str(tmp_path / 'K.tif'), K), C=0.2, tile_size=16, workers=1)
+    with rasterio.open(output_path) as src:
+        assert src.nodata == soil_loss_nodata
+        assert np.allclose(src.read(1), R * K * np.float32(0.2), rtol=1e-5)